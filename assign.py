@@ -0,0 +1,117 @@
+# This module labels new articles with the saved cluster model, without refitting anything. It is meant for daily
+# updates: after new PubMed files have been downloaded and added to the multi-CSV setup (modules 'retrieve_data',
+# 'check_hashes_gz_files' and 'create_multi_CSV'), this module:
+# 1. Finds the PMIDs in articles.csv that are not yet in data_with_clusters.csv (without the near-duplicates that are
+#    skipped, see 'near_duplicates');
+# 2. Creates their features with the saved vocabularies and TF-IDF vectorizers (same steps as the full pipeline);
+# 3. Projects them with the saved scaler and PCA basis;
+# 4. Labels them with the nearest saved centroid;
+# 5. Appends them to data_with_clusters.csv.
+# The model files are saved by 'perform_tf_idf_on_title_and_abstract', 'perform_PCA' and 'clustering'.
+
+import numpy as np                                           # For the nearest centroid lookup.
+import pandas as pd                                          # For reading and writing CSV files.
+from pathlib import Path                                     # For handling file paths.
+import joblib                                                # For loading the saved models.
+import schema                                                # For reading and writing CSV files with their types.
+import near_duplicates                                       # For the near-duplicates that are skipped.
+
+from variables import csv_folder
+from convert_to_lower_case import clean_text                 # Same text cleaning as the full pipeline.
+from transform_categorical_to_binary import encode           # Same multi-hot encoding as the full pipeline.
+from combine_transformed_data import combine_features        # Same feature merge as the full pipeline.
+
+# Set directories.
+csv_folder = Path(csv_folder)
+models_folder = csv_folder / "models"
+output_path = csv_folder / "data_with_clusters.csv"
+chunk_size = 100000
+
+# Read the rows of a (large) CSV file that belong to the given PMIDs, in chunks.
+def read_rows(filename, pmids):
+    chunks = []
+    for chunk in schema.read_table(csv_folder / filename, chunksize=chunk_size):
+        chunks.append(chunk[chunk["PMID"].isin(pmids)])
+    return pd.concat(chunks, ignore_index=True)
+
+# Find the articles that are not yet labeled. Skipped near-duplicates are not labeled, as in the full pipeline.
+def find_new_articles():
+    labeled = set(schema.read_table(output_path, usecols=["PMID"])["PMID"])
+    known = labeled | near_duplicates.skipped_pmids(csv_folder)
+    chunks = []
+    for chunk in schema.read_table(csv_folder / "articles.csv", chunksize=chunk_size):
+        chunks.append(chunk[~chunk["PMID"].isin(known)])
+    return pd.concat(chunks, ignore_index=True)
+
+# Create the feature tables (as in the transformed and TF-IDF files) for the given articles: Keywords, MeSH-terms,
+# Chemicals, Title and Abstract, in this order.
+def feature_tables(articles, keywords, mesh_terms, chemicals):
+    # Multi-hot encoding with the vocabularies of the full pipeline (the columns of the transformed files).
+    tables = []
+    for df, column, name in [
+        (keywords, "Keyword", "keywords"),
+        (mesh_terms, "Descriptor", "mesh_terms"),
+        (chemicals, "Chemical", "chemicals")
+    ]:
+        vocabulary = schema.read_table(csv_folder / f"{name}_transformed.csv", nrows=0).columns.drop("PMID")
+        df = df.assign(**{column: df[column].apply(clean_text)})
+        tables.append(encode(df, column, vocabulary).reindex(columns=["PMID", *vocabulary], fill_value=0))
+
+    # TF-IDF with the fitted vectorizers (or the hashing models, see 'hashing_tfidf') of the full pipeline, with the
+    # columns of the TF-IDF files. A missing title or abstract is an empty text, as in the lower-case files of the full
+    # pipeline (not the word "nan").
+    for column, prefix in [("Title", "title"), ("Abstract", "abstract")]:
+        vectorizer = joblib.load(models_folder / f"tfidf_{prefix}.joblib")
+        X_text = vectorizer.transform(articles[column].fillna("").apply(clean_text))
+        columns = schema.read_table(csv_folder / f"tfidf_{prefix}.csv", nrows=0).columns.drop("PMID")
+        text_features = pd.DataFrame(X_text.toarray(), columns=columns)
+        text_features["PMID"] = articles["PMID"].values
+        tables.append(text_features)
+
+    return tables
+
+# Create the feature matrix (as in data_combined_before_PCA.csv) for the given articles.
+def featurize(articles, keywords, mesh_terms, chemicals):
+    return combine_features(articles[["PMID", "SourceFile"]], feature_tables(articles, keywords, mesh_terms, chemicals))
+
+# Project the features with the saved scaler and PCA, and label them with the nearest centroid.
+def assign_clusters(features, model):
+    scaled = model["scaler"].transform(features[model["feature_columns"]])
+    reduced = model["pca"].transform(scaled)
+
+    centroids = model["centroids"]
+    distances = (reduced ** 2).sum(axis=1)[:, None] - 2 * reduced @ centroids.T + (centroids ** 2).sum(axis=1)
+    labels = np.argmin(distances, axis=1) + 1  # Start counting clusters at 1, not at 0.
+
+    result = pd.DataFrame(reduced, columns=[f"pca_{i + 1}" for i in range(reduced.shape[1])])
+    result.insert(0, "SourceFile", features["SourceFile"].values)
+    result.insert(0, "PMID", features["PMID"].values)
+    result["Cluster"] = labels
+    return result
+
+def main():
+    model = joblib.load(models_folder / "cluster_model.joblib")
+
+    # Find the new articles and their Keywords, MeSH-terms and Chemicals.
+    articles = find_new_articles()
+    if articles.empty:
+        print("No new articles to assign.")
+        return
+    new_pmids = set(articles["PMID"])
+    keywords = read_rows("keywords.csv", new_pmids)
+    mesh_terms = read_rows("mesh_terms.csv", new_pmids)
+    chemicals = read_rows("chemicals.csv", new_pmids)
+
+    # Create features, project and label.
+    features = featurize(articles, keywords, mesh_terms, chemicals)
+    result = assign_clusters(features, model)
+
+    # Append to the existing output, in the column order of the existing file.
+    columns = schema.read_table(output_path, nrows=0).columns
+    schema.write_table(result[columns], output_path, header=False, mode="a")
+
+    print(f"Assigned {len(result)} new articles to clusters and appended them to data_with_clusters.csv.")
+    print(result["Cluster"].value_counts().sort_index().to_string())
+
+if __name__ == "__main__":
+    main()
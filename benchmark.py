@@ -0,0 +1,148 @@
+# This module benchmarks the pipeline on synthetic PubMed corpora of increasing size (see 'synthetic_pubmed'). For
+# every size, a corpus is generated (or reused), and the stages from 'create_multi_CSV' to 'profiling_clusters' are run
+# one by one, each in its own process with the destination folder of that corpus. Every stage is measured by
+# 'instrumentation' (time, memory, I/O). The user input of 'perform_PCA' and 'clustering' is given automatically, and
+# charts are not shown (Agg backend).
+# The results are saved to benchmark_results.json and benchmark_results.csv, and the time and memory curves per stage
+# to benchmark.png. The scaling exponent per stage (the slope of log(time) against log(articles)) is printed: about 1
+# means linear scaling, about 2 quadratic scaling.
+#
+# Usage:
+#   python benchmark.py <benchmark folder> --sizes 10000 100000 1000000 --set clustering_k_max=10
+
+import argparse                          # For the command line options.
+import ast                               # For reading the settings given with --set.
+import json                              # For the results.
+import os                                # For the environment of the stage processes.
+import shutil                            # For removing the output of earlier benchmarks.
+import subprocess                        # For running the stages in separate processes.
+import sys                               # For the Python executable.
+from pathlib import Path                 # For handling file paths.
+import numpy as np                       # For the scaling exponents.
+import pandas as pd                      # For the results table.
+import matplotlib                        # For plotting without a display.
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt          # For plotting the curves.
+
+import synthetic_pubmed                  # For generating the corpora.
+from pipeline import STAGES              # For the order of the stages.
+
+module_folder = Path(__file__).resolve().parent
+stage_names = [stage["name"] for stage in STAGES]
+stage_names = stage_names[stage_names.index("create_multi_CSV"):]
+
+# Code that runs one stage in a new process: set the folders and the settings, then run and measure the stage.
+stage_runner = """
+import ast, importlib, json, sys
+import variables
+name, destination_folder, overrides, result_path = sys.argv[1:5]
+variables.destination_folder = destination_folder
+variables.csv_folder = destination_folder + "/pubmed_csv_export"
+for key, value in ast.literal_eval(overrides).items():
+    setattr(variables, key, value)
+import instrumentation
+record = instrumentation.measure(name, lambda: importlib.import_module(name).main(), csv_folder=variables.csv_folder)
+with open(result_path, "w") as f:
+    json.dump(record, f)
+"""
+
+def run_stage(name, corpus_folder, overrides, answers):
+    # Run one stage in a new process. The console output is saved to the folder 'logs' of the corpus.
+    log_folder = corpus_folder / "logs"
+    log_folder.mkdir(exist_ok=True)
+    result_path = log_folder / f"{name}.json"
+    result_path.unlink(missing_ok=True)
+
+    with open(log_folder / f"{name}.log", "w") as log:
+        completed = subprocess.run(
+            [sys.executable, "-c", stage_runner, name, str(corpus_folder), repr(overrides), str(result_path)],
+            input=answers.get(name, ""), text=True, stdout=log, stderr=subprocess.STDOUT, cwd=module_folder,
+            env={**os.environ, "MPLBACKEND": "Agg"}
+        )
+    if completed.returncode != 0 or not result_path.exists():
+        return {"stage": name, "status": "failed"}
+    with open(result_path, "r") as f:
+        return json.load(f)
+
+def scaling_exponents(results):
+    # Slope of log(wall time) against log(generated articles) per stage.
+    exponents = {}
+    for name, group in results[results["status"] == "ran"].groupby("stage"):
+        if group["articles_generated"].nunique() > 1:
+            slope = np.polyfit(np.log(group["articles_generated"]), np.log(group["wall_seconds"].clip(lower=1e-3)), 1)
+            exponents[name] = float(slope[0])
+    return exponents
+
+def plot_results(results, path):
+    # Plot wall time and peak memory against the number of articles, one line per stage (log-log).
+    plt.figure(figsize=(15, 6))
+    for i, (column, ylabel) in enumerate([("wall_seconds", "Wall time (s)"), ("peak_rss_mb", "Peak RSS (MB)")]):
+        plt.subplot(1, 2, i + 1)
+        for name in stage_names:
+            stage_results = results[(results["stage"] == name) & (results["status"] == "ran")]
+            plt.plot(stage_results["articles_generated"], stage_results[column], marker="o", label=name)
+        plt.xscale("log")
+        plt.yscale("log")
+        plt.xlabel("Generated articles")
+        plt.ylabel(ylabel)
+        plt.grid(True)
+    plt.legend(bbox_to_anchor=(1.02, 1), loc="upper left", fontsize="small")
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def run_benchmark(benchmark_folder, sizes, overrides, answers):
+    benchmark_folder = Path(benchmark_folder)
+    records = []
+    for size in sizes:
+        # Generate (or reuse) the corpus, and remove the CSVs of an earlier benchmark (create_multi_CSV resumes).
+        corpus_folder = benchmark_folder / f"{size}_articles"
+        arguments = synthetic_pubmed.parse_arguments([str(corpus_folder), "--articles", str(size)])
+        synthetic_pubmed.generate(corpus_folder, synthetic_pubmed.make_settings(arguments))
+        shutil.rmtree(corpus_folder / "pubmed_csv_export", ignore_errors=True)
+
+        # Run the stages. A failed stage stops this size, since the next stages need its output.
+        for name in stage_names:
+            record = run_stage(name, corpus_folder, overrides, answers)
+            record["articles_generated"] = size
+            records.append(record)
+            if record["status"] != "ran":
+                print(f"{size} articles, {name}: failed (see {corpus_folder / 'logs' / (name + '.log')})")
+                break
+            print(f"{size} articles, {name}: {record['wall_seconds']:.1f} s, {record['peak_rss_mb']:.0f} MB")
+
+    # Save and print the results.
+    results = pd.DataFrame(records)
+    exponents = scaling_exponents(results)
+    with open(benchmark_folder / "benchmark_results.json", "w") as f:
+        json.dump({"sizes": sizes, "overrides": repr(overrides), "stages": records, "scaling_exponents": exponents},
+                  f, indent=2)
+    results.to_csv(benchmark_folder / "benchmark_results.csv", sep="~", index=False)
+    plot_results(results, benchmark_folder / "benchmark.png")
+
+    print("\nStage                                    Scaling exponent (time)")
+    for name in stage_names:
+        if name in exponents:
+            print(f"{name:<41}{exponents[name]:.2f}")
+    print(f"Saved: benchmark results ({benchmark_folder})")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic PubMed corpora.")
+    parser.add_argument("benchmark_folder", help="folder for the corpora and the results")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="numbers of articles")
+    parser.add_argument("--pca-components", type=int, default=10, help="answer to the question of perform_PCA")
+    parser.add_argument("--clusters", type=int, default=8, help="answer to the question of clustering")
+    parser.add_argument("--set", nargs="*", default=[], metavar="NAME=VALUE",
+                        help="settings in 'variables' to override, e.g. clustering_k_max=10")
+    args = parser.parse_args()
+
+    overrides = {}
+    for setting in args.set:
+        key, value = setting.split("=", 1)
+        overrides[key] = ast.literal_eval(value)
+    answers = {"perform_PCA": f"{args.pca_components}\n", "clustering": f"{args.clusters}\n"}
+    run_benchmark(args.benchmark_folder, args.sizes, overrides, answers)
+
+if __name__ == "__main__":
+    main()
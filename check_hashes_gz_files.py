@@ -9,20 +9,21 @@ from variables import destination_folder
 # Convert string path to Path object to prevent error in for-loop.
 destination_folder = Path(destination_folder)
 
-def main():
-    # Calculate the MD5-hash of the file.
-    def calculate_md5(filepath, chunk_size=8192):
-        hash_md5 = hashlib.md5()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
+# Calculate the MD5-hash of the file.
+def calculate_md5(filepath, chunk_size=8192):
+    hash_md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+# Verify all .GZ-files in a folder with their .MD5-files. Returns the list of problems (empty if all files are valid).
+def check_folder(folder):
     # Collect mismatches or malformed/missing files.
     problem_files = []
 
     # Use for-loop to go through all .md5 files and verify their corresponding .GZ-file.
-    for md5_file in sorted(destination_folder.glob("*.xml.gz.md5")):
+    for md5_file in sorted(folder.glob("*.xml.gz.md5")):
         with open(md5_file, "r") as f:
             line = f.read().strip()  # Read the line and strip it.
 
@@ -33,12 +34,17 @@ def main():
 
         target_name = match.group(1)         # Extracted .gz filename.
         expected_hash = match.group(2)       # Extracted expected MD5 hash.
-        gz_file = destination_folder / target_name  # Full path to the .gz file.
+        gz_file = folder / target_name       # Full path to the .gz file.
 
         actual_hash = calculate_md5(gz_file)  # Compute actual hash of the file.
         if actual_hash != expected_hash:      # Compare hashes.
             problem_files.append(f"{target_name}: hash mismatch")  # Add mismatch to problems list.
 
+    return problem_files
+
+def main():
+    problem_files = check_folder(destination_folder)
+
     # Print statements.
     if problem_files:
         print("Some .GZ-files did not pass hash verification.\n")
@@ -0,0 +1,102 @@
+# This module saves and loads the checkpoints of the long fits in 'perform_PCA' (the passes over the data) and
+# 'clustering' (the final K-Means fit), so a stage that is interrupted (a crash, or a preempted batch node) continues
+# from its last checkpoint instead of starting again. A checkpoint holds the state of the estimators and the position in
+# the data (the number of chunks of the current pass, or the number of iterations). A checkpoint is:
+# - written atomically: to a temporary file that replaces the previous checkpoint when it is complete, so an
+#   interruption while writing leaves the previous checkpoint intact;
+# - saved every 'checkpoint_interval' seconds (None disables checkpoints), and at the end of every pass;
+# - only used if the input file and the settings of the stage have not changed since it was saved (its fingerprint);
+#   otherwise the stage starts again;
+# - removed when the stage has finished.
+# A resumed pass reads the same chunks as the interrupted pass (the chunk size is kept in the checkpoint), and the fits
+# are deterministic, so the results are identical to those of an uninterrupted run.
+
+import hashlib                       # For the fingerprint of the input and settings.
+import json                          # Idem.
+import os                            # For writing the checkpoints atomically.
+import time                          # For the checkpoint interval.
+from pathlib import Path             # For handling file paths.
+import joblib                        # For saving the estimators.
+
+import memory_budget                 # For reading the chunks of a pass.
+from variables import checkpoint_interval
+
+def checkpoint_path(folder, stage):
+    return Path(folder) / "models" / "checkpoints" / f"{stage}.joblib"
+
+def fingerprint(paths, settings):
+    # A hash of the name, size and modification time of the input files, and of the settings that change the results.
+    digest = hashlib.sha256()
+    for path in map(Path, paths):
+        stat = path.stat()
+        digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def load(path, fingerprint):
+    # The state of the last checkpoint, or None if there is no (usable) checkpoint.
+    if checkpoint_interval is None or not path.exists():
+        return None
+    try:
+        state = joblib.load(path)
+    except Exception as e:  # E.g. a checkpoint of another version of scikit-learn.
+        print(f"Checkpoint {path.name} cannot be loaded ({e}). Starting from the beginning.")
+        return None
+    if state.get("fingerprint") != fingerprint:
+        print(f"Checkpoint {path.name} is of other input or settings. Starting from the beginning.")
+        return None
+    print(f"Resuming from checkpoint {path.name} (saved {time.strftime('%Y-%m-%d %H:%M:%S', state['saved_at'])}).")
+    return state
+
+def save(path, state):
+    # Write the checkpoint to a temporary file and replace the previous checkpoint with it. The file (and the folder,
+    # for the new name) is flushed to disk first, so a checkpoint is either the previous or the new state.
+    if checkpoint_interval is None:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(path.name + ".tmp")
+    state["saved_at"] = time.localtime()
+    with open(temporary_path, "wb") as f:
+        joblib.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    if os.name == "posix":  # A folder cannot be opened (and synced) on Windows.
+        folder = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+
+def save_if_due(path, state, last_save):
+    # Save the checkpoint if 'checkpoint_interval' seconds have passed since the last save. Returns the time of the
+    # last save.
+    if checkpoint_interval is None or time.monotonic() - last_save < checkpoint_interval:
+        return last_save
+    save(path, state)
+    return time.monotonic()
+
+def remove(path):
+    path.unlink(missing_ok=True)
+
+def run_pass(state, name, input_path, plan, process, path, **read_csv_kwargs):
+    # One pass over the chunks of the input file: process(chunk) for every chunk, with checkpoints. The state holds the
+    # passes that have finished, the current pass and its number of processed chunks, and the chunk size ('rows'). A
+    # finished pass is skipped; an interrupted pass continues after the last chunk of its checkpoint.
+    if name in state["finished"]:
+        print(f"Pass '{name}' was finished before the interruption.")
+        return
+    if state["pass"] != name:
+        state["pass"], state["chunks"] = name, 0
+    skip = state["chunks"] * state["rows"]
+    if skip:
+        print(f"Pass '{name}': continuing after row {skip}.")
+        read_csv_kwargs["skiprows"] = lambda row: 0 < row <= skip  # Row 0 is the header.
+
+    last_save = time.monotonic()
+    for chunk in memory_budget.read_chunks(input_path, {**plan, "rows": state["rows"]}, **read_csv_kwargs):
+        process(chunk)
+        state["chunks"] += 1
+        last_save = save_if_due(path, state, last_save)
+    state["finished"].append(name)
+    save(path, state)
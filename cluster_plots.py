@@ -0,0 +1,92 @@
+# This module plots the clusters on the first three PCA components (PCA 1 vs 2 and PCA 2 vs 3). A scatter plot of
+# millions of articles takes minutes and a lot of memory, so there are two bounded alternatives:
+# - "density": all articles are counted into a 2D grid per cluster (one vectorized pass). Every grid cell gets the
+#   mixed color of the clusters in it, and is darker when it contains more articles. The time to draw the image only
+#   depends on the number of grid cells, not on the number of articles;
+# - "sample": a scatter plot of a stratified sample, with a minimum number of articles per cluster, so that small
+#   clusters remain visible.
+# The plots are saved to the folder 'cluster_plots'.
+
+import numpy as np                                   # For binning and sampling.
+import matplotlib.pyplot as plt                      # For plotting.
+from matplotlib.patches import Patch                 # For the legend of the density plot.
+
+from variables import (
+    clustering_random_state,
+    cluster_plot_mode,
+    cluster_plot_bins,
+    cluster_plot_sample_size
+)
+
+def axis_range(values):
+    # Range of an axis. The most extreme 0.5% on each side is left out, so that outliers do not squeeze the plot.
+    low, high = np.percentile(values, [0.5, 99.5])
+    return (low, high) if high > low else (low - 0.5, high + 0.5)
+
+def bin_indices(values, value_range, bins):
+    # Grid cell number of every value. Values outside the range are put in the outer cells.
+    low, high = value_range
+    return np.clip(((values - low) / (high - low) * bins).astype(np.int64), 0, bins - 1)
+
+def density_counts(x, y, cluster_index, n_clusters, x_range, y_range, bins):
+    # Count the articles per cluster and grid cell in one pass. Returns an array of shape (clusters, bins, bins).
+    cells = (cluster_index * bins + bin_indices(y, y_range, bins)) * bins + bin_indices(x, x_range, bins)
+    return np.bincount(cells, minlength=n_clusters * bins * bins).reshape(n_clusters, bins, bins)
+
+def density_image(counts, colors):
+    # Convert the counts to an RGB image. The color of a cell is the mix of the cluster colors (weighted by the
+    # number of articles per cluster), and its intensity increases with the (log) number of articles.
+    total = counts.sum(axis=0)
+    mixed = np.einsum("kyx,kc->yxc", counts, colors) / np.maximum(total, 1)[:, :, None]
+    intensity = (np.log1p(total) / np.log1p(max(total.max(), 1)))[:, :, None]
+    return mixed * intensity + (1 - intensity)  # Empty cells are white.
+
+def stratified_sample(cluster_index, n_clusters, size):
+    # Row numbers of a random sample in which every cluster has its proportional share, with a minimum of 1% of the
+    # sample size per cluster (or the full cluster if it is smaller).
+    rng = np.random.default_rng(clustering_random_state)
+    cluster_sizes = np.bincount(cluster_index, minlength=n_clusters)
+    shares = np.maximum(np.round(cluster_sizes / len(cluster_index) * size), size // 100).astype(np.int64)
+    shares = np.minimum(shares, cluster_sizes)
+
+    # Shuffle, then sort by cluster (stable), and keep the first 'share' rows of every cluster.
+    order = rng.permutation(len(cluster_index))
+    order = order[np.argsort(cluster_index[order], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(cluster_sizes)[:-1]])
+    return np.concatenate([order[start:start + share] for start, share in zip(starts, shares)])
+
+def plot_clusters(points, labels, output_dir):
+    # Plot PCA 1 vs 2 and PCA 2 vs 3. 'points' contains the first three PCA components, 'labels' the clusters.
+    output_dir.mkdir(exist_ok=True)
+    points = np.asarray(points, dtype=np.float64)
+    cluster_ids, cluster_index = np.unique(np.asarray(labels), return_inverse=True)
+    n_clusters = len(cluster_ids)
+    colors = np.array([plt.cm.tab20(i % 20)[:3] for i in range(n_clusters)])
+
+    if cluster_plot_mode == "sample":
+        sample = stratified_sample(cluster_index, n_clusters, cluster_plot_sample_size)
+        points, cluster_index = points[sample], cluster_index[sample]
+
+    plt.figure(figsize=(12, 5))
+    for i, (x_col, y_col) in enumerate([(0, 1), (1, 2)]):
+        plt.subplot(1, 2, i + 1)
+        x, y = points[:, x_col], points[:, y_col]
+
+        if cluster_plot_mode == "sample":
+            plt.scatter(x, y, c=colors[cluster_index], s=5)
+        else:
+            x_range, y_range = axis_range(x), axis_range(y)
+            counts = density_counts(x, y, cluster_index, n_clusters, x_range, y_range, cluster_plot_bins)
+            plt.imshow(density_image(counts, colors), origin="lower", aspect="auto",
+                       extent=[x_range[0], x_range[1], y_range[0], y_range[1]])
+
+        plt.title(f"Clusters: PCA {x_col + 1} vs {y_col + 1}")
+        plt.xlabel(f"PCA {x_col + 1}")
+        plt.ylabel(f"PCA {y_col + 1}")
+
+    legend = [Patch(color=colors[i], label=f"Cluster {cluster_id}") for i, cluster_id in enumerate(cluster_ids)]
+    plt.legend(handles=legend, bbox_to_anchor=(1.02, 1), loc="upper left", fontsize="small")
+    plt.tight_layout()
+    plt.savefig(output_dir / f"clusters_{cluster_plot_mode}.png")
+    print(f"Saved: cluster_plots/clusters_{cluster_plot_mode}.png")
+    plt.show()
@@ -0,0 +1,114 @@
+# This module calculates cluster quality metrics on the full PCA output instead of on a sample. The exact silhouette
+# score compares every article with every other article (O(n^2)), which is why it could only be calculated on a
+# sample. The metrics in this module only compare articles with the centroids. They are built from per-cluster
+# statistics (counts, sums, sums of distances) that are collected in one streaming pass over the data:
+# - Simplified silhouette: uses the distance to the own centroid (a) and to the nearest other centroid (b);
+# - Calinski-Harabasz: ratio of the between-cluster and within-cluster dispersion;
+# - Davies-Bouldin: average similarity of each cluster with its most similar cluster.
+# Because the simplified silhouette is an approximation, its relative error against the exact silhouette is reported
+# on a subsample.
+
+import numpy as np                                   # For the calculations.
+from sklearn.metrics import silhouette_score         # For the exact silhouette on the subsample.
+import memory_budget                                 # For reading the data in chunks of the planned size.
+
+def new_stats(centers):
+    # Create the empty per-cluster statistics for one set of centroids.
+    k, d = centers.shape
+    return {
+        "centers": np.asarray(centers, dtype=np.float64),
+        "counts": np.zeros(k),
+        "sums": np.zeros((k, d)),
+        "distance_sums": np.zeros(k),
+        "sum_of_squared_norms": 0.0,
+        "inertia": 0.0,
+        "silhouette_sum": 0.0,
+    }
+
+def nearest_centroids(X, centers):
+    # Return the label, the distance to the nearest centroid (a) and to the second nearest centroid (b) per article.
+    squared = (X ** 2).sum(axis=1)[:, None] - 2 * X @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+    distances = np.sqrt(np.maximum(squared, 0))
+    order = np.argsort(distances, axis=1)[:, :2]
+    rows = np.arange(len(X))
+    return order[:, 0], distances[rows, order[:, 0]], distances[rows, order[:, -1]]
+
+def simplified_silhouette_values(a, b):
+    # Silhouette per article, using centroid distances instead of the average distances to all other articles.
+    denominator = np.maximum(a, b)
+    return np.divide(b - a, denominator, out=np.zeros_like(a), where=denominator > 0)
+
+def update_stats(stats, X):
+    # Add one chunk of data to the statistics.
+    k = len(stats["counts"])
+    labels, a, b = nearest_centroids(X, stats["centers"])
+
+    stats["counts"] += np.bincount(labels, minlength=k)
+    stats["sums"] += (labels[:, None] == np.arange(k)[None, :]).T.astype(np.float64) @ X
+    stats["distance_sums"] += np.bincount(labels, weights=a, minlength=k)
+    stats["sum_of_squared_norms"] += float((X ** 2).sum())
+    stats["inertia"] += float((a ** 2).sum())
+    stats["silhouette_sum"] += float(simplified_silhouette_values(a, b).sum())
+    return stats
+
+def finalize_stats(stats):
+    # Calculate the metrics from the collected statistics.
+    counts = stats["counts"]
+    centers = stats["centers"]
+    filled = counts > 0
+    n = counts.sum()
+    k = int(filled.sum())
+
+    # Calinski-Harabasz. The dispersions are taken around the cluster means, like in scikit-learn.
+    means = stats["sums"][filled] / counts[filled][:, None]
+    overall_mean = stats["sums"].sum(axis=0) / n
+    between = float((counts[filled] * ((means - overall_mean) ** 2).sum(axis=1)).sum())
+    within = stats["sum_of_squared_norms"] - float(((stats["sums"][filled] ** 2).sum(axis=1) / counts[filled]).sum())
+    calinski_harabasz = float((between / (k - 1)) / (within / (n - k))) if k > 1 and within > 0 else np.nan
+
+    # Davies-Bouldin. The scatter of a cluster is the average distance of its articles to the centroid.
+    scatter = stats["distance_sums"][filled] / counts[filled]
+    center_distances = np.sqrt(((centers[filled][:, None, :] - centers[filled][None, :, :]) ** 2).sum(axis=2))
+    np.fill_diagonal(center_distances, np.inf)
+    davies_bouldin = float(((scatter[:, None] + scatter[None, :]) / center_distances).max(axis=1).mean())
+
+    return {
+        "n": int(n),
+        "inertia": stats["inertia"],
+        "simplified_silhouette": float(stats["silhouette_sum"] / n),
+        "calinski_harabasz": calinski_harabasz,
+        "davies_bouldin": davies_bouldin,
+    }
+
+def evaluate_chunks(chunks, centers_by_k):
+    # Calculate the metrics for several sets of centroids (one per K) in a single pass over the chunks.
+    all_stats = {k: new_stats(centers) for k, centers in centers_by_k.items()}
+    for X in chunks:
+        X = np.asarray(X, dtype=np.float64)
+        for stats in all_stats.values():
+            update_stats(stats, X)
+    return {k: finalize_stats(stats) for k, stats in all_stats.items()}
+
+def evaluate_file(path, centers_by_k, plan):
+    # Calculate the metrics on the full PCA output, reading it in chunks (see 'memory_budget').
+    reader = memory_budget.read_chunks(path, plan)
+    chunks = (chunk[[c for c in chunk.columns if c.startswith("pca_")]].to_numpy() for chunk in reader)
+    return evaluate_chunks(chunks, centers_by_k)
+
+def silhouette_errors(X_sample, centers_by_k):
+    # Compare the simplified silhouette with the exact silhouette on a (small) subsample, so the approximation can
+    # be trusted. Returns the exact score, the approximation and the relative error per K.
+    X_sample = np.asarray(X_sample, dtype=np.float64)
+    errors = {}
+    for k, centers in centers_by_k.items():
+        labels, a, b = nearest_centroids(X_sample, np.asarray(centers, dtype=np.float64))
+        if len(np.unique(labels)) < 2:
+            continue
+        exact = silhouette_score(X_sample, labels)
+        approximation = float(simplified_silhouette_values(a, b).mean())
+        errors[k] = {
+            "exact": exact,
+            "simplified": approximation,
+            "relative_error": abs(approximation - exact) / abs(exact) if exact != 0 else np.nan,
+        }
+    return errors
@@ -1,125 +1,325 @@
 # This module clusters the data using the selected number of principal components. Specifically, it uses K-Means.
+# The final K-Means fit runs in segments of 'clustering_checkpoint_iterations' iterations, and a checkpoint of the
+# centroids is saved between segments (see 'checkpoints'). An interrupted run continues with the chosen K and the
+# centroids of its last checkpoint, with the same results as an uninterrupted run.
+# The K-sweep runs on a weighted coreset of the PCA output (see 'coreset'), or on a uniform random sample
+# ('clustering_sample_method').
 
+import os                                                # For counting CPU cores.
+import time                                              # For the checkpoint interval.
+from concurrent.futures import ProcessPoolExecutor       # For running the K-sweep in parallel.
 import pandas as pd                                      # For loading and saving data.
 from sklearn.cluster import KMeans                       # For clustering.
-from sklearn.metrics import silhouette_score             # For cluster quality evaluation.
+from threadpoolctl import threadpool_limits              # For bounding the number of threads per worker.
 import matplotlib.pyplot as plt                          # For plotting metrics.
 import matplotlib.ticker as ticker                       # Idem.
-import numpy as np                                       # For BIC approximation.
+import numpy as np                                       # For BIC approximation and the K-sweep.
 from pathlib import Path                                 # For handling file paths.
-from variables import csv_folder                         # Path to final output folder.
+import joblib                                            # For saving the cluster model.
+import checkpoints                                       # For continuing an interrupted final fit.
+import coreset                                           # For the weighted sample of the K-sweep.
+import cluster_quality                                   # For cluster quality evaluation on the full data.
+import minibatch_clustering                              # Out-of-core clustering engine.
+import pmid_metadata                                     # Row count and PMID checksum of articles.csv.
+import near_duplicates                                   # For the near-duplicates that are skipped.
+import cluster_plots                                     # For plotting the clusters.
+import memory_budget                                     # For sizing the sample, workers and chunks to the budget.
+import schema                                            # For loading and saving data with the types of its schema.
+from variables import (
+    csv_folder,                                          # Path to final output folder.
+    clustering_random_state,
+    clustering_k_min,
+    clustering_k_max,
+    clustering_sample_size,
+    clustering_sample_method,
+    clustering_n_jobs,
+    clustering_warm_start,
+    clustering_engine,
+    clustering_checkpoint_iterations,
+    quality_check_sample_size
+)
 
 # Set directories.
 csv_folder_path = Path(csv_folder)
 input_path = csv_folder_path / "data_after_pca.csv"
 output_path = csv_folder_path / "data_with_clusters.csv"
+models_folder = csv_folder_path / "models"
+checkpoint_path = checkpoints.checkpoint_path(csv_folder_path, "clustering")
 
-def main():
-    # Load data.
-    df = pd.read_csv(input_path, sep="~")
-    X = df[[c for c in df.columns if c.startswith("pca_")]]
+# Number of copies of a sample row in a worker of the K-sweep (the sample and the copies made by K-Means), and of a
+# chunk row in the quality metrics (the chunk and its array). The distances to the centroids are added per row.
+sample_copies = 4
+chunk_copies = 2
+
+# Maximum number of iterations of the final K-Means fit (the default of scikit-learn).
+kmeans_max_iter = 300
+
+# The sample (and its weights) used by the K-sweep. Every worker process receives it once (through the initializer),
+# not once per K.
+worker_sample = None
+worker_weights = None
+
+def init_worker(X_sample, weights, n_threads):
+    # Store the sample in the worker and limit its BLAS/OpenMP threads, so that all workers together do not use more
+    # threads than there are CPU cores.
+    global worker_sample, worker_weights
+    worker_sample, worker_weights = X_sample, weights
+    threadpool_limits(limits=n_threads)
+
+def fit_k(k):
+    # Fit K-Means from a cold start (k-means++). Runs in a worker process.
+    model = KMeans(n_clusters=k, random_state=clustering_random_state, n_init="auto")
+    model.fit(worker_sample, sample_weight=worker_weights)
+    return {"k": k, "centers": model.cluster_centers_, "sample_inertia": model.inertia_}
+
+def split_worst_cluster(X_sample, model, weights=None):
+    # Create the initial centroids for K+1 from the K solution (bisecting). The cluster with the largest (weighted) sum
+    # of squared distances is replaced by two centroids, one standard deviation apart along its main direction of
+    # variance.
+    labels = model.labels_
+    centers = model.cluster_centers_
+    weights = np.ones(len(X_sample)) if weights is None else weights
+    distances = ((X_sample - centers[labels]) ** 2).sum(axis=1)
+    sse = np.bincount(labels, weights=weights * distances, minlength=len(centers))
+    worst = int(np.argmax(sse))
+
+    in_worst = labels == worst
+    members = (X_sample[in_worst] - centers[worst]) * np.sqrt(weights[in_worst])[:, None]
+    _, singular_values, vt = np.linalg.svd(members, full_matrices=False)
+    offset = vt[0] * singular_values[0] / np.sqrt(weights[in_worst].sum())
+
+    new_centers = np.delete(centers, worst, axis=0)
+    return np.vstack([new_centers, centers[worst] - offset, centers[worst] + offset])
+
+def run_k_sweep(X_sample, k_range, n_jobs, weights=None):
+    # Fit every K in the K-range, with the weights of the sample rows (None: all 1). Cold starts are independent, so
+    # they run in parallel. With a warm start the fits depend on each other, so they run in order in the main process
+    # (with all threads).
+    X_sample = np.asarray(X_sample)
+
+    if not clustering_warm_start:
+        n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+        initargs = (X_sample, weights, n_threads)
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=initargs) as pool:
+            results = list(pool.map(fit_k, k_range))
+        print(f"K-sweep finished: {len(k_range)} values of K, {n_jobs} workers with {n_threads} thread(s) each.")
+    else:
+        results = []
+        model = None
+        for k in k_range:
+            if model is None:
+                model = KMeans(n_clusters=k, random_state=clustering_random_state, n_init="auto")
+            else:
+                model = KMeans(n_clusters=k, init=split_worst_cluster(X_sample, model, weights), n_init=1)
+            model.fit(X_sample, sample_weight=weights)
+            results.append({"k": k, "centers": model.cluster_centers_, "sample_inertia": model.inertia_})
+        print(f"K-sweep finished: {len(k_range)} values of K, warm started by bisecting.")
+
+    return sorted(results, key=lambda result: result["k"])
+
+def save_cluster_model(centers):
+    # Save the final centroids together with the scaler and PCA basis fitted by 'perform_PCA'. With this model, new
+    # articles can be labeled without refitting anything (see 'assign').
+    pca_model_path = models_folder / "pca_model.joblib"
+    if not pca_model_path.exists():
+        print("No pca_model.joblib found (run perform_PCA first). The cluster model is not saved.")
+        return
+
+    model = joblib.load(pca_model_path)
+    model["centroids"] = np.asarray(centers)
+    joblib.dump(model, models_folder / "cluster_model.joblib")
+    print(f"Saved: cluster_model.joblib ({len(centers)} centroids)")
+
+def check_output(pmids):
+    # Check the PMIDs of the clustered output (in memory) against articles.csv. Instead of reading articles.csv again,
+    # its stored row count and PMID checksum are used (see 'pmid_metadata'). Equal row counts and checksums, without
+    # missing or duplicate PMIDs, mean that both contain exactly the same articles. Skipped near-duplicates (see
+    # 'near_duplicates') are subtracted from the row count and checksum of articles.csv.
+    metadata = pmid_metadata.read_metadata(csv_folder_path) or pmid_metadata.build_metadata(csv_folder_path)
+    pmids = pd.Series(pmids)
+
+    print(f"Rows in clustered output: {len(pmids)}")
+    print(f"Rows in articles.csv: {metadata['rows']}")
+    skipped = near_duplicates.skipped_pmids(csv_folder_path)
+    if skipped:
+        print(f"Skipped near-duplicates: {len(skipped)}")
+        metadata = {
+            "rows": metadata["rows"] - len(skipped),
+            "pmid_checksum": (metadata["pmid_checksum"] - pmid_metadata.pmid_checksum(list(skipped))) % 2 ** 64
+        }
+
+    missing_pmid_count = pmids.isnull().sum()
+    print(f"Rows with missing PMID in clustered output: {missing_pmid_count}")
+
+    duplicate_pmid_count = pmids.duplicated().sum()
+    print(f"Duplicate PMIDs in clustered output: {duplicate_pmid_count}")
+
+    same_pmids = len(pmids) == metadata["rows"] and pmid_metadata.pmid_checksum(pmids) == metadata["pmid_checksum"]
+    print(f"Clustered output and articles.csv contain the same PMIDs (row count and checksum): {same_pmids}")
+
+def uniform_sample(X, rows):
+    # A uniform random sample of rows (without replacement) of the PCA output in RAM, or of the memory-mapped matrix.
+    if clustering_engine == "minibatch":
+        rng = np.random.default_rng(clustering_random_state)
+        sample_rows = np.sort(rng.choice(len(X), size=rows, replace=False))
+        return pd.DataFrame(np.asarray(X[sample_rows], dtype=np.float64))
+    return X.sample(n=rows, random_state=clustering_random_state)
+
+def select_k(X, k_range):
+    # Sample size and number of workers of the K-sweep: 'clustering_sample_size' rows and 'clustering_n_jobs' workers,
+    # with fewer workers (or rows) if they do not fit in the memory budget. Every worker holds its own sample. The
+    # sample is a coreset (with weights) or a uniform sample. Returns the chosen K and a uniform sample (for the
+    # comparison of the Mini-Batch engine with K-Means).
+    n_jobs = 1 if clustering_warm_start else clustering_n_jobs or min(os.cpu_count() or 1, len(k_range))
+    plan = memory_budget.make_plan(
+        "K-sweep", 8 * X.shape[1] * sample_copies, rows=min(clustering_sample_size, len(X)), workers=n_jobs
+    )
+    if clustering_sample_method == "coreset":
+        X_sample, weights = coreset.build(input_path, plan["rows"], clustering_random_state)
+    else:
+        X_sample, weights = uniform_sample(X, plan["rows"]), None
 
     # Evaluate clustering metrics.
-    k_range = range(2, 20)
-    X_sample = X.sample(n=65000, random_state=20250501)
+    results = run_k_sweep(X_sample, k_range, plan["workers"], weights)
+    memory_budget.report(plan)
+    centers_by_k = {result["k"]: result["centers"] for result in results}
 
-    inertias = []
-    silhouette_scores = []
-    bic_scores = []
+    # Calculate the quality metrics on the full data (one streaming pass for all K) and check the simplified
+    # silhouette against the exact silhouette on a small subsample.
+    quality_plan = memory_budget.make_plan(
+        "Cluster quality", memory_budget.bytes_per_row(input_path) * chunk_copies + 8 * 3 * clustering_k_max
+    )
+    metrics = cluster_quality.evaluate_file(input_path, centers_by_k, quality_plan)
+    memory_budget.report(quality_plan)
+    if clustering_sample_method == "coreset":
+        X_check = uniform_sample(X, min(quality_check_sample_size, len(X)))
+    else:
+        X_check = X_sample.sample(
+            n=min(quality_check_sample_size, len(X_sample)), random_state=clustering_random_state
+        )
+    errors = cluster_quality.silhouette_errors(X_check, centers_by_k)
 
+    print("\nK   Simplified silhouette   Simplified silhouette   Exact silhouette   Relative error")
+    print("    (full data)             (subsample)             (subsample)        (subsample)")
     for k in k_range:
-        model = KMeans(n_clusters=k, random_state=20250501, n_init="auto")
-        labels = model.fit_predict(X_sample)
+        if k in errors:
+            print(f"{k:<4}{metrics[k]['simplified_silhouette']:<24.4f}{errors[k]['simplified']:<24.4f}"
+                  f"{errors[k]['exact']:<19.4f}{errors[k]['relative_error']:.2%}")
 
-        inertias.append(model.inertia_)
-        silhouette_scores.append(silhouette_score(X_sample, labels))
+    # The coreset guarantee in practice: the weighted cost of the coreset against the inertia on the full data.
+    if clustering_sample_method == "coreset":
+        print("\nK   Inertia (full data)   Weighted inertia (coreset)   Relative error")
+        for result in results:
+            k, full, estimate = result["k"], metrics[result["k"]]["inertia"], result["sample_inertia"]
+            print(f"{k:<4}{full:<22.1f}{estimate:<29.1f}{abs(estimate - full) / full:.2%}")
 
-        n, d = X_sample.shape
-        bic = n * np.log(model.inertia_ / n) + k * d * np.log(n)
-        bic_scores.append(bic)
+    n, d = X.shape
+    inertias = [metrics[k]["inertia"] for k in k_range]
+    silhouette_scores = [metrics[k]["simplified_silhouette"] for k in k_range]
+    calinski_harabasz_scores = [metrics[k]["calinski_harabasz"] for k in k_range]
+    davies_bouldin_scores = [metrics[k]["davies_bouldin"] for k in k_range]
+    bic_scores = [n * np.log(inertia / n) + k * d * np.log(n) for k, inertia in zip(k_range, inertias)]
+    relative_errors = [errors[k]["relative_error"] if k in errors else np.nan for k in k_range]
 
     # Plot evaluation metrics.
-    plt.figure(figsize=(15, 4))
-
-    plt.subplot(1, 3, 1)
-    plt.plot(k_range, inertias, marker="o")
-    plt.title("Elbow Method")
-    plt.xlabel("K")
-    plt.ylabel("Inertia")
-    plt.grid(True)
-    plt.gca().xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
-
-    plt.subplot(1, 3, 2)
-    plt.plot(k_range, silhouette_scores, marker="o", color="green")
-    plt.title("Silhouette Score")
-    plt.xlabel("K")
-    plt.ylabel("Score")
-    plt.grid(True)
-    plt.gca().xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
-
-    plt.subplot(1, 3, 3)
-    plt.plot(k_range, bic_scores, marker="o", color="purple")
-    plt.title("BIC Score")
-    plt.xlabel("K")
-    plt.ylabel("BIC")
-    plt.grid(True)
-    plt.gca().xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+    plots = [
+        ("Elbow Method", "Inertia", inertias, None),
+        ("Simplified Silhouette Score", "Score", silhouette_scores, "green"),
+        ("BIC Score", "BIC", bic_scores, "purple"),
+        ("Calinski-Harabasz Score", "Score", calinski_harabasz_scores, "orange"),
+        ("Davies-Bouldin Score", "Score", davies_bouldin_scores, "red"),
+        ("Silhouette Relative Error (subsample)", "Relative error", relative_errors, "grey"),
+    ]
+
+    plt.figure(figsize=(15, 8))
+    for i, (title, ylabel, values, color) in enumerate(plots):
+        plt.subplot(2, 3, i + 1)
+        plt.plot(k_range, values, marker="o", color=color)
+        plt.title(title)
+        plt.xlabel("K")
+        plt.ylabel(ylabel)
+        plt.grid(True)
+        plt.gca().xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
 
     plt.tight_layout()
     plt.show()
 
     # Ask input from user: number of clusters.
     chosen_k = int(input("User input required. Enter the number of clusters (K): "))
+    return chosen_k, X_check if clustering_sample_method == "coreset" else X_sample
 
-    # Fit final KMeans model.
-    final_model = KMeans(n_clusters=chosen_k, random_state=20250501, n_init="auto")
-    df["Cluster"] = final_model.fit_predict(X) + 1  # Start counting clusters at 1, not at 0.
+def fit_kmeans(X, state):
+    # Fit the final K-Means model (k-means++ initialization, Lloyd iterations) in segments of
+    # 'clustering_checkpoint_iterations' iterations. Every segment starts from the centroids of the previous segment,
+    # which is the same as continuing the iterations. The fitted model of the last segment is kept in the checkpoint.
+    # The fit stops when a segment converges (stops before its last iteration, or does not change the labels) or after
+    # 'kmeans_max_iter' iterations.
+    last_save = time.monotonic()
+    while not state["converged"] and state["iterations"] < kmeans_max_iter:
+        segment = min(clustering_checkpoint_iterations, kmeans_max_iter - state["iterations"])
+        previous = state["model"]
+        if previous is None:
+            model = KMeans(n_clusters=state["k"], random_state=clustering_random_state, n_init=1, max_iter=segment)
+        else:
+            model = KMeans(
+                n_clusters=state["k"], init=previous.cluster_centers_, n_init=1, max_iter=segment,
+                random_state=clustering_random_state
+            )
+        state["model"] = model.fit(X)
+        state["iterations"] += model.n_iter_
+        state["converged"] = model.n_iter_ < segment or (
+            previous is not None and np.array_equal(model.labels_, previous.labels_)
+        )
+        last_save = checkpoints.save_if_due(checkpoint_path, state, last_save)
+    print(f"K-Means: {state['iterations']} iterations, converged: {state['converged']}.")
+    return state["model"]
 
-    # Save output.
-    df.to_csv(output_path, sep="~", index=False)
-    print(f"Saved: data_with_clusters ({df.shape})")
+def main():
+    # Load data. The Mini-Batch engine does not load the PCA output into RAM, but uses a memory-mapped matrix.
+    k_range = range(clustering_k_min, clustering_k_max + 1)
+    if clustering_engine == "minibatch":
+        X = minibatch_clustering.load_pca_matrix()
+    else:
+        df = schema.read_table(input_path)
+        X = df[[c for c in df.columns if c.startswith("pca_")]]
 
-    # Final checks: compare row counts and PMIDs in clustered output vs original articles.csv.
-    clusters_df = pd.read_csv(output_path, sep="~")
-    articles_df = pd.read_csv(csv_folder_path / "articles.csv", sep="~")
+    # Choose K with the K-sweep, or continue the final fit of an interrupted run with its K (K-Means engine only).
+    fingerprint = checkpoints.fingerprint(
+        [input_path], {"random_state": clustering_random_state, "iterations": clustering_checkpoint_iterations}
+    )
+    state = checkpoints.load(checkpoint_path, fingerprint) if clustering_engine == "kmeans" else None
+    if state is None:
+        chosen_k, X_sample = select_k(X, k_range)
+        state = {"fingerprint": fingerprint, "k": chosen_k, "model": None, "iterations": 0, "converged": False}
+        if clustering_engine == "kmeans":
+            checkpoints.save(checkpoint_path, state)
+    chosen_k = state["k"]
 
-    print(f"Rows in clustered output: {len(clusters_df)}")
-    print(f"Rows in articles.csv: {len(articles_df)}")
+    # Fit final model.
+    if clustering_engine == "minibatch":
+        final_model = minibatch_clustering.fit(X, chosen_k)
+        labels = minibatch_clustering.predict(X, final_model)
+        pmids = minibatch_clustering.save_labels(labels)
+        minibatch_clustering.compare_with_kmeans(X_sample, final_model)
+        df = pd.DataFrame(np.asarray(X[:, :3]), columns=["pca_1", "pca_2", "pca_3"])
+        df["Cluster"] = labels + 1  # Start counting clusters at 1, not at 0.
+    else:
+        final_model = fit_kmeans(X, state)
+        df["Cluster"] = final_model.labels_ + 1  # Start counting clusters at 1, not at 0.
 
-    missing_pmid_count = clusters_df["PMID"].isnull().sum()
-    print(f"Rows with missing PMID in clustered output: {missing_pmid_count}")
+        # Save output.
+        schema.write_table(df, output_path)
+        print(f"Saved: data_with_clusters ({df.shape})")
+        pmids = df["PMID"]
 
-    duplicate_pmid_count = clusters_df["PMID"].duplicated().sum()
-    print(f"Duplicate PMIDs in clustered output: {duplicate_pmid_count}")
+    save_cluster_model(final_model.cluster_centers_)
+    checkpoints.remove(checkpoint_path)
 
-    clusters_pmids = set(clusters_df["PMID"].astype(str))
-    article_pmids = set(articles_df["PMID"].astype(str))
-    print(f"All cluster member PMIDs are in articles.csv: {clusters_pmids.issubset(article_pmids)}")
-    print(f"All articles.csv article PMIDs are in clustered output: {article_pmids.issubset(clusters_pmids)}")
-
-    # Plot clusters using first four PCA components.
-    plt.figure(figsize=(12, 5))
-
-    plt.subplot(1, 2, 1)
-    for cluster_id in sorted(df["Cluster"].unique()):
-        cluster_points = df[df["Cluster"] == cluster_id]
-        plt.scatter(cluster_points["pca_1"], cluster_points["pca_2"], label=f"Cluster {cluster_id}", s=10)
-    plt.title("Clusters: PCA 1 vs 2")
-    plt.xlabel("PCA 1")
-    plt.ylabel("PCA 2")
- #   plt.legend(markerscale=2, fontsize="small")
-
-    plt.subplot(1, 2, 2)
-    for cluster_id in sorted(df["Cluster"].unique()):
-        cluster_points = df[df["Cluster"] == cluster_id]
-        plt.scatter(cluster_points["pca_2"], cluster_points["pca_3"], label=f"Cluster {cluster_id}", s=10)
-    plt.title("Clusters: PCA 2 vs 3")
-    plt.xlabel("PCA 3")
-    plt.ylabel("PCA 4")
- #   plt.legend(markerscale=2, fontsize="small")
+    # Final checks: compare row counts and PMIDs in clustered output vs original articles.csv.
+    check_output(pmids)
 
-    plt.tight_layout()
-    plt.show()
+    # Plot clusters using the first three PCA components (saved to the folder 'cluster_plots').
+    cluster_plots.plot_clusters(df[["pca_1", "pca_2", "pca_3"]], df["Cluster"], csv_folder_path / "cluster_plots")
 
 
 if __name__ == "__main__":
@@ -5,9 +5,11 @@
 # - chemicals_transformed;
 # - tfidf_title;
 # - tfidf_abstract.
+# If 'skip_near_duplicates' is True, the near-duplicates (see 'near_duplicates') are left out.
 
-import pandas as pd                      # For loading and merging CSV files
 from pathlib import Path                 # For handling file paths
+import near_duplicates                   # For the near-duplicates that are skipped
+import schema                            # For loading and saving the CSV files with the types of their schema
 
 from variables import csv_folder
 
@@ -15,35 +17,30 @@ from variables import csv_folder
 csv_folder = Path(csv_folder)
 output_path = csv_folder / "data_combined_before_PCA.csv"
 
-def main():
-    # Load tables.
-    articles = pd.read_csv(csv_folder / "articles.csv", sep="~")
-    articles = articles[["PMID", "SourceFile"]] # Include SourceFile again.
-    articles["PMID"] = articles["PMID"].astype(str)
-
-    keywords = pd.read_csv(csv_folder / "keywords_transformed.csv", sep="~")
-    keywords["PMID"] = keywords["PMID"].astype(str)
-
-    mesh_terms = pd.read_csv(csv_folder / "mesh_terms_transformed.csv", sep="~")
-    mesh_terms["PMID"] = mesh_terms["PMID"].astype(str)
-
-    chemicals = pd.read_csv(csv_folder / "chemicals_transformed.csv", sep="~")
-    chemicals["PMID"] = chemicals["PMID"].astype(str)
-
-    tfidf_title = pd.read_csv(csv_folder / "tfidf_title.csv", sep="~")
-    tfidf_title["PMID"] = tfidf_title["PMID"].astype(str)
-
-    tfidf_abstract = pd.read_csv(csv_folder / "tfidf_abstract.csv", sep="~")
-    tfidf_abstract["PMID"] = tfidf_abstract["PMID"].astype(str)
-
-    # Merge all columns using PMID.
+# Merge all feature tables into the articles table using PMID. The tables must be given in the order above, since
+# columns with the same name in several tables (e.g. a keyword that is also a MeSH-term) get a suffix based on it.
+def combine_features(articles, tables):
     features = articles
-    for table in [keywords, mesh_terms, chemicals, tfidf_title, tfidf_abstract]:
+    for table in tables:
         features = features.merge(table, on="PMID", how="left")
 
-    # Replace NaNs with zeros and export combined matrix.
-    features = features.fillna(0) # NaN-values cause errors later on.
-    features.to_csv(output_path, sep="~", index=False)
+    # Replace NaNs with zeros.
+    return features.fillna(0) # NaN-values cause errors later on.
+
+def main():
+    # Load tables. The PMIDs are 64-bit integers in all tables (see 'schema'). Include SourceFile again.
+    articles = schema.read_table(csv_folder / "articles.csv", usecols=["PMID", "SourceFile"])
+    articles = articles[~articles["PMID"].isin(near_duplicates.skipped_pmids(csv_folder))]
+
+    keywords = schema.read_table(csv_folder / "keywords_transformed.csv")
+    mesh_terms = schema.read_table(csv_folder / "mesh_terms_transformed.csv")
+    chemicals = schema.read_table(csv_folder / "chemicals_transformed.csv")
+    tfidf_title = schema.read_table(csv_folder / "tfidf_title.csv")
+    tfidf_abstract = schema.read_table(csv_folder / "tfidf_abstract.csv")
+
+    # Merge all tables and export combined matrix.
+    features = combine_features(articles, [keywords, mesh_terms, chemicals, tfidf_title, tfidf_abstract])
+    schema.write_table(features, output_path)
 
     print(f"\nCombined feature matrix created: data_combined_before_PCA.csv, ({features.shape})")
 
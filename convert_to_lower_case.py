@@ -12,62 +12,67 @@
 # used as input for TF-IDF later on. Each of these TF-IDF executions will result in a separate
 # table with data.
 
-import pandas as pd             # For reading and writing CSV files.
 import re                       # For cleaning and normalizing text.
 from pathlib import Path        # For working with file paths.
+import schema                   # For reading and writing the CSVs with the types of their schema.
+import sqlite_store             # For reading the tables from the SQLite store.
 
-from variables import csv_folder
+from variables import csv_folder, use_sqlite_store
 
 # Set directory containing input CSVs.
 csv_folder = Path(csv_folder)
 
-def main():
-    # Load CSVs to be processed.
-    articles_df = pd.read_csv(csv_folder / "articles.csv", sep="~")
-    keywords_df = pd.read_csv(csv_folder / "keywords.csv", sep="~")
-    mesh_df = pd.read_csv(csv_folder / "mesh_terms.csv", sep="~")
-    chemicals_df = pd.read_csv(csv_folder / "chemicals.csv", sep="~")
+# Clean and normalize text by converting to lowercase, stripping whitespace,
+# and replacing tabs, etc. with a single space.
+def clean_text(text):
+    return re.sub(r"\s+", " ", str(text).lower().strip())
 
-    # Clean and normalize text by converting to lowercase, stripping whitespace,
-    # and replacing tabs, etc. with a single space.
-    def clean_text(text):
-        return re.sub(r"\s+", " ", str(text).lower().strip())
+# Create the lower-case tables from the multi-CSV tables. Returns the tables per output file name.
+def lower_case_tables(articles_df, keywords_df, mesh_df, chemicals_df):
+    tables = {}
 
-    # Create lowercase title file.
+    # Lowercase title table.
     title_df = articles_df[["PMID", "Title", "SourceFile"]].copy()
     title_df["Title"] = title_df["Title"].apply(clean_text)
-    title_df.to_csv(csv_folder / "articles_title_lower_case.csv", sep="~", index=False)
-    print("Created: articles_title_lower_case.csv")
+    tables["articles_title_lower_case.csv"] = title_df
 
-    # Create lowercase abstract file.
+    # Lowercase abstract table.
     abstract_df = articles_df[["PMID", "Abstract", "SourceFile"]].copy()
     abstract_df["Abstract"] = abstract_df["Abstract"].apply(clean_text)
-    abstract_df.to_csv(csv_folder / "articles_abstract_lower_case.csv", sep="~", index=False)
-    print("Created: articles_abstract_lower_case.csv")
+    tables["articles_abstract_lower_case.csv"] = abstract_df
 
-    # Create lowercase ('title'+'abstract') file. This is a newly 'engineered' feature.
+    # Lowercase ('title'+'abstract') table. This is a newly 'engineered' feature.
     combined_df = articles_df[["PMID", "Title", "Abstract", "SourceFile"]].copy()
     combined_df["Title_plus_abstract"] = (
         combined_df["Title"].fillna("") + " " + combined_df["Abstract"].fillna("")
     ).apply(clean_text)
     combined_df = combined_df[["PMID", "Title_plus_abstract"]] # SourceID left out due to RAM-limit later in process.
-    combined_df.to_csv(csv_folder / "articles_title_plus_abstract_lower_case.csv", sep="~", index=False)
-    print("Created: articles_title_plus_abstract_lower_case.csv")
+    tables["articles_title_plus_abstract_lower_case.csv"] = combined_df
 
-    # Create lowercase keyword file.
-    keywords_df["Keyword"] = keywords_df["Keyword"].apply(clean_text)
-    keywords_df.to_csv(csv_folder / "keywords_lower_case.csv", sep="~", index=False)
-    print("Created: keywords_lower_case.csv")
+    # Lowercase keyword, MeSH-term and Chemical tables.
+    tables["keywords_lower_case.csv"] = keywords_df.assign(Keyword=keywords_df["Keyword"].apply(clean_text))
+    tables["mesh_terms_lower_case.csv"] = mesh_df.assign(Descriptor=mesh_df["Descriptor"].apply(clean_text))
+    tables["chemicals_lower_case.csv"] = chemicals_df.assign(Chemical=chemicals_df["Chemical"].apply(clean_text))
+    return tables
 
-    # Create lowercase MeSH-term file.
-    mesh_df["Descriptor"] = mesh_df["Descriptor"].apply(clean_text)
-    mesh_df.to_csv(csv_folder / "mesh_terms_lower_case.csv", sep="~", index=False)
-    print("Created: mesh_terms_lower_case.csv")
+def main():
+    # Load the tables to be processed, from the SQLite store (see 'sqlite_store') or the CSVs.
+    if use_sqlite_store:
+        conn = sqlite_store.open_store(csv_folder)
+        articles_df, keywords_df, mesh_df, chemicals_df = (
+            sqlite_store.read_table(conn, name) for name in ["articles", "keywords", "mesh_terms", "chemicals"]
+        )
+        conn.close()
+    else:
+        articles_df, keywords_df, mesh_df, chemicals_df = (
+            schema.read_table(csv_folder / filename)
+            for filename in ["articles.csv", "keywords.csv", "mesh_terms.csv", "chemicals.csv"]
+        )
 
-    # Create lowercase Chemical file.
-    chemicals_df["Chemical"] = chemicals_df["Chemical"].apply(clean_text)
-    chemicals_df.to_csv(csv_folder / "chemicals_lower_case.csv", sep="~", index=False)
-    print("Created: chemicals_lower_case.csv")
+    # Create and save the lowercase files.
+    for filename, df in lower_case_tables(articles_df, keywords_df, mesh_df, chemicals_df).items():
+        schema.write_table(df, csv_folder / filename)
+        print(f"Created: {filename}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
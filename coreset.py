@@ -0,0 +1,83 @@
+# This module builds a weighted k-means coreset of the PCA output for the K-sweep of 'clustering'
+# (clustering_sample_method = "coreset"), in place of a uniform random sample. It is a lightweight coreset (Bachem,
+# Lucic and Krause, 2018): every row x is drawn with probability
+#     q(x) = 1/2 * 1/n + 1/2 * d(x, mean)^2 / sum of d(x', mean)^2 over all rows,
+# and a drawn row gets the weight 1 / (m * q(x)), for m draws (with replacement; a row that is drawn more than once
+# gets the sum of its weights). Rows far from the mean, such as the rows of a small and distinct cluster, are drawn
+# more often than in a uniform sample, and get a smaller weight. The weighted cost (inertia) of the coreset is an
+# unbiased estimate of the cost on the full data, for any set of centroids. With
+#     m >= c * (d * k * log(k) + log(1 / delta)) / epsilon^2
+# draws (d dimensions, k clusters, some constant c), with probability 1 - delta, for every set of k centroids:
+#     |weighted cost of the coreset - cost of the full data| <= epsilon/2 * cost of the full data
+#                                                               + epsilon/2 * cost of the full data around its mean.
+# So K-Means on the coreset (with the weights) finds centroids that are nearly as good on the full data as K-Means on
+# the full data. 'clustering' reports the actual error per K: the weighted cost of the coreset against the inertia on
+# the full data (see 'cluster_quality').
+# The coreset is built in two streaming passes over the PCA output, read in chunks (see 'memory_budget'):
+# 1. the number of rows, the mean, and the sum of the squared norms (which give the sum of the squared distances to
+#    the mean);
+# 2. the draws: every chunk gets its share of the remaining draws (binomial, by its share of the remaining
+#    probability), which are drawn from its rows by q(x). This gives the same distribution as m draws from all rows.
+# If there are no more rows than draws (n <= m), the second pass reads all rows instead, with weight 1: the K-sweep
+# then runs on the full data.
+
+import numpy as np                   # For the sums, the probabilities and the draws.
+
+import memory_budget                 # For reading the PCA output in chunks.
+
+# Number of copies of a chunk row in memory: the chunk and its array (with the distances and probabilities).
+chunk_copies = 2
+
+def pca_chunks(path, plan):
+    # The PCA columns of the chunks, as arrays.
+    for chunk in memory_budget.read_chunks(path, plan):
+        yield chunk[[c for c in chunk.columns if c.startswith("pca_")]].to_numpy(dtype=np.float64)
+
+def data_moments(path, plan):
+    # First pass: the number of rows, the mean, and the sum of the squared distances to the mean.
+    n, sums, sum_of_squared_norms = 0, 0.0, 0.0
+    for X in pca_chunks(path, plan):
+        n += len(X)
+        sums = sums + X.sum(axis=0)
+        sum_of_squared_norms += float((X ** 2).sum())
+    mean = sums / n
+    return n, mean, max(sum_of_squared_norms - n * float(mean @ mean), 0.0)
+
+def probabilities(X, n, mean, total_distance):
+    # The probability q(x) of every row of a chunk.
+    distances = ((X - mean) ** 2).sum(axis=1)
+    if total_distance == 0:  # All rows are equal.
+        return np.full(len(X), 1 / n)
+    return 0.5 / n + 0.5 * distances / total_distance
+
+def build(path, m, random_state):
+    # Build a coreset with m draws. Returns the rows (as an array) and their weights.
+    plan = memory_budget.make_plan("Coreset", memory_budget.bytes_per_row(path) * chunk_copies)
+    n, mean, total_distance = data_moments(path, plan)
+    if n <= m:  # All rows fit: the coreset is the full data, with weight 1.
+        rows = np.vstack(list(pca_chunks(path, plan)))
+        memory_budget.report(plan)
+        print(f"Coreset: all {n} rows (no more than the {m} draws), with weight 1.")
+        return rows, np.ones(n)
+    rng = np.random.default_rng(random_state)
+
+    # Second pass: the draws per chunk.
+    rows, weights = [], []
+    remaining_draws, remaining_probability = m, 1.0
+    for X in pca_chunks(path, plan):
+        q = probabilities(X, n, mean, total_distance)
+        chunk_probability = float(q.sum())
+        share = min(chunk_probability / remaining_probability, 1.0) if remaining_probability > 0 else 1.0
+        draws = int(rng.binomial(remaining_draws, share))
+        remaining_draws -= draws
+        remaining_probability -= chunk_probability
+        if draws:
+            drawn, counts = np.unique(rng.choice(len(X), size=draws, p=q / chunk_probability), return_counts=True)
+            rows.append(X[drawn])
+            weights.append(counts / (m * q[drawn]))
+    memory_budget.report(plan)
+
+    rows = np.vstack(rows)
+    weights = np.concatenate(weights)
+    print(f"Coreset: {m} draws from {n} rows, {len(rows)} distinct rows, total weight {weights.sum():.0f}.")
+    return rows, weights
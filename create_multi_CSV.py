@@ -4,35 +4,145 @@
 import os                             # For creating output folder.
 import xml.etree.ElementTree as ET    # For parsing XML.
 import pandas as pd                   # For working with the CSV files.
+import schema                         # For reading and writing the CSVs with the types of their schema.
 from pathlib import Path              # For file system paths.
 from tqdm import tqdm                 # Progress bar.
+import pmid_metadata                  # Row count and PMID checksum of articles.csv.
+import sqlite_store                   # Optional SQLite copy of the CSVs.
 
-from variables import destination_folder
+from variables import destination_folder, use_sqlite_store
 
 # Set input and output directories.
 destination_folder = Path(destination_folder)
 output_dir = destination_folder / "pubmed_csv_export"
-os.makedirs(output_dir, exist_ok=True)
+
+# Parse one PubMed XML file. Returns the rows for the four CSVs, the PMIDs of all records in the file and the PMIDs of
+# the deleted records.
+def parse_file(xml_file):
+    source_file = xml_file.name # Create source file data to be able to trace back data to origin.
+    tree = ET.parse(xml_file)
+    root = tree.getroot()
+
+    # Temporary storage for rows to write.
+    articles, keywords = [], []
+    mesh_terms, chemicals = [], []
+
+    # PMIDs of all records in the file (also the filtered ones) and of deleted records. Update files contain revised
+    # versions of existing records, and a list of deleted records (see 'delta_update').
+    pmids = []
+    deleted = [pmid.text for pmid in root.findall("DeleteCitation/PMID")]
+
+    for article in root.findall("PubmedArticle"):
+        medline = article.find("MedlineCitation")
+        article_data = medline.find("Article") if medline is not None else None
+        pmid = medline.find("PMID").text if medline is not None else None
+        pmids.append(pmid)
+        title = article_data.find("ArticleTitle").text if article_data is not None else None
+
+        # Filter out retracted articles.
+        is_retracted = any(
+            note.attrib.get("RefType", "") == "RetractionIn"
+            for note in medline.findall(".//CommentsCorrections")
+        )
+        if is_retracted:
+            continue
+
+        # Extract publication year.
+        journal = article_data.find("Journal") if article_data is not None else None
+        pub_date = journal.find(".//PubDate") if journal is not None else None
+        year = pub_date.find("Year").text if pub_date is not None and pub_date.find("Year") is not None else None
+
+        # Filter out non-2024/2025 years.
+        if year not in ["2024", "2025"]:
+            continue
+
+        # Filter out articles without at least an English version.
+        langs = article_data.findall("Language")
+        if not any(lang.text == "eng" for lang in langs if lang is not None):
+            continue
+
+        # Extract abstract text.
+        abstract = ""
+        if article_data is not None:
+            abstract_element = article_data.find("Abstract")
+            if abstract_element is not None:
+                abstract_texts = abstract_element.findall("AbstractText")
+                abstract = " ".join(
+                    "".join(elem.itertext()).strip()
+                    for elem in abstract_texts
+                    if elem is not None
+                )
+
+        articles.append({
+            "PMID": pmid,
+            "Title": title,
+            "Abstract": abstract,
+            "Year": year,
+            "SourceFile": source_file
+        })
+
+        for keyword in medline.findall(".//Keyword"):
+            keywords.append({
+                "PMID": pmid,
+                "Keyword": keyword.text,
+                "SourceFile": source_file
+            })
+
+        for mesh in medline.findall(".//MeshHeading"):
+            descriptor = mesh.find("DescriptorName")
+            mesh_terms.append({
+                "PMID": pmid,
+                "Descriptor": descriptor.text if descriptor is not None else None,
+                "SourceFile": source_file
+            })
+
+        for chem in medline.findall(".//Chemical"):
+            name = chem.find("NameOfSubstance")
+            chemicals.append({
+                "PMID": pmid,
+                "Chemical": name.text if name is not None else None,
+                "SourceFile": source_file
+            })
+
+    return {
+        "articles": articles,
+        "keywords": keywords,
+        "mesh_terms": mesh_terms,
+        "chemicals": chemicals,
+        "pmids": pmids,
+        "deleted": deleted
+    }
 
 def main():
+    os.makedirs(output_dir, exist_ok=True)
+
     # Track which files have already been processed.
     processed_files = set()
     articles_path = output_dir / "articles.csv"
     if articles_path.exists():
         try:
-            processed_files = set(pd.read_csv(articles_path, sep="~", usecols=["SourceFile"])["SourceFile"].unique())
+            processed_files = set(schema.read_table(articles_path, usecols=["SourceFile"])["SourceFile"].unique())
             print(f"Resuming: {len(processed_files)} files already processed.")
         except Exception as e:
             print("Could not read articles.csv to resume:", e)
+        # The metadata is created again from articles.csv, so it also includes the rows of a file that was
+        # interrupted after its rows were appended.
+        pmid_metadata.build_metadata(output_dir)
+        if use_sqlite_store and not sqlite_store.is_up_to_date(output_dir):
+            sqlite_store.build_store(output_dir)
 
     # Create empty CSVs with headers if they don't exist yet. Use '~' symbol since it is much less common than ','. This
     # in order to prevent regular commas in article titles/abstracts from being recognized as column separators.
     def write_headers(filename, columns):
         path = output_dir / filename
         if not path.exists():
-            pd.DataFrame(columns=columns).to_csv(path, sep="~", index=False)
+            schema.write_table(pd.DataFrame(columns=columns), path)
 
-    # Determine the CSVs' columns.
+    # Determine the CSVs' columns. A new articles.csv starts new metadata, also if the metadata of deleted CSVs exists,
+    # and has no superseded rows (see 'delta_update').
+    if not articles_path.exists():
+        pmid_metadata.reset_metadata(output_dir)
+        (output_dir / schema.tombstones_filename).unlink(missing_ok=True)
     write_headers("articles.csv", ["PMID", "Title", "Abstract", "Year", "SourceFile"])
     write_headers("keywords.csv", ["PMID", "Keyword", "SourceFile"])
     write_headers("mesh_terms.csv", ["PMID", "Descriptor", "SourceFile"])
@@ -41,7 +151,7 @@ def main():
     # Append a DataFrame to a CSV file. An append method was chosen because loading the full
     # dataset at once overload the RAM.
     def append(df, filename):
-        df.to_csv(output_dir / filename, mode="a", header=False, sep="~", index=False)
+        schema.write_table(df, output_dir / filename, mode="a", header=False)
 
     # The for-loop goes through all PubMed XML files and extracts the relevant data.
     # For each file, the script parses its contents and filters out retracted articles and
@@ -50,94 +160,29 @@ def main():
     # The extracted data is
     # temporarily stored and appended (due to RAM-overload).
 
+    # If the SQLite store is used, the rows are also inserted into the store (one bulk insert per table and file).
+    store = sqlite_store.connect(output_dir) if use_sqlite_store else None
+
     xml_files = sorted(destination_folder.glob("*.xml"))
     for xml_file in tqdm(xml_files, desc="Processing XML files", unit="file"):
         if xml_file.name in processed_files:
             continue
 
-        source_file = xml_file.name # Create source file data to be able to trace back data to origin.
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        # Temporary storage for rows to write.
-        articles, keywords = [], []
-        mesh_terms, chemicals = [], []
-
-        for article in root.findall("PubmedArticle"):
-            medline = article.find("MedlineCitation")
-            article_data = medline.find("Article") if medline is not None else None
-            pmid = medline.find("PMID").text if medline is not None else None
-            title = article_data.find("ArticleTitle").text if article_data is not None else None
-
-            # Filter out retracted articles.
-            is_retracted = any(
-                note.attrib.get("RefType", "") == "RetractionIn"
-                for note in medline.findall(".//CommentsCorrections")
-            )
-            if is_retracted:
-                continue
-
-            # Extract publication year.
-            journal = article_data.find("Journal") if article_data is not None else None
-            pub_date = journal.find(".//PubDate") if journal is not None else None
-            year = pub_date.find("Year").text if pub_date is not None and pub_date.find("Year") is not None else None
-
-            # Filter out non-2024/2025 years.
-            if year not in ["2024", "2025"]:
-                continue
-
-            # Filter out articles without at least an English version.
-            langs = article_data.findall("Language")
-            if not any(lang.text == "eng" for lang in langs if lang is not None):
-                continue
-
-            # Extract abstract text.
-            abstract = ""
-            if article_data is not None:
-                abstract_element = article_data.find("Abstract")
-                if abstract_element is not None:
-                    abstract_texts = abstract_element.findall("AbstractText")
-                    abstract = " ".join(
-                        "".join(elem.itertext()).strip()
-                        for elem in abstract_texts
-                        if elem is not None
-                    )
-
-            articles.append({
-                "PMID": pmid,
-                "Title": title,
-                "Abstract": abstract,
-                "Year": year,
-                "SourceFile": source_file
-            })
-
-            for keyword in medline.findall(".//Keyword"):
-                keywords.append({
-                    "PMID": pmid,
-                    "Keyword": keyword.text,
-                    "SourceFile": source_file
-                })
-
-            for mesh in medline.findall(".//MeshHeading"):
-                descriptor = mesh.find("DescriptorName")
-                mesh_terms.append({
-                    "PMID": pmid,
-                    "Descriptor": descriptor.text if descriptor is not None else None,
-                    "SourceFile": source_file
-                })
-
-            for chem in medline.findall(".//Chemical"):
-                name = chem.find("NameOfSubstance")
-                chemicals.append({
-                    "PMID": pmid,
-                    "Chemical": name.text if name is not None else None,
-                    "SourceFile": source_file
-                })
+        rows = parse_file(xml_file)
+        articles = rows["articles"]
 
         append(pd.DataFrame(articles), "articles.csv")
-        append(pd.DataFrame(keywords), "keywords.csv")
-        append(pd.DataFrame(mesh_terms), "mesh_terms.csv")
-        append(pd.DataFrame(chemicals), "chemicals.csv")
+        append(pd.DataFrame(rows["keywords"]), "keywords.csv")
+        append(pd.DataFrame(rows["mesh_terms"]), "mesh_terms.csv")
+        append(pd.DataFrame(rows["chemicals"]), "chemicals.csv")
+        pmid_metadata.add_pmids(output_dir, [row["PMID"] for row in articles])
+        if store:
+            for name in ["articles", "keywords", "mesh_terms", "chemicals"]:
+                sqlite_store.insert_rows(store, name, rows[name])
+
+    if store:
+        sqlite_store.create_indexes(store)
+        sqlite_store.close(store)
 
     # Print statement that multi-CSV setup is complete.
     print("\nMulti-CSV setup complete.")
@@ -2,93 +2,103 @@
 # number of columns per CSV, the PubMedID format and uniqueness, and whether the parent
 # and child tables are have relations (every child has a parent). It is also checks if every
 # article is from 2024/2025.
+# If the SQLite store is used (see 'sqlite_store'), the checks are queries on the store instead.
 
-import pandas as pd             # For reading and inspecting CSV files.
+import schema                   # For reading the CSV files (and checking their columns).
 from pathlib import Path        # For working with file paths.
-from tqdm import tqdm           # Progress bar.
+import sqlite_store             # For the checks on the SQLite store.
 
-from variables import destination_folder, csv_folder
+from variables import destination_folder, csv_folder, use_sqlite_store
 
 destination_folder = Path(destination_folder)
 csv_folder = Path(csv_folder)
 
-def main():
-    # Check number of columns in articles.csv.
-    articles_df = pd.read_csv(csv_folder / "articles.csv", sep="~")
-    if articles_df.shape[1] == 5:
-        print("Column count for articles.csv is correct (5)")
-    else:
-        print(f"Incorrect column count in articles.csv: found {articles_df.shape[1]}, expected 5")
+# Expected number of columns per CSV, and the child tables (every child must have a parent in articles.csv).
+expected_columns = {"articles.csv": 5, "chemicals.csv": 3, "keywords.csv": 3, "mesh_terms.csv": 3}
+child_tables = ["chemicals.csv", "keywords.csv", "mesh_terms.csv"]
 
-    # Check number of columns in chemicals.csv.
-    chemicals_df = pd.read_csv(csv_folder / "chemicals.csv", sep="~")
-    if chemicals_df.shape[1] == 3:
-        print("Column count for chemicals.csv is correct (3)")
-    else:
-        print(f"Incorrect column count in chemicals.csv: found {chemicals_df.shape[1]}, expected 3")
+# Calculate the check results from the CSV files.
+def check_csv():
+    results = {"columns": {}, "unmatched": {}}
+    # All values are read as text, so values that do not fit the schema (e.g. a PMID that is not a number) are counted.
+    tables = {filename: schema.read_table(csv_folder / filename, dtype=str) for filename in expected_columns}
+    for filename, df in tables.items():
+        results["columns"][filename] = df.shape[1]
+    articles_df = tables["articles.csv"]
 
-    # Check number of columns in keywords.csv.
-    keywords_df = pd.read_csv(csv_folder / "keywords.csv", sep="~")
-    if keywords_df.shape[1] == 3:
-        print("Column count for keywords.csv is correct (3)")
-    else:
-        print(f"Incorrect column count in keywords.csv: found {keywords_df.shape[1]}, expected 3")
+    # PMID format and duplicates.
+    results["non_numeric"] = int((~articles_df["PMID"].str.isdigit()).sum())
+    results["duplicates"] = int(articles_df["PMID"].duplicated().sum())
 
-    # Check number of columns in mesh_terms.csv.
-    mesh_df = pd.read_csv(csv_folder / "mesh_terms.csv", sep="~")
-    if mesh_df.shape[1] == 3:
-        print("Column count for mesh_terms.csv is correct (3)")
-    else:
-        print(f"Incorrect column count in mesh_terms.csv: found {mesh_df.shape[1]}, expected 3")
+    # PMIDs of the child tables that are not in articles.csv.
+    pmids_in_articles = set(articles_df["PMID"])
+    for filename in child_tables:
+        results["unmatched"][filename] = len(set(tables[filename]["PMID"]) - pmids_in_articles)
+
+    # Years other than 2024 or 2025.
+    results["invalid_years"] = int((~articles_df["Year"].isin(["2024", "2025"])).sum())
+    return results
+
+# Calculate the check results with queries on the SQLite store. The orphan check uses the PMID index of articles.
+def check_store():
+    conn = sqlite_store.open_store(csv_folder)
+
+    def query(sql):
+        return conn.execute(sql).fetchone()[0]
+
+    results = {"columns": {}, "unmatched": {}}
+    for filename in expected_columns:
+        results["columns"][filename] = len(conn.execute(f"PRAGMA table_info({filename[:-4]})").fetchall())
+
+    results["non_numeric"] = query("SELECT COUNT(*) FROM articles WHERE typeof(PMID) != 'integer'")
+    results["duplicates"] = query(
+        "SELECT COALESCE(SUM(n - 1), 0) FROM (SELECT COUNT(*) AS n FROM articles GROUP BY PMID)"
+    )
+    for filename in child_tables:
+        results["unmatched"][filename] = query(
+            f"SELECT COUNT(DISTINCT PMID) FROM {filename[:-4]} AS child "
+            f"WHERE NOT EXISTS (SELECT 1 FROM articles WHERE articles.PMID = child.PMID)"
+        )
+    results["invalid_years"] = query("SELECT COUNT(*) FROM articles WHERE Year IS NULL OR Year NOT IN (2024, 2025)")
+    conn.close()
+    return results
+
+def main():
+    results = check_store() if use_sqlite_store else check_csv()
+
+    # Check number of columns per CSV.
+    for filename, expected in expected_columns.items():
+        found = results["columns"][filename]
+        if found == expected:
+            print(f"Column count for {filename} is correct ({expected})")
+        else:
+            print(f"Incorrect column count in {filename}: found {found}, expected {expected}")
 
     # Check that all PMIDs are numeric.
-    non_numeric_pmids = articles_df[~articles_df["PMID"].astype(str).str.isdigit()]
-    if non_numeric_pmids.empty:
+    if results["non_numeric"] == 0:
         print("All PMIDs in articles.csv are numeric")
     else:
-        print(f"\n{len(non_numeric_pmids)} invalid PMIDs (non-numeric) found in articles.csv")
+        print(f"\n{results['non_numeric']} invalid PMIDs (non-numeric) found in articles.csv")
 
     # Check for PMID duplicates.
-    duplicates = articles_df["PMID"].astype(str).duplicated().sum()
-    if duplicates:
-        print(f"{duplicates} duplicate PMIDs found in articles.csv")
+    if results["duplicates"]:
+        print(f"{results['duplicates']} duplicate PMIDs found in articles.csv")
     else:
         print("No duplicate PMIDs found in articles.csv")
 
-    # Check that all PMIDs in chemicals.csv exist in articles.csv, so every child has a parent.
-    pmids_in_articles = set(articles_df["PMID"].astype(str))
-    chemicals_df = pd.read_csv(csv_folder / "chemicals.csv", sep="~")
-    chemicals_pmids = set(chemicals_df["PMID"].astype(str))
-    unmatched_chemicals = chemicals_pmids - pmids_in_articles
-    if unmatched_chemicals:
-        print(f"{len(unmatched_chemicals)} PMIDs in chemicals.csv are not found in articles.csv")
-    else:
-        print("All PMIDs in chemicals.csv are matched in articles.csv")
-
-    # Check that all PMIDs in keywords.csv exist in articles.csv, so every child has a parent.
-    keywords_df = pd.read_csv(csv_folder / "keywords.csv", sep="~")
-    keywords_pmids = set(keywords_df["PMID"].astype(str))
-    unmatched_keywords = keywords_pmids - pmids_in_articles
-    if unmatched_keywords:
-        print(f"{len(unmatched_keywords)} PMIDs in keywords.csv are not found in articles.csv")
-    else:
-        print("All PMIDs in keywords.csv are matched in articles.csv")
-
-    # Check that all PMIDs in mesh_terms.csv exist in articles.csv, so every child has a parent.
-    mesh_df = pd.read_csv(csv_folder / "mesh_terms.csv", sep="~")
-    mesh_pmids = set(mesh_df["PMID"].astype(str))
-    unmatched_mesh = mesh_pmids - pmids_in_articles
-    if unmatched_mesh:
-        print(f"{len(unmatched_mesh)} PMIDs in mesh_terms.csv are not found in articles.csv")
-    else:
-        print("All PMIDs in mesh_terms.csv are matched in articles.csv")
+    # Check that all PMIDs in the child tables exist in articles.csv, so every child has a parent.
+    for filename in child_tables:
+        unmatched = results["unmatched"][filename]
+        if unmatched:
+            print(f"{unmatched} PMIDs in {filename} are not found in articles.csv")
+        else:
+            print(f"All PMIDs in {filename} are matched in articles.csv")
 
     # Check that all Year values are 2024 or 2025.
-    invalid_years = articles_df[~articles_df["Year"].astype(str).isin(["2024", "2025"])]
-    if invalid_years.empty:
+    if results["invalid_years"] == 0:
         print("All articles are 2024 or 2025 publications")
     else:
-        print(f"{len(invalid_years)} articles are not from 2024 or 2025")
+        print(f"{results['invalid_years']} articles are not from 2024 or 2025")
 
     print("\nData check complete.")
 if __name__ == "__main__":
@@ -0,0 +1,411 @@
+# This module is the daily refresh of the pipeline (delta mode). Next to the yearly baseline, PubMed publishes daily
+# update files. An update file contains new records, revised versions of records that already exist, and a list of
+# deleted records (DeleteCitation). This module:
+# 1. Downloads and verifies the update files as determined in the variables file (same steps as 'retrieve_data' and
+#    'check_hashes_gz_files', in the folder 'updatefiles' of the destination folder);
+# 2. Parses the update files that were not processed yet, in order, so the latest version of a record wins;
+# 3. Creates the rows of the changed articles only, for every output of the pipeline: the multi-CSV setup, the
+#    lower-case files, the multi-hot and TF-IDF features (saved vocabularies and vectorizers), the combined features,
+#    the PCA projection and the cluster labels (saved scaler, PCA basis and centroids, see 'assign');
+# 4. Finds the changed articles that are already in articles.csv in the PMID index (pmid_index.sqlite, an indexed
+#    SQLite table of the PMIDs of articles.csv), and saves them in the tombstones (tombstones.csv) with the source file
+#    of their new version and the feature files without a row of it, or without a source file if they have been
+#    deleted or no longer pass the filters of 'create_multi_CSV' (e.g. retracted);
+# 5. Appends the new rows to the outputs. The old rows of the revised and deleted articles stay in the files, and are
+#    left out when the files are read (see 'schema'), so the outputs are only appended to.
+# The cost of an update depends on its size, not on the size of the corpus: only the changed articles are parsed,
+# featurized, projected and labeled, and looked up in the PMID index. The PMID index is only built again (one read of
+# the PMID column of articles.csv) if another module has changed articles.csv (its metadata differs, see
+# 'pmid_metadata').
+# The superseded rows are removed from the files (compaction) when the tombstones exceed 'delta_compact_share' of the
+# articles, or with 'python delta_update.py compact'. This rewrites all outputs, without parsing them.
+# If 'use_sqlite_store' is set, the rows of the changed articles are replaced in the SQLite store (see 'sqlite_store').
+# The processed update files are recorded in update_files.json, so running this module again only processes new files.
+# Before the first output is changed, the update is recorded in update_pending.json: its update files, the changed
+# articles that were in articles.csv, the size of every output file and the metadata of articles.csv after the update.
+# If a run is interrupted, the next run processes the same update files again: it cuts the output files back to their
+# recorded size before it appends the new rows, so no rows are left behind or duplicated.
+# The models are not refitted. Run the full pipeline again (see 'pipeline') to refit them on the updated data.
+#
+# Usage:
+#   python delta_update.py                    Process the new update files.
+#   python delta_update.py compact            Remove the superseded rows from the files.
+
+import argparse                                              # For the command line options.
+import json                                                  # For the list of processed update files.
+import os                                                    # For replacing and cutting files.
+import sqlite3                                               # For the PMID index.
+import time                                                  # For the duration of the update.
+import numpy as np                                           # For empty values in the TF-IDF rows.
+import pandas as pd                                          # For creating and appending the rows.
+from pathlib import Path                                     # For handling file paths.
+import joblib                                                # For loading the saved models.
+
+import pmid_metadata                                         # Row count and PMID checksum of articles.csv.
+import schema                                                # For the types of the rows, and the tombstones.
+import sqlite_store                                          # For updating the SQLite store.
+from variables import (
+    destination_folder,
+    csv_folder,
+    use_sqlite_store,
+    update_base_url,
+    update_first_file,
+    update_last_file,
+    delta_compact_share
+)
+
+from retrieve_data import download_files                     # Same download steps as for the baseline.
+from check_hashes_gz_files import check_folder               # Same hash verification as for the baseline.
+from create_multi_CSV import parse_file                      # Same parsing and filters as for the baseline.
+from convert_to_lower_case import lower_case_tables          # Same text cleaning as the full pipeline.
+from combine_transformed_data import combine_features        # Same feature merge as the full pipeline.
+from assign import feature_tables, assign_clusters           # Same features, projection and labels as 'assign'.
+
+# Set directories.
+update_folder = Path(destination_folder) / "updatefiles"
+csv_folder = Path(csv_folder)
+models_folder = csv_folder / "models"
+ledger_path = csv_folder / "update_files.json"
+pending_path = csv_folder / "update_pending.json"
+index_path = csv_folder / "pmid_index.sqlite"
+index_chunk_size = 1000000           # Number of PMIDs that are read at once when the PMID index is built.
+index_batch_size = 500               # Number of PMIDs per lookup in the PMID index.
+
+# The columns of the multi-CSV setup (see 'create_multi_CSV').
+raw_columns = {
+    "articles": ["PMID", "Title", "Abstract", "Year", "SourceFile"],
+    "keywords": ["PMID", "Keyword", "SourceFile"],
+    "mesh_terms": ["PMID", "Descriptor", "SourceFile"],
+    "chemicals": ["PMID", "Chemical", "SourceFile"]
+}
+
+# The update files that have already been processed.
+def read_ledger():
+    if not ledger_path.exists():
+        return []
+    with open(ledger_path, "r") as f:
+        return json.load(f)
+
+def write_ledger(processed_files):
+    write_json(ledger_path, processed_files)
+
+# The update that was started but not finished, or None.
+def read_pending():
+    if not pending_path.exists():
+        return None
+    with open(pending_path, "r") as f:
+        return json.load(f)
+
+# Write a JSON file through a temporary file, so an interruption cannot leave a broken file.
+def write_json(path, data):
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+# Parse the update files in order. Returns the rows of the latest version of every changed article (an article that is
+# revised in a later file only keeps the rows of that file), and the PMIDs of all changed (new, revised or deleted)
+# articles.
+def collect_changes(xml_files):
+    changes = {name: [] for name in raw_columns}
+    changed = set()
+    for xml_file in xml_files:
+        rows = parse_file(xml_file)
+        file_changed = set(rows["pmids"]) | set(rows["deleted"])
+        for name in changes:
+            changes[name] = [row for row in changes[name] if row["PMID"] not in file_changed] + rows[name]
+        changed |= file_changed
+        print(f"Parsed: {xml_file.name} ({len(rows['pmids'])} records, {len(rows['deleted'])} deleted)")
+    return {name: pd.DataFrame(rows, columns=raw_columns[name]) for name, rows in changes.items()}, changed
+
+# Create the rows of the given articles for all outputs of the pipeline (same steps as the modules that create them).
+def derived_tables(articles, keywords, mesh_terms, chemicals):
+    tables = {}
+
+    # Lower-case files (see 'convert_to_lower_case').
+    tables.update(lower_case_tables(articles, keywords, mesh_terms, chemicals))
+    title_plus_abstract = tables["articles_title_plus_abstract_lower_case.csv"]["Title_plus_abstract"]
+
+    # Multi-hot and TF-IDF features (see 'transform_categorical_to_binary' and 'perform_tf_idf_on_title_and_abstract').
+    features = feature_tables(articles, keywords, mesh_terms, chemicals)
+    for name, table in zip(
+        ["keywords_transformed.csv", "mesh_terms_transformed.csv", "chemicals_transformed.csv", "tfidf_title.csv",
+         "tfidf_abstract.csv"],
+        features
+    ):
+        tables[name] = table
+
+    # The TF-IDF files of the pipeline are saved from sparse tables, so zeros are saved as empty values. The new rows
+    # are saved the same way.
+    for name in ["tfidf_title.csv", "tfidf_abstract.csv"]:
+        tables[name] = tables[name].replace(0, np.nan)
+
+    # TF-IDF for profiling (see 'perform_tf_idf_on_title_plus_abstract'). The vectorizer is only saved since the delta
+    # mode exists, so older runs of the pipeline do not have it.
+    vectorizer_path = models_folder / "tfidf_title_plus_abstract.joblib"
+    if vectorizer_path.exists():
+        vectorizer = joblib.load(vectorizer_path)
+        text_features = pd.DataFrame.sparse.from_spmatrix(
+            vectorizer.transform(title_plus_abstract),
+            columns=[f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()]
+        )
+        text_features.insert(0, "PMID", articles["PMID"].values)
+        tables["tfidf_title_plus_abstract.csv"] = text_features
+    else:
+        # Every changed article gets a row, also without values, so the row of its old version is superseded.
+        print("No tfidf_title_plus_abstract.joblib found (run perform_tf_idf_on_title_plus_abstract first). "
+              "Updated articles get empty values in tfidf_title_plus_abstract.csv.")
+        columns = schema.read_table(csv_folder / "tfidf_title_plus_abstract.csv", nrows=0).columns
+        empty = pd.DataFrame({"PMID": articles["PMID"].values})
+        tables["tfidf_title_plus_abstract.csv"] = empty.reindex(columns=columns)
+
+    # Combined features, PCA projection and cluster labels (see 'combine_transformed_data', 'perform_PCA' and
+    # 'clustering').
+    combined = combine_features(articles[["PMID", "SourceFile"]], features)
+    labeled = assign_clusters(combined, joblib.load(models_folder / "cluster_model.joblib"))
+    tables["data_combined_before_PCA.csv"] = combined
+    tables["data_after_pca.csv"] = labeled.drop(columns="Cluster")
+    tables["data_with_clusters.csv"] = labeled
+    return tables
+
+# The PMID index: the PMIDs of articles.csv in an indexed SQLite table, with the metadata of articles.csv they are of.
+def connect_index():
+    conn = sqlite3.connect(index_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS pmids (PMID INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (rows INTEGER, pmid_checksum TEXT)")
+    return conn
+
+def index_metadata(conn):
+    stored = conn.execute("SELECT rows, pmid_checksum FROM metadata").fetchone()
+    return None if stored is None else {"rows": stored[0], "pmid_checksum": int(stored[1])}
+
+# Open the PMID index of articles.csv with the given metadata. It is built again from articles.csv if it has other
+# metadata (another module has changed articles.csv).
+def open_index(metadata):
+    conn = connect_index()
+    if index_metadata(conn) != metadata:
+        print("Building the PMID index from articles.csv.")
+        with conn:
+            conn.execute("DELETE FROM pmids")
+            for chunk in schema.read_table(csv_folder / "articles.csv", usecols=["PMID"], chunksize=index_chunk_size):
+                conn.executemany("INSERT OR IGNORE INTO pmids VALUES (?)", ((int(pmid),) for pmid in chunk["PMID"]))
+            write_index_metadata(conn, metadata)
+    return conn
+
+def write_index_metadata(conn, metadata):
+    conn.execute("DELETE FROM metadata")
+    conn.execute("INSERT INTO metadata VALUES (?, ?)", (metadata["rows"], str(metadata["pmid_checksum"])))
+
+# The given PMIDs that are in the PMID index.
+def indexed_pmids(conn, pmids):
+    pmids, found = sorted(pmids), set()
+    for start in range(0, len(pmids), index_batch_size):
+        batch = pmids[start:start + index_batch_size]
+        query = f"SELECT PMID FROM pmids WHERE PMID IN ({', '.join('?' * len(batch))})"
+        found |= {row[0] for row in conn.execute(query, batch)}
+    return found
+
+# Remove the removed PMIDs from the index, and add the added ones, with the metadata after the update (in one
+# transaction). An index that is neither of articles.csv before nor after the update is left as it is: it is built
+# again by the next update.
+def update_index(removed, added, before, after):
+    conn = connect_index()
+    if index_metadata(conn) not in (before, after):
+        conn.close()
+        return
+    with conn:
+        conn.executemany("DELETE FROM pmids WHERE PMID = ?", ((pmid,) for pmid in removed))
+        conn.executemany("INSERT OR IGNORE INTO pmids VALUES (?)", ((pmid,) for pmid in added))
+        write_index_metadata(conn, after)
+    conn.close()
+
+# The tombstones after the update. A changed article that has rows in the outputs (it is in articles.csv, or already in
+# the tombstones) gets the source file of its new version, or none if it has been deleted, and the files without a
+# SourceFile column that get no row of its new version.
+def updated_tombstones(changed, removed, articles, tables):
+    tombstones = schema.read_tombstones(csv_folder)
+    tombstones = {} if tombstones is None else {
+        pmid: (source_file, " ".join(sorted(missing_from)))
+        for pmid, source_file, missing_from in tombstones.itertuples()
+    }
+    latest = dict(zip(articles["PMID"].astype("int64"), articles["SourceFile"]))
+    with_rows = {
+        filename: set(tables[filename]["PMID"].astype("int64")) if filename in tables else set()
+        for filename in schema.article_tables if "SourceFile" not in schema.table_schema(filename)
+    }
+    for pmid in changed:
+        if pmid in removed or pmid in tombstones:
+            missing_from = [filename for filename, pmids in with_rows.items() if pmid not in pmids]
+            tombstones[pmid] = (latest.get(pmid), " ".join(missing_from) if pmid in latest else None)
+    return pd.DataFrame(
+        [(pmid, source_file, missing_from) for pmid, (source_file, missing_from) in tombstones.items()],
+        columns=["PMID", "SourceFile", "MissingFrom"]
+    )
+
+def write_tombstones(tombstones):
+    if tombstones.empty:
+        return
+    path = csv_folder / schema.tombstones_filename
+    temp_path = path.with_name(path.name + ".tmp")
+    schema.write_table(tombstones, temp_path, name=path.name)
+    os.replace(temp_path, path)
+
+# The rows of an open CSV file (after its header), without parsing them: the lines of every row. A row can span several
+# lines if a quoted text contains a line break; a row is complete when it contains an even number of quotes (quotes
+# inside a quoted text are doubled).
+def raw_rows(source):
+    lines, quotes = [], 0
+    for line in source:
+        lines.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield lines
+            lines, quotes = [], 0
+
+# Remove the given rows (0 is the first row after the header) from a CSV file, without parsing it.
+def remove_rows(path, rows):
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(path, "rb") as source, open(temp_path, "wb") as target:
+        target.write(source.readline())
+        for number, lines in enumerate(raw_rows(source)):
+            if number not in rows:
+                target.writelines(lines)
+    os.replace(temp_path, path)
+
+# Append rows to a CSV file, in the column order and with the types (see 'schema') of the existing file.
+def append_rows(df, path):
+    columns = schema.read_table(path, nrows=0).columns
+    schema.write_table(df[columns], path, header=False, mode="a")
+
+# Remove the superseded rows from all outputs, then the tombstones. An interrupted compaction can be run again: the
+# tombstones still apply to the files that have already been compacted, and leave out nothing there.
+def compact():
+    start = time.perf_counter()
+    tombstones = schema.read_tombstones(csv_folder)
+    if tombstones is None:
+        print("No superseded rows to remove.")
+        return
+    removed_rows = 0
+    for filename in schema.article_tables:
+        path = csv_folder / filename
+        if path.exists():
+            rows = set(schema.superseded_rows(path, filename, tombstones).tolist())
+            if rows:
+                remove_rows(path, rows)
+                removed_rows += len(rows)
+    (csv_folder / schema.tombstones_filename).unlink()
+    print(f"Compacted the outputs: removed {removed_rows} superseded rows of {len(tombstones)} articles "
+          f"({time.perf_counter() - start:.1f} s).")
+
+def update():
+    start = time.perf_counter()
+
+    # Download and verify the update files.
+    missing_files = download_files(update_base_url, update_folder, update_first_file, update_last_file)
+    if missing_files:
+        raise RuntimeError("Not all update files were downloaded or extracted correctly.")
+    problem_files = check_folder(update_folder)
+    if problem_files:
+        raise RuntimeError(f"Some update files did not pass hash verification: {', '.join(problem_files)}")
+
+    # Find the update files that have not been processed yet. An interrupted update is finished first, with the same
+    # update files.
+    processed_files = read_ledger()
+    pending = read_pending()
+    if pending and all(name in processed_files for name in pending["files"]):
+        pending_path.unlink()  # Interrupted after the ledger was written: nothing left to do.
+        pending = None
+    if pending:
+        print(f"Finishing the interrupted update of {len(pending['files'])} update files.")
+        xml_files = [update_folder / name for name in pending["files"]]
+    else:
+        xml_files = [path for path in sorted(update_folder.glob("*.xml")) if path.name not in processed_files]
+    if not xml_files:
+        print("No new update files to process.")
+        return
+
+    # Parse the update files and create the new rows of all outputs. Nothing is written before all rows exist.
+    changes, changed = collect_changes(xml_files)
+    changed = {int(pmid) for pmid in changed if pmid is not None}
+    articles = changes["articles"]
+    tables = {f"{name}.csv": table for name, table in changes.items()}
+    if not articles.empty:
+        tables.update(derived_tables(articles, changes["keywords"], changes["mesh_terms"], changes["chemicals"]))
+    added = articles["PMID"].astype("int64").tolist()
+
+    # Record the update before the first output is changed: the changed articles that are in articles.csv (from the
+    # PMID index), the size of every output and the metadata of articles.csv after the update.
+    resumed = pending is not None
+    if not resumed:
+        metadata = pmid_metadata.read_metadata(csv_folder) or pmid_metadata.build_metadata(csv_folder)
+        conn = open_index(metadata)
+        removed = indexed_pmids(conn, changed)
+        conn.close()
+        pending = {
+            "files": [path.name for path in xml_files],
+            "removed": sorted(removed),
+            "sizes": {filename: (csv_folder / filename).stat().st_size for filename in schema.article_tables},
+            "metadata_before": metadata,
+            "metadata": {
+                "rows": metadata["rows"] - len(removed) + len(added),
+                "pmid_checksum": (
+                    metadata["pmid_checksum"] - pmid_metadata.pmid_checksum(sorted(removed))
+                    + pmid_metadata.pmid_checksum(added)
+                ) % 2 ** 64
+            },
+            "store_up_to_date": use_sqlite_store and sqlite_store.is_up_to_date(csv_folder)
+        }
+        write_json(pending_path, pending)
+    removed = set(pending["removed"])
+
+    # Save the tombstones, and append the new rows. The rows that an interrupted update has appended are cut off first.
+    write_tombstones(updated_tombstones(changed, removed, articles, tables))
+    for filename in schema.article_tables:
+        path = csv_folder / filename
+        if resumed:
+            os.truncate(path, pending["sizes"][filename])
+        table = tables.get(filename)
+        if table is not None and not table.empty:
+            append_rows(table, path)
+    pmid_metadata.write_metadata(csv_folder, pending["metadata"]["rows"], pending["metadata"]["pmid_checksum"])
+    update_index(removed, added, pending["metadata_before"], pending["metadata"])
+
+    # Same changes in the SQLite store (all rows of the changed PMIDs are replaced). A store that was not up to date
+    # before the update, or of an interrupted update, is rebuilt.
+    if pending["store_up_to_date"] and not resumed:
+        conn = sqlite_store.connect(csv_folder)
+        sqlite_store.remove_pmids(conn, sorted(changed))
+        for name, table in changes.items():
+            sqlite_store.insert_rows(conn, name, table)
+        sqlite_store.close(conn)
+    elif use_sqlite_store:
+        sqlite_store.build_store(csv_folder)
+    write_ledger(processed_files + [path.name for path in xml_files])
+    pending_path.unlink()
+
+    # Print statements.
+    new_pmids = set(added)
+    print(f"\nProcessed {len(xml_files)} update files in {time.perf_counter() - start:.1f} s.")
+    print(f"New articles: {len(new_pmids - removed)}")
+    print(f"Revised articles: {len(new_pmids & removed)}")
+    print(f"Removed articles (deleted or no longer passing the filters): {len(removed - new_pmids)}")
+    if "data_with_clusters.csv" in tables:
+        print("Clusters of the new and revised articles:")
+        print(tables["data_with_clusters.csv"]["Cluster"].value_counts().sort_index().to_string())
+
+    # Compact the outputs when the superseded rows have become too many.
+    tombstones = schema.read_tombstones(csv_folder)
+    if tombstones is not None and len(tombstones) > delta_compact_share * pending["metadata"]["rows"]:
+        compact()
+
+def main():
+    parser = argparse.ArgumentParser(description="Process the daily PubMed update files.")
+    parser.add_argument("command", nargs="?", choices=["update", "compact"], default="update")
+    args = parser.parse_args()
+    if args.command == "compact":
+        compact()
+    else:
+        update()
+
+if __name__ == "__main__":
+    main()
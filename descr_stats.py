@@ -1,58 +1,84 @@
 # Generate statistics for the casestudy document. The output of this module is not used further in this pipeline.
+# If the SQLite store is used (see 'sqlite_store'), the statistics are calculated in SQL instead.
 
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
-from variables import csv_folder
+import schema
+import sqlite_store
+from variables import csv_folder, use_sqlite_store
 
 # Set paths
 csv_folder = Path(csv_folder)
 
-def main():
-    # Load data
-    articles = pd.read_csv(csv_folder / "articles.csv", sep="~")
-    keywords = pd.read_csv(csv_folder / "keywords.csv", sep="~")
-    mesh_terms = pd.read_csv(csv_folder / "mesh_terms.csv", sep="~")
-    chemicals = pd.read_csv(csv_folder / "chemicals.csv", sep="~")
+# The term tables and their term columns.
+term_tables = {"Keywords": ("keywords", "Keyword"), "MeSH Terms": ("mesh_terms", "Descriptor"),
+               "Chemicals": ("chemicals", "Chemical")}
+
+# Calculate the statistics from the CSV files.
+def stats_csv():
+    articles = schema.read_table(csv_folder / "articles.csv")
+    stats = {"terms": {}}
+    for label, (name, column) in term_tables.items():
+        df = schema.read_table(csv_folder / f"{name}.csv")
+        stats["terms"][label] = {
+            "unique": df[column].nunique(),
+            "per_article": df.groupby("PMID").size().mean(),
+            "top_10": schema.value_counts(df[column]).head(10)
+        }
+    stats["missing_pmids"] = articles["PMID"].isna().sum()
+    stats["articles_per_year"] = schema.value_counts(articles["Year"]).sort_index()
+    return stats
 
-    # Keyword stats
-    unique_keywords = keywords["Keyword"].nunique()
-    avg_keywords_per_article = keywords.groupby("PMID").size().mean()
+# Calculate the statistics in SQL. The counts are returned in the same form as pandas' value_counts (ties in order of
+# first appearance).
+def stats_store():
+    conn = sqlite_store.open_store(csv_folder)
 
-    # MeSH term stats
-    unique_mesh = mesh_terms["Descriptor"].nunique()
-    avg_mesh_per_article = mesh_terms.groupby("PMID").size().mean()
+    def value_counts(sql, index_name):
+        rows = conn.execute(sql).fetchall()
+        return pd.Series([row[1] for row in rows], index=pd.Index([row[0] for row in rows], name=index_name),
+                         name="count", dtype="int64")
 
-    # Chemical stats
-    unique_chem = chemicals["Chemical"].nunique()
-    avg_chem_per_article = chemicals.groupby("PMID").size().mean()
+    stats = {"terms": {}}
+    for label, (name, column) in term_tables.items():
+        stats["terms"][label] = {
+            "unique": conn.execute(f"SELECT COUNT(DISTINCT {column}) FROM {name}").fetchone()[0],
+            "per_article": conn.execute(
+                f"SELECT AVG(n) FROM (SELECT COUNT(*) AS n FROM {name} WHERE PMID IS NOT NULL GROUP BY PMID)"
+            ).fetchone()[0],
+            "top_10": value_counts(
+                f"SELECT {column}, COUNT(*) AS n FROM {name} WHERE {column} IS NOT NULL GROUP BY {column} "
+                f"ORDER BY n DESC, MIN(rowid) LIMIT 10", column
+            )
+        }
+    stats["missing_pmids"] = conn.execute("SELECT COUNT(*) FROM articles WHERE PMID IS NULL").fetchone()[0]
+    stats["articles_per_year"] = value_counts(
+        "SELECT Year, COUNT(*) FROM articles WHERE Year IS NOT NULL GROUP BY Year ORDER BY Year", "Year"
+    )
+    conn.close()
+    return stats
 
-    # Additional stats
-    missing_pmids = articles["PMID"].isna().sum()
+def main():
+    stats = stats_store() if use_sqlite_store else stats_csv()
+    keywords, mesh, chemicals = (stats["terms"][label] for label in term_tables)
 
     # Print stats
     print("\n--- PubMed Summary Statistics ---")
-    print(f"Unique Keywords: {unique_keywords}")
-    print(f"Average Keywords per Article: {avg_keywords_per_article:.2f}")
-    print(f"Unique MeSH Terms: {unique_mesh}")
-    print(f"Average MeSH Terms per Article: {avg_mesh_per_article:.2f}")
-    print(f"Unique Chemicals: {unique_chem}")
-    print(f"Average Chemicals per Article: {avg_chem_per_article:.2f}")
-    print(f"Articles without PMID: {missing_pmids}")
+    print(f"Unique Keywords: {keywords['unique']}")
+    print(f"Average Keywords per Article: {keywords['per_article']:.2f}")
+    print(f"Unique MeSH Terms: {mesh['unique']}")
+    print(f"Average MeSH Terms per Article: {mesh['per_article']:.2f}")
+    print(f"Unique Chemicals: {chemicals['unique']}")
+    print(f"Average Chemicals per Article: {chemicals['per_article']:.2f}")
+    print(f"Articles without PMID: {stats['missing_pmids']}")
 
     # Articles per year.
     print("\nArticles per Year:")
-    articles_per_year = articles["Year"].value_counts().sort_index()
-    print(articles_per_year)
+    print(stats["articles_per_year"])
 
     # Top 10 most common Keywords, MeSH-terms and Chemicals.
-    print("\nTop 10 Keywords:")
-    print(keywords["Keyword"].value_counts().head(10))
-
-    print("\nTop 10 MeSH Terms:")
-    print(mesh_terms["Descriptor"].value_counts().head(10))
-
-    print("\nTop 10 Chemicals:")
-    print(chemicals["Chemical"].value_counts().head(10))
+    for label in term_tables:
+        print(f"\nTop 10 {label}:")
+        print(stats["terms"][label]["top_10"])
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
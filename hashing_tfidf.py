@@ -0,0 +1,143 @@
+# This module creates the TF-IDF features of titles and abstracts with feature hashing, as an alternative for the fitted
+# vocabularies of 'perform_tf_idf_on_title_and_abstract' (tfidf_feature_mode = "hashing"). Every n-gram is hashed to
+# one of 'hashing_n_features' columns (buckets), so a chunk of texts is vectorized without a vocabulary: independently
+# of the other chunks, and in parallel (by worker processes, or by the shards of 'mapreduce'). Per chunk, it counts:
+# - the number of documents and the document frequency (DF) of every bucket. The counts of all chunks are added up,
+#   and give the (smoothed) IDF of every bucket, with the same formula as TfidfVectorizer;
+# - the DF of the most frequent n-grams per bucket. These are merged as well, and every bucket is named after its most
+#   frequent n-gram, so the columns (and the cluster profiles of them) stay readable. The 'hashing_terms_per_bucket'
+#   most frequent n-grams of every bucket (the n-grams that share a column) are saved to a JSON file per table.
+# The TF-IDF of a text is its hashed term counts times the IDF, L2-normalized (as TfidfVectorizer). The model
+# (HashingVectorizer + TfidfTransformer) is saved in place of the fitted vectorizer, so 'assign' and 'delta_update' use
+# it the same way. The n-gram ranges and the stop words are the same as in the vocabulary mode; there is no
+# 'max_features', 'min_df' or 'max_df'.
+
+import json                                                  # For saving the n-grams per bucket.
+import os                                                    # For counting CPU cores.
+from concurrent.futures import ProcessPoolExecutor           # For hashing the chunks in parallel.
+import numpy as np                                           # For the counts and the IDF.
+import pandas as pd                                          # For the n-grams per bucket and the features.
+from scipy.sparse import csr_matrix, vstack                  # For the hashed term counts.
+from sklearn.feature_extraction import FeatureHasher        # For the bucket of an n-gram.
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfTransformer  # For TF-IDF.
+from sklearn.pipeline import make_pipeline                   # For the saved model.
+
+import memory_budget                                         # For sizing the chunks to the memory budget.
+from variables import CUSTOM_DOMAIN_STOPWORDS_TF_IDF, hashing_n_features, hashing_terms_per_bucket, hashing_n_jobs
+
+# Number of copies of a text row in memory per worker: the text, its n-grams, and the hashed and counted n-grams.
+row_copies = 10
+
+# A chunk keeps this many times 'hashing_terms_per_bucket' n-grams per bucket, so the merged top n-grams hardly depend
+# on how the texts are divided over the chunks.
+candidates_per_bucket = 20
+
+def make_vectorizer(ngram_range, n_features, stop_words):
+    return HashingVectorizer(
+        n_features=n_features, ngram_range=ngram_range, stop_words=list(stop_words), alternate_sign=False, norm=None
+    )
+
+def top_per_bucket(terms, n_terms):
+    # The 'n_terms' n-grams with the highest DF per bucket (ties in alphabetical order), sorted by bucket.
+    terms = terms.sort_index().sort_values(["bucket", "df"], ascending=[True, False], kind="stable")
+    return terms.groupby("bucket").head(n_terms)
+
+def bucket_terms(texts, vectorizer, n_terms):
+    # The DF and the bucket of the n-grams of the texts (the 'n_terms' most frequent per bucket). The n-grams are made
+    # by a CountVectorizer with the same settings, and hashed as HashingVectorizer hashes them.
+    counter = CountVectorizer(ngram_range=vectorizer.ngram_range, stop_words=vectorizer.stop_words, binary=True)
+    try:
+        X = counter.fit_transform(texts)
+    except ValueError:  # No n-grams (no texts, or only stop words).
+        return pd.DataFrame({"bucket": [], "df": []}, dtype="int64")
+    terms = counter.get_feature_names_out()
+    hasher = FeatureHasher(n_features=vectorizer.n_features, input_type="string", alternate_sign=False)
+    terms = pd.DataFrame(
+        {"bucket": hasher.transform([[term] for term in terms]).indices.astype("int64"), "df": X.getnnz(axis=0)},
+        index=terms
+    )
+    return top_per_bucket(terms, n_terms)
+
+def hash_counts(texts, vectorizer, terms_per_bucket):
+    # Hash a chunk of texts. Returns the hashed term counts (one row per text) and the counts of the chunk: the number
+    # of documents, the DF per bucket and the most frequent n-grams per bucket. Runs in a worker process.
+    X = vectorizer.transform(texts) if len(texts) else csr_matrix((0, vectorizer.n_features))
+    counts = {
+        "documents": X.shape[0],
+        "df": np.bincount(X.indices, minlength=vectorizer.n_features),
+        "terms": bucket_terms(texts, vectorizer, terms_per_bucket * candidates_per_bucket)
+    }
+    return X, counts
+
+def merge_counts(counts, terms_per_bucket):
+    # Add up the counts of several chunks (or shards).
+    terms = pd.concat([chunk_counts["terms"] for chunk_counts in counts])
+    terms = terms.groupby(level=0).agg({"bucket": "first", "df": "sum"})
+    return {
+        "documents": sum(chunk_counts["documents"] for chunk_counts in counts),
+        "df": np.sum([chunk_counts["df"] for chunk_counts in counts], axis=0),
+        "terms": top_per_bucket(terms, terms_per_bucket)
+    }
+
+def make_model(vectorizer, counts):
+    # The hashing vectorizer followed by the TF-IDF weighting with the smoothed IDF of the merged counts.
+    transformer = TfidfTransformer()
+    transformer.idf_ = np.log((counts["documents"] + 1) / (counts["df"] + 1.0)) + 1.0
+    return make_pipeline(vectorizer, transformer)
+
+def transform(model, texts):
+    if len(texts) == 0:  # scikit-learn does not transform zero rows.
+        return csr_matrix((0, model[0].n_features))
+    return model.transform(texts)
+
+def feature_names(counts, prefix):
+    # The column names: the most frequent n-gram of every bucket, or '#<bucket>' for a bucket without n-grams.
+    names = np.array([f"{prefix}#{bucket}" for bucket in range(len(counts["df"]))], dtype=object)
+    top = counts["terms"].groupby("bucket").head(1)
+    names[top["bucket"].to_numpy()] = [f"{prefix}{term}" for term in top.index]
+    return list(names)
+
+def save_bucket_terms(counts, prefix, path):
+    # Save the most frequent n-grams (with their DF) of every column.
+    names = feature_names(counts, prefix)
+    output = {}
+    for term, (bucket, df) in counts["terms"][["bucket", "df"]].iterrows():
+        output.setdefault(names[bucket], {})[term] = int(df)
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+
+def hash_file(path, column, prefix, ngram_range, skipped=()):
+    # Create the TF-IDF features of the texts in a column of a lower-case file, leaving out the skipped PMIDs. The
+    # chunks are hashed by 'hashing_n_jobs' worker processes; at most one chunk per worker waits to be hashed. Returns
+    # the features (sparse, with the PMID as last column), the model and the merged counts.
+    n_jobs = hashing_n_jobs or os.cpu_count() or 1
+    vectorizer = make_vectorizer(ngram_range, hashing_n_features, CUSTOM_DOMAIN_STOPWORDS_TF_IDF)
+    row_bytes = memory_budget.bytes_per_row(path, usecols=["PMID", column]) * row_copies * n_jobs
+    plan = memory_budget.make_plan(f"TF-IDF hashing ({column})", row_bytes)
+    pmids, matrices, chunk_counts, pending = [], [], [], []
+
+    def collect(future):
+        X, counts = future.result()
+        matrices.append(X)
+        chunk_counts.append(counts)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for chunk in memory_budget.read_chunks(path, plan, usecols=["PMID", column]):
+            chunk = chunk[~chunk["PMID"].isin(skipped)]
+            pmids.append(chunk["PMID"].to_numpy())
+            texts = chunk[column].fillna("").tolist()
+            pending.append(pool.submit(hash_counts, texts, vectorizer, hashing_terms_per_bucket))
+            if len(pending) > n_jobs:
+                collect(pending.pop(0))
+        for future in pending:
+            collect(future)
+    memory_budget.report(plan)
+
+    counts = merge_counts(chunk_counts, hashing_terms_per_bucket)
+    model = make_model(vectorizer, counts)
+    X = model[-1].transform(vstack(matrices, format="csr"))
+    features = pd.DataFrame.sparse.from_spmatrix(X.astype("float32"), columns=feature_names(counts, prefix))
+    features["PMID"] = np.concatenate(pmids)
+    print(f"Hashed {counts['documents']} texts of {column} into {hashing_n_features} columns in {len(matrices)} "
+          f"chunks ({n_jobs} workers); {int((counts['df'] > 0).sum())} columns are used.")
+    return features, model, counts
@@ -0,0 +1,197 @@
+# This module measures the performance of the pipeline stages (see 'pipeline'). Per stage it records:
+# - wall time and CPU time (user + system, including finished child processes such as the K-sweep workers);
+# - peak memory (RSS) of the stage process and its child processes, sampled by a background thread;
+# - bytes read and written (from /proc/<pid>/io, including reads that were served from the page cache);
+# - articles per second (the number of articles in articles.csv, divided by the wall time).
+# Optionally, a stage can be profiled with cProfile (deterministic, .prof file) or with a sampling profiler (folded
+# stacks, which can be turned into a flame graph). All results are saved to a JSON run report in the folder
+# 'run_reports', and a summary table is printed at the end of the run.
+# Memory and I/O are read from /proc, so they are only available on Linux. On other systems only the peak memory of
+# the stage process itself is reported, and on Windows (no 'resource' module) only the wall time and CPU time.
+
+import json                          # For the run report.
+import os                            # For CPU times and process ids.
+import sys                           # For the stacks of the sampling profiler.
+import time                          # For wall time and the sampling interval.
+import threading                     # For the background sampler.
+import cProfile                      # For the deterministic profiler.
+import pstats                        # For the cProfile summary.
+from collections import Counter      # For counting the sampled stacks.
+from pathlib import Path             # For handling file paths.
+
+from variables import instrumentation_sample_interval, instrumentation_profile_interval
+
+# The peak memory fallback and the page size (for the RSS from /proc) are not available on Windows.
+try:
+    import resource
+    page_size = os.sysconf("SC_PAGE_SIZE")
+except (ImportError, AttributeError, ValueError):
+    resource, page_size = None, None
+
+def descendants(pid):
+    # The process ids of all child processes (recursively) of a process.
+    result = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                for child in f.read().split():
+                    result += [int(child), *descendants(int(child))]
+    except OSError:
+        pass
+    return result
+
+def read_rss(pid):
+    # Current RSS of a process in bytes (0 if the process has ended, or if it cannot be read).
+    if page_size is None:
+        return 0
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * page_size
+    except OSError:
+        return 0
+
+def read_io(pid):
+    # Bytes read and written by a process so far, or None if it is not available.
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def start_sampler(interval, sample_stacks=False):
+    # Start a background thread that samples the memory and I/O of this process and the child processes it starts
+    # (child processes that already exist, such as idle workers of the pipeline, are left out). For child processes,
+    # the last sampled I/O counters are kept, because they can no longer be read after a child has ended. Optionally,
+    # it also samples the stack of the calling thread (sampling profiler). Returns the samples and a function that
+    # stops the sampler.
+    pid = os.getpid()
+    existing = set(descendants(pid))
+    thread_id = threading.get_ident()
+    stop_event = threading.Event()
+    samples = {"peak_rss": 0, "child_io": {}, "stacks": Counter()}
+
+    def sample():
+        children = [child for child in descendants(pid) if child not in existing]
+        samples["peak_rss"] = max(samples["peak_rss"], read_rss(pid) + sum(read_rss(child) for child in children))
+        for child in children:
+            samples["child_io"][child] = read_io(child) or samples["child_io"].get(child, (0, 0))
+
+        if sample_stacks:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            samples["stacks"][";".join(reversed(stack))] += 1
+
+    def loop():
+        while not stop_event.wait(interval):
+            sample()
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+
+    def stop():
+        stop_event.set()
+        thread.join()
+        sample()
+        return samples
+    return samples, stop
+
+def count_articles(csv_folder):
+    # Number of articles in articles.csv (from its metadata, see 'pmid_metadata'), or None if it does not exist yet.
+    path = Path(csv_folder) / "articles_metadata.json"
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["rows"]
+
+def measure(name, function, profiler=None, report_folder=None, csv_folder=None):
+    # Run function() and return the performance record of the stage. 'profiler' is None, "cprofile" or "sampling";
+    # the profile is saved to 'report_folder'.
+    io_before = read_io("self")
+    times_before = os.times()
+    profile = cProfile.Profile() if profiler == "cprofile" else None
+
+    start = time.perf_counter()
+    if profiler == "sampling":
+        samples, stop_sampler = start_sampler(instrumentation_profile_interval, sample_stacks=True)
+    else:
+        samples, stop_sampler = start_sampler(instrumentation_sample_interval)
+    try:
+        if profile:
+            profile.runcall(function)
+        else:
+            function()
+    finally:
+        wall_seconds = time.perf_counter() - start
+        stop_sampler()
+
+    times_after = os.times()
+    io_after = read_io("self")
+    cpu_seconds = sum(times_after[:4]) - sum(times_before[:4])
+
+    record = {
+        "stage": name,
+        "status": "ran",
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "peak_rss_mb": round(samples["peak_rss"] / 2 ** 20, 1) if samples["peak_rss"] else None,
+        "read_mb": None,
+        "written_mb": None,
+        "articles": count_articles(csv_folder) if csv_folder else None,
+        "articles_per_second": None,
+        "profile": None
+    }
+
+    # Without /proc, fall back to the peak memory of this process (which may include earlier stages).
+    if record["peak_rss_mb"] is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record["peak_rss_mb"] = round(peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+    if io_before and io_after:
+        child_read = sum(read for read, _ in samples["child_io"].values())
+        child_written = sum(written for _, written in samples["child_io"].values())
+        record["read_mb"] = round((io_after[0] - io_before[0] + child_read) / 2 ** 20, 1)
+        record["written_mb"] = round((io_after[1] - io_before[1] + child_written) / 2 ** 20, 1)
+    if record["articles"] and wall_seconds > 0:
+        record["articles_per_second"] = round(record["articles"] / wall_seconds, 1)
+
+    # Save the profile.
+    if profiler and report_folder:
+        report_folder.mkdir(parents=True, exist_ok=True)
+        if profile:
+            path = report_folder / f"{name}.prof"
+            profile.dump_stats(path)
+            with open(report_folder / f"{name}_cprofile.txt", "w") as f:
+                pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(30)
+        else:
+            path = report_folder / f"{name}_stacks.txt"
+            with open(path, "w") as f:
+                for stack, count in samples["stacks"].most_common():
+                    f.write(f"{stack} {count}\n")
+        record["profile"] = str(path)
+
+    return record
+
+def skipped_record(name):
+    # Record of a stage that was skipped because it was up to date.
+    return {"stage": name, "status": "skipped"}
+
+def save_report(records, report_folder, started):
+    # Save the run report (JSON) and print a summary table.
+    report_folder.mkdir(parents=True, exist_ok=True)
+    path = report_folder / "run_report.json"
+    with open(path, "w") as f:
+        json.dump({"started": started.isoformat(timespec="seconds"), "stages": records}, f, indent=2)
+
+    def value(record, key, width):
+        return f"{record[key]:<{width}.1f}" if record.get(key) is not None else f"{'-':<{width}}"
+
+    print("\nStage                                    Status    Wall (s)  CPU (s)   Peak RSS (MB)  Read (MB)  "
+          "Written (MB)  Articles/s")
+    for record in records:
+        print(f"{record['stage']:<41}{record['status']:<10}{value(record, 'wall_seconds', 10)}"
+              f"{value(record, 'cpu_seconds', 10)}{value(record, 'peak_rss_mb', 15)}{value(record, 'read_mb', 11)}"
+              f"{value(record, 'written_mb', 14)}{value(record, 'articles_per_second', 0)}")
+    print(f"Saved: run report ({path})")
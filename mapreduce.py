@@ -0,0 +1,597 @@
+# This module runs the feature stages of the pipeline (from 'create_multi_CSV' to 'combine_transformed_data') as a
+# shard-parallel map-reduce job. A shard is one XML source file. The job has three map phases, each followed by a
+# reduce step in the coordinator:
+# 1. extract: parse the XML file, create the multi-CSV rows and the lower-case rows of the shard, and count the
+#    Keywords, MeSH-terms, Chemicals and TF-IDF n-grams (title and abstract) of the shard.
+#    reduce: concatenate the shards into the CSVs of the pipeline, add up the PMID metadata, build the SQLite store
+#    (if 'use_sqlite_store' is set), select the top-N values from the merged counts and fit the TF-IDF vectorizers
+#    from the merged n-gram counts.
+# 2. features: multi-hot encode and TF-IDF transform the shard with the fitted vocabularies and vectorizers, and count
+#    the n-grams of ('title' + 'abstract') of the rows that are used to fit the profiling vectorizer.
+#    reduce: merge the shards into the feature CSVs and fit the profiling vectorizer.
+# 3. transform: combine the features of the shard, and TF-IDF transform ('title' + 'abstract') of the shard.
+#    reduce: concatenate the shards into the combined feature matrix and the TF-IDF files for profiling.
+# The partial states (counts, row numbers, checksums) are added up, and the vectorizers are fitted from them with the
+# same rules as scikit-learn (document frequency limits, top features by term frequency, smoothed IDF), so the output
+# files are equal to those of the stages run in one process. This assumes that a PMID occurs in only one source file
+# (as in the PubMed baseline).
+# In the hashing feature mode (see 'hashing_tfidf'), the extract phase counts the document frequencies of the hash
+# buckets (and the most frequent n-grams per bucket) instead of the n-grams, and the reduce step makes the hashing
+# models from the merged counts. The TF-IDF values are equal to those of the stage as well; the name of a column (its
+# most frequent n-gram) can only differ if the most frequent n-grams of a bucket (almost) have the same count.
+# PCA and K-Means are not part of the job: their results depend on the order of the rows (IncrementalPCA, k-means++ on
+# a sample), so they would differ from a single-process run. Continue with 'python -m pipeline --from perform_PCA'.
+# Near-duplicates (see 'near_duplicates') are not skipped by the job, since the vocabularies are fitted from the counts
+# of the extract phase, before the near-duplicates are known. Run the stages instead if 'skip_near_duplicates' is set.
+#
+# The coordinator and the workers only communicate through files in the job folder ('mapreduce' in the destination
+# folder): the tasks, the fitted state per phase, and per task a claim file and a result file. A worker claims a task
+# by creating its claim file (an atomic operation, also on a shared filesystem), and keeps the claim file up to date
+# while it works. A claim that has not been updated for 'mapreduce_task_timeout' seconds (e.g. the host went down) is
+# removed by the coordinator, so another worker takes over the task.
+#
+# Usage:
+#   python mapreduce.py                            Run the job with 'mapreduce_n_jobs' local worker processes.
+#   python mapreduce.py --workers 0                Run the job with workers on other hosts only.
+#   python mapreduce.py worker [--job-folder F]    Join a running job, e.g. on another host. The destination folder
+#                                                  must be a shared filesystem with the same path on all hosts.
+
+import argparse                                              # For the command line options.
+import heapq                                                 # For merging the sorted feature files.
+import multiprocessing                                       # For the local worker processes.
+import os                                                    # For claiming tasks and replacing files.
+import pickle                                                # For the tasks, states and results.
+import shutil                                                # For copying and removing files.
+import socket                                                # For the host name in the claim files.
+import threading                                             # For keeping the claim up to date.
+import time                                                  # For waiting and timeouts.
+import traceback                                             # For reporting failed tasks.
+from numbers import Integral                                 # For the document frequency limits.
+from pathlib import Path                                     # For handling file paths.
+import numpy as np                                           # For fitting the vectorizers.
+import pandas as pd                                          # For reading and writing the shards.
+import joblib                                                # For saving the fitted vectorizers.
+from scipy.sparse import csr_matrix, vstack                  # For the TF-IDF rows of a shard.
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer   # For the n-gram counts and TF-IDF.
+from sklearn.preprocessing import normalize                  # For the TF-IDF rows of the fitted rows.
+
+import variables
+import memory_budget                                         # For the number of rows to fit the profiling TF-IDF.
+import pmid_metadata                                         # Row count and PMID checksum of articles.csv.
+import schema                                                # For reading and writing the shards with their types.
+import hashing_tfidf                                         # For the hashing feature mode.
+import sqlite_store                                          # For building the SQLite store.
+from create_multi_CSV import parse_file                      # Same parsing and filters as 'create_multi_CSV'.
+from convert_to_lower_case import lower_case_tables          # Same text cleaning as 'convert_to_lower_case'.
+from transform_categorical_to_binary import encode           # Same encoding as 'transform_categorical_to_binary'.
+from combine_transformed_data import combine_features        # Same feature merge as 'combine_transformed_data'.
+from perform_tf_idf_on_title_plus_abstract import fit_copies # Same fit plan as 'perform_tf_idf_on_title_plus_abstract'.
+
+phases = ["extract", "features", "transform"]
+
+# The columns of the multi-CSV setup (see 'create_multi_CSV'). The shard files are read and written with the types of
+# their schema (see 'schema'), so a shard is read the same as the full file.
+raw_columns = {
+    "articles": ["PMID", "Title", "Abstract", "Year", "SourceFile"],
+    "keywords": ["PMID", "Keyword", "SourceFile"],
+    "mesh_terms": ["PMID", "Descriptor", "SourceFile"],
+    "chemicals": ["PMID", "Chemical", "SourceFile"]
+}
+
+# The categorical tables: the lower-case file, the column and the setting for the top N.
+categorical_tables = {
+    "keywords": ("keywords_lower_case.csv", "Keyword", "top_n_keywords"),
+    "mesh_terms": ("mesh_terms_lower_case.csv", "Descriptor", "top_n_mesh"),
+    "chemicals": ("chemicals_lower_case.csv", "Chemical", "top_n_chemicals")
+}
+
+# The TF-IDF tables for clustering: the lower-case file, the column, the column prefix and the settings.
+tfidf_tables = {
+    "title": ("articles_title_lower_case.csv", "Title", "title__", "title_max_features", "title_ngram_range"),
+    "abstract": ("articles_abstract_lower_case.csv", "Abstract", "abstract__", "abstract_max_features",
+                 "abstract_ngram_range")
+}
+
+lower_case_files = [
+    "articles_title_lower_case.csv", "articles_abstract_lower_case.csv", "articles_title_plus_abstract_lower_case.csv",
+    "keywords_lower_case.csv", "mesh_terms_lower_case.csv", "chemicals_lower_case.csv"
+]
+
+# The settings of the job. They are saved in the job folder, so all workers (also on other hosts) use the settings of
+# the coordinator.
+def job_settings():
+    names = [
+        "destination_folder", "csv_folder", "top_n_keywords", "top_n_mesh", "top_n_chemicals",
+        "title_max_features", "title_ngram_range", "abstract_max_features", "abstract_ngram_range",
+        "min_df_clustering", "max_df_clustering", "title_abstract_max_features", "title_abstract_ngram_range",
+        "min_df_profiling", "max_df_profiling", "tfidf_chunk_size", "mapreduce_task_timeout",
+        "mapreduce_poll_interval", "tfidf_feature_mode", "hashing_n_features", "hashing_terms_per_bucket"
+    ]
+    settings = {name: getattr(variables, name) for name in names}
+    settings["stop_words_tf_idf"] = sorted(variables.CUSTOM_DOMAIN_STOPWORDS_TF_IDF)
+    return settings
+
+def default_job_folder():
+    return Path(variables.destination_folder) / "mapreduce"
+
+# Files in the job folder. A file is written to a temporary name first and then renamed, so other processes never see
+# a half-written file. If a task runs twice (after a timeout), both runs write the same content.
+def write_pickle(obj, path):
+    temp_path = path.with_name(f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(temp_path, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(temp_path, path)
+
+def read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def write_csv(df, path, **to_csv_kwargs):
+    temp_path = path.with_name(f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    schema.write_table(df, temp_path, name=path.name, **to_csv_kwargs)
+    os.replace(temp_path, path)
+
+def shard_folder(job_folder, task_id):
+    folder = job_folder / "shards" / task_id
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+# N-gram counts of a collection of texts: the number of documents (df) and the number of occurrences (tf) per n-gram,
+# in order of first appearance. Counts of several shards can be added up. CountVectorizer.fit_transform numbers the
+# n-grams in sorted order, but keeps the n-grams of every row in order of first appearance (see 'tfidf_transform'): the
+# first position of an n-gram in the rows, one after the other, gives that order.
+def ngram_counts(texts, ngram_range, stop_words):
+    vectorizer = CountVectorizer(ngram_range=ngram_range, stop_words=stop_words)
+    try:
+        X = vectorizer.fit_transform(texts)
+    except ValueError:  # No n-grams (no texts, or only stop words).
+        return pd.DataFrame({"df": [], "tf": []}, dtype="int64")
+    terms = np.empty(len(vectorizer.vocabulary_), dtype=object)
+    terms[list(vectorizer.vocabulary_.values())] = list(vectorizer.vocabulary_.keys())
+    columns, first_positions = np.unique(X.indices, return_index=True)
+    order = columns[np.argsort(first_positions)]
+    return pd.DataFrame(
+        {"df": np.bincount(X.indices, minlength=X.shape[1])[order], "tf": np.asarray(X.sum(axis=0)).ravel()[order]},
+        index=terms[order]
+    )
+
+# Add up the n-gram counts of the shards (in order of the shards). Returns the counts per n-gram in sorted order, with
+# the position of the first appearance of the n-gram in all shards.
+def merge_counts(counts):
+    counts = pd.concat(counts)
+    merged = counts.groupby(level=0).sum()
+    merged["first"] = pd.Series(np.arange(len(counts)), index=counts.index).groupby(level=0).min()
+    return merged
+
+# Fit a TfidfVectorizer from merged n-gram counts of 'n_doc' documents. The same steps as TfidfVectorizer.fit: the
+# vocabulary is sorted, the n-grams outside the document frequency limits are removed, the 'max_features' n-grams with
+# the highest term frequency are kept, and the smoothed IDF is calculated. Also returns the first appearance of the
+# selected n-grams (see 'tfidf_transform').
+def fit_vectorizer(vectorizer, counts, n_doc):
+    max_df, min_df, limit = vectorizer.max_df, vectorizer.min_df, vectorizer.max_features
+    max_doc_count = max_df if isinstance(max_df, Integral) else max_df * n_doc
+    min_doc_count = min_df if isinstance(min_df, Integral) else min_df * n_doc
+    if max_doc_count < min_doc_count:
+        raise ValueError("max_df corresponds to < documents than min_df")
+
+    dfs = counts["df"].to_numpy()
+    mask = (dfs <= max_doc_count) & (dfs >= min_doc_count)
+    if limit is not None and mask.sum() > limit:
+        tfs = counts["tf"].to_numpy(dtype="float64")
+        mask_inds = (-tfs[mask]).argsort()[:limit]
+        new_mask = np.zeros(len(dfs), dtype=bool)
+        new_mask[np.where(mask)[0][mask_inds]] = True
+        mask = new_mask
+    if not mask.any():
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+
+    vectorizer.vocabulary_ = {term: i for i, term in enumerate(counts.index[mask])}
+    idf = np.full(mask.sum(), n_doc + 1, dtype="float64")
+    idf /= dfs[mask].astype("float64") + 1.0
+    np.log(idf, out=idf)
+    idf += 1.0
+    vectorizer.idf_ = idf
+    return vectorizer, counts["first"].to_numpy()[mask]
+
+# TF-IDF transform. For the rows that were used to fit the vectorizer, TfidfVectorizer.fit_transform adds up the
+# squared values of a row (for the normalization) in order of first appearance of the n-grams instead of in sorted
+# order, which can change the last digit. With 'first' (see 'fit_vectorizer'), these rows are calculated in the same
+# order, so they are equal to those of a single-process run.
+def tfidf_transform(vectorizer, texts, first=None):
+    if len(texts) == 0:  # scikit-learn does not transform zero rows.
+        return csr_matrix((0, len(vectorizer.vocabulary_)))
+    if first is None:
+        return vectorizer.transform(texts)
+    X = CountVectorizer.transform(vectorizer, texts)
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    order = np.lexsort((first[X.indices], rows))
+    X.indices, X.data = X.indices[order], X.data[order]
+    X.data *= vectorizer.idf_[X.indices]
+    return normalize(X, norm=vectorizer.norm, copy=False)
+
+# Select the top-N values from merged value counts (in order of first appearance), the same way as
+# 'df[column].value_counts().nlargest(top_n)' (ties keep the order of first appearance). Returns the values in the
+# column order of the multi-hot encoding.
+def top_columns(counts, top_n):
+    top_values = pd.Series(counts, dtype="int64").sort_values(ascending=False, kind="stable").nlargest(top_n).index
+    return list(pd.get_dummies(pd.Series(list(top_values), dtype=object)).columns)
+
+def sparse_table(X, columns):
+    return pd.DataFrame.sparse.from_spmatrix(X.astype("float32"), columns=columns)
+
+def hashing_vectorizer(settings, ngram_range):
+    return hashing_tfidf.make_vectorizer(
+        settings[ngram_range], settings["hashing_n_features"], settings["stop_words_tf_idf"]
+    )
+
+# Map phase 1: multi-CSV and lower-case rows, value counts and n-gram counts of one source file.
+def map_extract(job_folder, task_id, task, settings, state):
+    shard = shard_folder(job_folder, task_id)
+    rows = parse_file(Path(task["source"]))
+
+    # Multi-CSV rows, written the same way as 'create_multi_CSV' (a header, then the rows appended).
+    for name, columns in raw_columns.items():
+        temp_path = shard / f"{name}.csv.{socket.gethostname()}.{os.getpid()}.tmp"
+        schema.write_table(pd.DataFrame(columns=columns), temp_path, name=f"{name}.csv")
+        schema.write_table(pd.DataFrame(rows[name]), temp_path, name=f"{name}.csv", mode="a", header=False)
+        os.replace(temp_path, shard / f"{name}.csv")
+
+    # Lower-case rows, created from the saved rows (as 'convert_to_lower_case' reads them).
+    raw = {name: schema.read_table(shard / f"{name}.csv") for name in raw_columns}
+    for filename, df in lower_case_tables(raw["articles"], raw["keywords"], raw["mesh_terms"],
+                                          raw["chemicals"]).items():
+        write_csv(df, shard / filename)
+
+    # Value counts of the categorical tables, in order of first appearance.
+    value_counts = {}
+    for name, (filename, column, _) in categorical_tables.items():
+        values = schema.read_table(shard / filename)[column]
+        value_counts[name] = schema.value_counts(values, sort=False).to_dict()
+
+    # N-gram counts (or hash bucket counts, in the hashing mode) of titles and abstracts.
+    ngrams = {}
+    for name, (filename, column, _, _, ngram_range) in tfidf_tables.items():
+        texts = schema.read_table(shard / filename)[column].fillna("")
+        if settings["tfidf_feature_mode"] == "hashing":
+            _, ngrams[name] = hashing_tfidf.hash_counts(
+                texts.tolist(), hashing_vectorizer(settings, ngram_range), settings["hashing_terms_per_bucket"]
+            )
+        else:
+            ngrams[name] = ngram_counts(texts, settings[ngram_range], settings["stop_words_tf_idf"])
+
+    return {
+        "rows": len(raw["articles"]),
+        "pmid_checksum": pmid_metadata.pmid_checksum(raw["articles"]["PMID"]),
+        "value_counts": value_counts,
+        "ngrams": ngrams
+    }
+
+# Map phase 2: multi-hot and TF-IDF features of one shard, and the n-gram counts for the profiling vectorizer.
+def map_features(job_folder, task_id, task, settings, state):
+    shard = shard_folder(job_folder, task_id)
+    pmids = schema.read_table(shard / "articles.csv", usecols=["PMID"])["PMID"]
+
+    # Multi-hot encoding with the global top-N values. The shard has all columns, also values it does not contain.
+    for name, (filename, column, _) in categorical_tables.items():
+        columns = state["columns"][name]
+        result = encode(schema.read_table(shard / filename), column, columns)
+        result = result.reindex(columns=["PMID"] + columns, fill_value=0)
+        write_csv(result, shard / f"{name}_transformed.csv")
+
+    # TF-IDF with the fitted vectorizers or hashing models (PMID as last column, see
+    # 'perform_tf_idf_on_title_and_abstract').
+    for name, (filename, column, _, _, _) in tfidf_tables.items():
+        df = schema.read_table(shard / filename)
+        vectorizer, first, columns = state["vectorizers"][name]
+        if settings["tfidf_feature_mode"] == "hashing":
+            X = hashing_tfidf.transform(vectorizer, df[column].fillna("").tolist())
+        else:
+            X = tfidf_transform(vectorizer, df[column].fillna(""), first)
+        features = sparse_table(X, columns)
+        features["PMID"] = df["PMID"]
+        write_csv(features, shard / f"tfidf_{name}.csv")
+
+    # N-gram counts of the rows of this shard that are used to fit the profiling vectorizer.
+    fit_rows = min(max(state["fit_rows"] - task["offset"], 0), len(pmids))
+    ngrams = None
+    if fit_rows:
+        texts = schema.read_table(shard / "articles_title_plus_abstract_lower_case.csv", nrows=fit_rows)
+        ngrams = ngram_counts(texts["Title_plus_abstract"].fillna(""), settings["title_abstract_ngram_range"],
+                              settings["stop_words_tf_idf"])
+    return {"ngrams": ngrams}
+
+# Map phase 3: combined features and TF-IDF for profiling of one shard.
+def map_transform(job_folder, task_id, task, settings, state):
+    shard = shard_folder(job_folder, task_id)
+
+    # Combined features (see 'combine_transformed_data'). All features are saved as 32-bit floats (see 'schema'), so
+    # a column has the same type in a shard as in the full table.
+    articles = schema.read_table(shard / "articles.csv", usecols=["PMID", "SourceFile"])
+    tables = []
+    for name in ["keywords", "mesh_terms", "chemicals", "title", "abstract"]:
+        filename = f"{name}_transformed.csv" if name in categorical_tables else f"tfidf_{name}.csv"
+        tables.append(schema.read_table(shard / filename))
+    write_csv(combine_features(articles, tables), shard / "data_combined_before_PCA.csv")
+
+    # TF-IDF for profiling (PMID as first column, see 'perform_tf_idf_on_title_plus_abstract'). The rows that were used
+    # to fit the vectorizer go to part 1, the other rows to part 2.
+    df = schema.read_table(shard / "articles_title_plus_abstract_lower_case.csv")
+    texts = df["Title_plus_abstract"].fillna("")
+    vectorizer, first = state["vectorizer"]
+    fit_rows = min(max(state["fit_rows"] - task["offset"], 0), len(df))
+    X = vstack([tfidf_transform(vectorizer, texts[:fit_rows], first), tfidf_transform(vectorizer, texts[fit_rows:])])
+    features = sparse_table(X, [f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()])
+    features.insert(0, "PMID", df["PMID"].values)
+    write_csv(features.iloc[:fit_rows], shard / "tfidf_title_plus_abstract_part1.csv")
+    write_csv(features.iloc[fit_rows:], shard / "tfidf_title_plus_abstract_part2.csv")
+    return {}
+
+map_functions = {"extract": map_extract, "features": map_features, "transform": map_transform}
+
+# Claim the next open task: the first task (of the earliest phase) that has no claim and no result yet. Returns the
+# phase and the task id, or None.
+def claim_task(job_folder):
+    for phase in phases:
+        phase_folder = job_folder / phase
+        if not (phase_folder / "tasks").exists():
+            continue
+        for task_path in sorted((phase_folder / "tasks").glob("*.pkl")):
+            task_id = task_path.stem
+            if (phase_folder / "results" / f"{task_id}.pkl").exists():
+                continue
+            try:
+                fd = os.open(phase_folder / "claims" / task_id, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{socket.gethostname()}:{os.getpid()}\n")
+            return phase, task_id
+    return None
+
+# Run one task. The claim file is touched regularly while the task runs. A failure is saved to the folder 'failed' of
+# the phase, so the coordinator can stop the job.
+def run_task(job_folder, phase, task_id):
+    phase_folder = job_folder / phase
+    settings = read_pickle(job_folder / "settings.pkl")
+    claim_path = phase_folder / "claims" / task_id
+    stop = threading.Event()
+
+    def keep_claim():
+        while not stop.wait(settings["mapreduce_task_timeout"] / 4):
+            try:
+                os.utime(claim_path)
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=keep_claim, daemon=True)
+    thread.start()
+    try:
+        task = read_pickle(phase_folder / "tasks" / f"{task_id}.pkl")
+        state = read_pickle(phase_folder / "state.pkl")
+        result = map_functions[phase](job_folder, task_id, task, settings, state)
+        write_pickle(result, phase_folder / "results" / f"{task_id}.pkl")
+    except Exception:
+        with open(phase_folder / "failed" / f"{task_id}.txt", "w") as f:
+            f.write(f"{socket.gethostname()}:{os.getpid()}\n{traceback.format_exc()}")
+    finally:
+        stop.set()
+        thread.join()
+
+# A worker runs tasks until the job is finished.
+def run_worker(job_folder):
+    job_folder = Path(job_folder)
+    while not (job_folder / "finished").exists():
+        task = claim_task(job_folder) if (job_folder / "settings.pkl").exists() else None
+        if task is None:
+            time.sleep(variables.mapreduce_poll_interval)
+            continue
+        run_task(job_folder, *task)
+
+# Run a map phase: save the state and the tasks, and wait until all tasks have a result. Claims that have not been
+# updated within the timeout are removed, so the task is run again.
+def run_map_phase(job_folder, phase, tasks, state, settings):
+    phase_folder = job_folder / phase
+    for subfolder in ["tasks", "claims", "results", "failed"]:
+        (phase_folder / subfolder).mkdir(parents=True, exist_ok=True)
+    write_pickle(state, phase_folder / "state.pkl")
+    for task_id, task in tasks.items():
+        write_pickle(task, phase_folder / "tasks" / f"{task_id}.pkl")
+
+    start = time.perf_counter()
+    while True:
+        failed = sorted((phase_folder / "failed").glob("*.txt"))
+        if failed:
+            with open(failed[0], "r") as f:
+                raise RuntimeError(f"Task {phase}/{failed[0].stem} failed on {f.read()}")
+        done = [task_id for task_id in tasks if (phase_folder / "results" / f"{task_id}.pkl").exists()]
+        if len(done) == len(tasks):
+            break
+        for task_id in tasks:
+            claim_path = phase_folder / "claims" / task_id
+            try:
+                stale = time.time() - claim_path.stat().st_mtime > settings["mapreduce_task_timeout"]
+            except FileNotFoundError:
+                continue
+            if stale and not (phase_folder / "results" / f"{task_id}.pkl").exists():
+                print(f"Task {phase}/{task_id} timed out; it is run again.")
+                claim_path.unlink(missing_ok=True)
+        time.sleep(settings["mapreduce_poll_interval"])
+
+    print(f"Map phase '{phase}': {len(tasks)} tasks in {time.perf_counter() - start:.1f} s.")
+    return {task_id: read_pickle(phase_folder / "results" / f"{task_id}.pkl") for task_id in tasks}
+
+# Concatenate shard CSV files: the header of the first file, then the rows of all files.
+def concatenate(paths, target):
+    with open(target, "wb") as output:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as source:
+                header = source.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(source, output, 2 ** 24)
+
+# Merge shard CSV files that are sorted by PMID (first column, numbers only) into one file sorted by PMID, as the
+# multi-hot files of 'transform_categorical_to_binary' (grouped by PMID) are.
+def merge_sorted(paths, target):
+    sources = [open(path, "rb") for path in paths]
+    try:
+        header = [source.readline() for source in sources][0]
+        with open(target, "wb") as output:
+            output.write(header)
+            output.writelines(heapq.merge(*sources, key=lambda line: int(line.split(b"~", 1)[0])))
+    finally:
+        for source in sources:
+            source.close()
+
+def run_job(n_jobs=variables.mapreduce_n_jobs, job_folder=None):
+    start = time.perf_counter()
+    job_folder = Path(job_folder) if job_folder else default_job_folder()
+    csv_folder = Path(variables.csv_folder)
+    models_folder = csv_folder / "models"
+    xml_files = sorted(Path(variables.destination_folder).glob("*.xml"))
+    if not xml_files:
+        raise FileNotFoundError(f"No XML files found in {variables.destination_folder}.")
+    if variables.skip_near_duplicates:
+        raise ValueError("The map-reduce job does not skip near-duplicates. Set 'skip_near_duplicates' to False, or "
+                         "run the stages with 'python -m pipeline'.")
+
+    # Create a new job folder and start the local workers.
+    shutil.rmtree(job_folder, ignore_errors=True)
+    job_folder.mkdir(parents=True)
+    csv_folder.mkdir(parents=True, exist_ok=True)
+    models_folder.mkdir(exist_ok=True)
+    settings = job_settings()
+    write_pickle(settings, job_folder / "settings.pkl")
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    workers = [multiprocessing.Process(target=run_worker, args=(job_folder,), daemon=True) for _ in range(n_jobs)]
+    for worker in workers:
+        worker.start()
+    print(f"Map-reduce job: {len(xml_files)} source files, {n_jobs} local worker(s). Other hosts can join with: "
+          f"python mapreduce.py worker --job-folder {job_folder}")
+
+    task_ids = [f"{i:06d}" for i in range(len(xml_files))]
+    shards = [job_folder / "shards" / task_id for task_id in task_ids]
+    try:
+        # Phase 1: extract.
+        results = run_map_phase(job_folder, "extract", {
+            task_id: {"source": str(xml_file.resolve())} for task_id, xml_file in zip(task_ids, xml_files)
+        }, {}, settings)
+
+        # Reduce 1: the multi-CSV setup, the lower-case files and the metadata of articles.csv. The new files have no
+        # superseded rows (see 'delta_update').
+        (csv_folder / schema.tombstones_filename).unlink(missing_ok=True)
+        for filename in [f"{name}.csv" for name in raw_columns] + lower_case_files:
+            concatenate([shard / filename for shard in shards], csv_folder / filename)
+            print(f"Created: {filename}")
+        n_rows = sum(result["rows"] for result in results.values())
+        checksum = sum(result["pmid_checksum"] for result in results.values()) % 2 ** 64
+        pmid_metadata.write_metadata(csv_folder, n_rows, checksum)
+        if variables.use_sqlite_store:
+            sqlite_store.build_store(csv_folder)
+
+        # The top-N values of the categorical tables, from the merged value counts.
+        columns = {}
+        for name, (_, _, top_n) in categorical_tables.items():
+            merged = {}
+            for result in results.values():
+                for value, count in result["value_counts"][name].items():
+                    merged[value] = merged.get(value, 0) + count
+            columns[name] = top_columns(merged, settings[top_n])
+
+        # The TF-IDF vectorizers for clustering, from the merged n-gram counts (or the hashing models, from the merged
+        # bucket counts), with their columns.
+        vectorizers = {}
+        for name, (_, _, prefix, max_features, ngram_range) in tfidf_tables.items():
+            if settings["tfidf_feature_mode"] == "hashing":
+                counts = hashing_tfidf.merge_counts(
+                    [result["ngrams"][name] for result in results.values()], settings["hashing_terms_per_bucket"]
+                )
+                model = hashing_tfidf.make_model(hashing_vectorizer(settings, ngram_range), counts)
+                vectorizers[name] = (model, None, hashing_tfidf.feature_names(counts, prefix))
+                hashing_tfidf.save_bucket_terms(counts, prefix, models_folder / f"tfidf_{name}_buckets.json")
+            else:
+                vectorizer = TfidfVectorizer(
+                    max_features=settings[max_features],
+                    ngram_range=settings[ngram_range],
+                    stop_words=settings["stop_words_tf_idf"],
+                    min_df=settings["min_df_clustering"],
+                    max_df=settings["max_df_clustering"]
+                )
+                counts = merge_counts([result["ngrams"][name] for result in results.values()])
+                vectorizer, first = fit_vectorizer(vectorizer, counts, n_rows)
+                vectorizers[name] = (vectorizer, first, [f"{prefix}{t}" for t in vectorizer.get_feature_names_out()])
+            joblib.dump(vectorizers[name][0], models_folder / f"tfidf_{name}.joblib")
+
+        # The number of rows to fit the profiling vectorizer (the same plan as the stage), and the first row of every
+        # shard.
+        text_bytes = memory_budget.bytes_per_row(csv_folder / "articles_title_plus_abstract_lower_case.csv")
+        fit_plan = memory_budget.make_plan("TF-IDF fit", text_bytes * fit_copies, rows=settings["tfidf_chunk_size"])
+        memory_budget.report(fit_plan)
+        fit_rows = fit_plan["rows"]
+        offsets = np.cumsum([0] + [results[task_id]["rows"] for task_id in task_ids])
+
+        # Phase 2: features.
+        results = run_map_phase(job_folder, "features", {
+            task_id: {"offset": int(offset)} for task_id, offset in zip(task_ids, offsets)
+        }, {"columns": columns, "vectorizers": vectorizers, "fit_rows": fit_rows}, settings)
+
+        # Reduce 2: the feature files, and the profiling vectorizer.
+        for name in categorical_tables:
+            merge_sorted([shard / f"{name}_transformed.csv" for shard in shards],
+                         csv_folder / f"{name}_transformed.csv")
+            print(f"Created: {name}_transformed.csv")
+        for name in tfidf_tables:
+            concatenate([shard / f"tfidf_{name}.csv" for shard in shards], csv_folder / f"tfidf_{name}.csv")
+            print(f"Created: tfidf_{name}.csv")
+        vectorizer = TfidfVectorizer(
+            max_features=settings["title_abstract_max_features"],
+            ngram_range=settings["title_abstract_ngram_range"],
+            stop_words=settings["stop_words_tf_idf"],
+            min_df=settings["min_df_profiling"],
+            max_df=settings["max_df_profiling"]
+        )
+        counts = merge_counts([result["ngrams"] for result in results.values() if result["ngrams"] is not None])
+        vectorizer = fit_vectorizer(vectorizer, counts, min(fit_rows, n_rows))
+        joblib.dump(vectorizer[0], models_folder / "tfidf_title_plus_abstract.joblib")
+
+        # Phase 3: transform.
+        run_map_phase(job_folder, "transform", {
+            task_id: {"offset": int(offset)} for task_id, offset in zip(task_ids, offsets)
+        }, {"vectorizer": vectorizer, "fit_rows": fit_rows}, settings)
+
+        # Reduce 3: the combined feature matrix and the TF-IDF files for profiling.
+        for filename in ["data_combined_before_PCA.csv", "tfidf_title_plus_abstract_part1.csv",
+                         "tfidf_title_plus_abstract_part2.csv"]:
+            concatenate([shard / filename for shard in shards], csv_folder / filename)
+            print(f"Created: {filename}")
+        concatenate([csv_folder / "tfidf_title_plus_abstract_part1.csv",
+                     csv_folder / "tfidf_title_plus_abstract_part2.csv"],
+                    csv_folder / "tfidf_title_plus_abstract.csv")
+        print("Created: tfidf_title_plus_abstract.csv")
+    finally:
+        # Stop the workers (also those on other hosts).
+        (job_folder / "finished").touch()
+        for worker in workers:
+            worker.join()
+
+    print(f"\nMap-reduce job finished in {time.perf_counter() - start:.1f} s: {n_rows} articles from "
+          f"{len(xml_files)} source files.")
+    print("Continue with PCA and clustering: python -m pipeline --from perform_PCA")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the feature stages as a shard-parallel map-reduce job.")
+    parser.add_argument("command", nargs="?", choices=["run", "worker"], default="run",
+                        help="run the job (coordinator), or join a running job as a worker")
+    parser.add_argument("--workers", type=int, default=variables.mapreduce_n_jobs,
+                        help="number of local worker processes (default: 'mapreduce_n_jobs')")
+    parser.add_argument("--job-folder", default=None,
+                        help="job folder (default: 'mapreduce' in the destination folder)")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_worker(args.job_folder or default_job_folder())
+    else:
+        run_job(args.workers, args.job_folder)
+
+if __name__ == "__main__":
+    main()
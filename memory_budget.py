@@ -0,0 +1,124 @@
+# This module sizes the chunks, samples and worker processes of the chunked stages to a memory budget
+# ('max_memory_gb' in the variables module), instead of fixed numbers of rows. For every stage:
+# 1. The memory per row is estimated from the first rows of its input (as loaded by pandas), times the number of copies
+#    of a row that the stage keeps in memory at the same time (e.g. the chunk and its scaled version);
+# 2. A plan is made with the part of the budget that is not used yet (the budget minus the current memory of the
+#    process): the number of rows per chunk (or the sample size), the prefetch depth (the number of chunks that are
+#    read in a background thread while the current chunk is processed) and the number of worker processes;
+# 3. The plan is printed, and at the end of the stage the observed peak memory (of the process and its workers).
+# If 'max_memory_gb' is None, the budget is half of the physical memory. Where the physical memory cannot be read
+# (Windows), the budget is 'default_budget_gb'.
+
+import os                            # For the physical memory.
+import queue                         # For the prefetched chunks.
+import threading                     # For reading chunks in the background.
+
+import instrumentation               # For sampling the memory of the process and its workers.
+import schema                        # For reading the CSV files with the types of their schema.
+from variables import max_memory_gb, instrumentation_sample_interval
+
+sample_rows = 1000                   # Number of rows used to estimate the memory per row.
+default_budget_gb = 4                # Budget if 'max_memory_gb' is None and the physical memory is unknown.
+
+def budget_bytes():
+    # The memory budget in bytes.
+    if max_memory_gb is not None:
+        return int(max_memory_gb * 2 ** 30)
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (AttributeError, ValueError, OSError):  # No os.sysconf (Windows), or no such value.
+        print(f"The physical memory is unknown. Using a memory budget of {default_budget_gb} GB; set 'max_memory_gb' "
+              f"in the variables module to change it.")
+        return default_budget_gb * 2 ** 30
+
+def bytes_per_row(path, **read_csv_kwargs):
+    # Estimate the memory of one row of a CSV file in a DataFrame (with the types of its schema), from its first rows.
+    first_rows = schema.read_table(path, nrows=sample_rows, **read_csv_kwargs)
+    return max(1.0, first_rows.memory_usage(deep=True).sum() / max(1, len(first_rows)))
+
+def make_plan(name, row_bytes, rows=None, workers=1, min_rows=1000):
+    # Make the plan of a stage. 'row_bytes' is the memory per row of the stage (including its copies).
+    # - rows=None (streaming): the largest chunks that fit, with one prefetched chunk if the chunks still have at least
+    #   'min_rows' rows. With prefetching, three chunks can be in memory: the current one, the queued one and the one
+    #   that is being read.
+    # - rows=N (sample): N rows per worker. If they do not fit, the number of workers is reduced first, then the rows.
+    available = max(0, budget_bytes() - instrumentation.read_rss("self"))
+    prefetch = 0
+    if rows is None:
+        workers = 1
+        rows = int(available // (row_bytes * 3))
+        if rows >= min_rows:
+            prefetch = 1
+        else:
+            rows = max(min_rows, int(available // row_bytes))
+    else:
+        while workers > 1 and rows * row_bytes * workers > available:
+            workers -= 1
+        rows = max(min(min_rows, rows), min(rows, int(available // (row_bytes * workers))))
+
+    plan = {
+        "name": name,
+        "budget_mb": round(budget_bytes() / 2 ** 20),
+        "available_mb": round(available / 2 ** 20),
+        "bytes_per_row": round(row_bytes),
+        "rows": rows,
+        "prefetch": prefetch,
+        "workers": workers
+    }
+    print(f"Memory plan ({name}): budget {plan['budget_mb']} MB, {plan['available_mb']} MB available, "
+          f"{plan['bytes_per_row']} bytes per row -> {rows} rows, prefetch {prefetch}, {workers} worker(s).")
+    if rows * row_bytes * workers > available:
+        print(f"Warning: the memory budget is too small for {name}; the minimum of {rows} rows is used.")
+    plan["samples"], plan["stop"] = instrumentation.start_sampler(instrumentation_sample_interval)
+    return plan
+
+def read_chunks(path, plan, **read_csv_kwargs):
+    # Read a CSV file in chunks of the planned size, with the types of its schema (see 'schema'). With prefetching, the
+    # next chunk is read in a background thread while the current chunk is processed (the C parser of pandas releases
+    # the GIL while reading).
+    reader = schema.read_table(path, chunksize=plan["rows"], **read_csv_kwargs)
+    if not plan["prefetch"]:
+        yield from reader
+        return
+
+    chunks = queue.Queue(maxsize=plan["prefetch"])
+    stop = threading.Event()
+
+    def put(item):
+        # Wait until there is room in the queue, unless the chunks are no longer read.
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in reader:
+                if not put(chunk):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+def report(plan):
+    # Print the observed peak memory since the plan was made (the process and the workers it started).
+    peak_mb = round(plan["stop"]()["peak_rss"] / 2 ** 20)
+    print(f"Memory ({plan['name']}): observed peak {peak_mb} MB of {plan['budget_mb']} MB budget.")
+    return peak_mb
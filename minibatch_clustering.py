@@ -0,0 +1,152 @@
+# This module is an alternative clustering engine for large datasets. Instead of loading the full PCA output into RAM
+# and fitting K-Means on all rows at once, it:
+# 1. Converts data_after_pca.csv once to a binary (.npy) matrix that is memory-mapped, so only the rows that are used
+#    are loaded into RAM;
+# 2. Fits Mini-Batch K-Means on batches from this matrix, and stops early when the (smoothed) batch inertia no longer
+#    improves or the centroids no longer move;
+# 3. Labels all rows in chunks.
+# The engine is selected through 'clustering_engine' in the variables module.
+
+import os                                                    # For replacing the matrix when it is complete.
+import numpy as np                                           # For the memory-mapped matrix.
+import pandas as pd                                          # For reading and writing CSV files in chunks.
+from sklearn.cluster import KMeans, MiniBatchKMeans          # For clustering.
+from sklearn.cluster import kmeans_plusplus                  # For initializing the centroids.
+from sklearn.metrics import adjusted_rand_score              # For comparing the labels with full K-Means.
+from pathlib import Path                                     # For handling file paths.
+import schema                                                # For the types of the CSV files.
+from variables import (
+    csv_folder,
+    clustering_random_state,
+    minibatch_batch_size,
+    minibatch_max_epochs,
+    minibatch_max_no_improvement,
+    minibatch_tol,
+    minibatch_init_size,
+    minibatch_chunk_size
+)
+
+# Set directories.
+csv_folder = Path(csv_folder)
+input_path = csv_folder / "data_after_pca.csv"
+matrix_path = csv_folder / "data_after_pca.npy"
+output_path = csv_folder / "data_with_clusters.csv"
+
+def count_rows(path):
+    # Count the data rows of a CSV file without parsing it. The PCA output only contains numbers, so every line
+    # break is the end of a row.
+    rows = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            rows += block.count(b"\n")
+    return rows - 1  # Header.
+
+def load_pca_matrix():
+    # Return the PCA components as a memory-mapped matrix. The matrix is (re)created from the CSV if it does not exist
+    # yet or if the CSV is newer. It is written to a temporary file that replaces the matrix when it is complete, so an
+    # interrupted conversion does not leave a partly filled matrix that is newer than the CSV.
+    if not matrix_path.exists() or matrix_path.stat().st_mtime < input_path.stat().st_mtime:
+        columns = schema.read_table(input_path, nrows=0).columns
+        pca_cols = [c for c in columns if c.startswith("pca_")]
+        n_rows = count_rows(input_path)
+
+        temporary_path = matrix_path.with_suffix(".npy.tmp")
+        matrix = np.lib.format.open_memmap(
+            temporary_path, mode="w+", dtype=np.float32, shape=(n_rows, len(pca_cols))
+        )
+        start = 0
+        for chunk in schema.read_table(input_path, usecols=pca_cols, chunksize=minibatch_chunk_size):
+            matrix[start:start + len(chunk)] = chunk[pca_cols].to_numpy(dtype=np.float32)
+            start += len(chunk)
+        matrix.flush()
+        del matrix
+        os.replace(temporary_path, matrix_path)
+        print(f"Saved: data_after_pca.npy ({n_rows}, {len(pca_cols)})")
+
+    return np.load(matrix_path, mmap_mode="r")
+
+def fit(X, k):
+    # Fit Mini-Batch K-Means on the (memory-mapped) matrix X. Every epoch visits all rows once. The rows are read in
+    # small contiguous blocks (fast to read from disk), and every batch combines blocks from random positions in the
+    # file. Batches of only contiguous rows would contain articles from only one or a few source files.
+    rng = np.random.default_rng(clustering_random_state)
+    n_rows = X.shape[0]
+    batch_size = min(minibatch_batch_size, n_rows)
+    block_size = 256
+    blocks_per_batch = max(1, batch_size // block_size)
+    block_starts = np.arange(0, n_rows, block_size)
+
+    # Initialize the centroids with k-means++ on a random sample.
+    init_rows = np.sort(rng.choice(n_rows, size=min(minibatch_init_size, n_rows), replace=False))
+    init_centers, _ = kmeans_plusplus(np.asarray(X[init_rows], dtype=np.float64), n_clusters=k,
+                                      random_state=clustering_random_state)
+    model = MiniBatchKMeans(n_clusters=k, init=init_centers, n_init=1, batch_size=batch_size,
+                            random_state=clustering_random_state)
+
+    # Early stopping, based on the exponentially weighted average (EWA) of the inertia per row of the batches.
+    alpha = min(1.0, batch_size * 2.0 / (n_rows + 1))
+    ewa_inertia = None
+    best_ewa_inertia = np.inf
+    no_improvement = 0
+    n_batches = 0
+
+    for epoch in range(minibatch_max_epochs):
+        shuffled_blocks = rng.permutation(block_starts)
+        for i in range(0, len(shuffled_blocks), blocks_per_batch):
+            batch = np.concatenate([
+                np.asarray(X[start:start + block_size], dtype=np.float64)
+                for start in np.sort(shuffled_blocks[i:i + blocks_per_batch])
+            ])
+            old_centers = None if n_batches == 0 else model.cluster_centers_.copy()
+            model.partial_fit(batch)
+            n_batches += 1
+
+            batch_inertia = -model.score(batch) / len(batch)
+            ewa_inertia = batch_inertia if ewa_inertia is None else ewa_inertia * (1 - alpha) + batch_inertia * alpha
+            if ewa_inertia < best_ewa_inertia:
+                best_ewa_inertia = ewa_inertia
+                no_improvement = 0
+            else:
+                no_improvement += 1
+
+            centers_converged = (
+                minibatch_tol > 0 and old_centers is not None
+                and ((model.cluster_centers_ - old_centers) ** 2).sum() <= minibatch_tol
+            )
+            if no_improvement >= minibatch_max_no_improvement or centers_converged:
+                print(f"Mini-Batch K-Means converged after {n_batches} batches (epoch {epoch + 1}).")
+                return model
+
+    print(f"Mini-Batch K-Means stopped after {minibatch_max_epochs} epochs ({n_batches} batches).")
+    return model
+
+def predict(X, model):
+    # Label all rows of X in chunks.
+    labels = np.empty(X.shape[0], dtype=np.int32)
+    for start in range(0, X.shape[0], minibatch_chunk_size):
+        labels[start:start + minibatch_chunk_size] = model.predict(
+            np.asarray(X[start:start + minibatch_chunk_size], dtype=np.float64)
+        )
+    return labels
+
+def save_labels(labels):
+    # Write data_with_clusters.csv in chunks: the PCA output with an extra 'Cluster' column. Clusters start at 1.
+    # Returns the PMIDs, for the final checks.
+    start = 0
+    pmids = []
+    for i, chunk in enumerate(schema.read_table(input_path, chunksize=minibatch_chunk_size)):
+        chunk["Cluster"] = labels[start:start + len(chunk)] + 1
+        schema.write_table(chunk, output_path, mode="w" if i == 0 else "a", header=i == 0)
+        pmids.append(chunk["PMID"])
+        start += len(chunk)
+    print(f"Saved: data_with_clusters ({start}, {len(chunk.columns)})")
+    return pd.concat(pmids, ignore_index=True)
+
+def compare_with_kmeans(X_sample, model):
+    # Compare the Mini-Batch labels with the labels of full K-Means on the same sample (adjusted Rand index). An ARI
+    # of 1 means that both engines put the articles in exactly the same clusters.
+    X_sample = np.asarray(X_sample, dtype=np.float64)
+    kmeans = KMeans(n_clusters=model.n_clusters, random_state=clustering_random_state, n_init="auto")
+    ari = adjusted_rand_score(kmeans.fit_predict(X_sample), model.predict(X_sample))
+    print(f"Label agreement Mini-Batch K-Means vs. K-Means on the sample (ARI): {ari:.4f}")
+    return ari
@@ -0,0 +1,174 @@
+# This module finds near-duplicate articles (e.g. errata, republished abstracts and versioned records) in the cleaned
+# ('title' + 'abstract') texts, with MinHash and locality-sensitive hashing (LSH). The texts are read in chunks (sized
+# by the memory budget, see 'memory_budget'):
+# 1. Every text is split into shingles: its word N-grams ('near_duplicate_shingle_size' words), hashed to integers;
+# 2. The MinHash signature of a text is the minimum of 'near_duplicate_num_perm' random hash functions over its
+#    shingles. Two signatures have the same value at a position with a probability equal to the Jaccard similarity of
+#    the shingles of both texts;
+# 3. The signature is split into 'near_duplicate_bands' bands. Two texts with the same values in a band are a
+#    candidate pair. Every band keeps a dictionary of the first text per band value, so each text is only compared
+#    with one text per band, and the time grows linearly with the number of articles;
+# 4. The candidate pairs with an estimated Jaccard similarity (share of equal signature values) of at least
+#    'near_duplicate_threshold' are near-duplicates. Connected near-duplicates form a group.
+# The groups are saved to near_duplicates.csv: every article of a group with the canonical PMID of the group (the
+# lowest PMID, usually the original record). If 'skip_near_duplicates' is True, the feature stages, PCA and clustering
+# only use the canonical article of a group. Texts with fewer words than the shingle size are never near-duplicates.
+# If 'skip_near_duplicates' is False, nothing uses the groups, so the stage does nothing.
+
+import time                                                  # For the duration of the stage.
+import numpy as np                                           # For the signatures.
+import pandas as pd                                          # For reading the texts and saving the groups.
+from pathlib import Path                                     # For handling file paths.
+from scipy.sparse import coo_matrix                          # For the graph of near-duplicate pairs.
+from scipy.sparse.csgraph import connected_components        # For the groups.
+from sklearn.feature_extraction.text import HashingVectorizer  # For hashing the shingles.
+
+import memory_budget                                         # For sizing the chunks to the memory budget.
+import schema                                                # For reading and saving the groups.
+from variables import (
+    csv_folder,
+    near_duplicate_threshold,
+    near_duplicate_shingle_size,
+    near_duplicate_num_perm,
+    near_duplicate_bands,
+    near_duplicate_random_state,
+    skip_near_duplicates
+)
+
+# Set directories.
+csv_folder = Path(csv_folder)
+input_path = csv_folder / "articles_title_plus_abstract_lower_case.csv"
+output_filename = "near_duplicates.csv"
+
+# The hash functions of the signature are (a * x + b) mod p, with p the prime 2^31 - 1 and shingle hashes x < p.
+prime = 2 ** 31 - 1
+perms_per_block = 16                 # Number of hash functions that are applied to the shingles of a chunk at once.
+
+# Number of copies of a text row in memory: the text, its shingles and a block of hash values per shingle.
+row_copies = 20
+
+def skipped_pmids(folder):
+    # The PMIDs that the later stages skip if 'skip_near_duplicates' is True: all articles of a group except the
+    # canonical one.
+    path = Path(folder) / output_filename
+    if not skip_near_duplicates:
+        return set()
+    if not path.exists():
+        raise FileNotFoundError(f"{output_filename} does not exist. Run near_duplicates first, or set "
+                                f"'skip_near_duplicates' to False.")
+    groups = schema.read_table(path)
+    return set(groups.loc[groups["PMID"] != groups["CanonicalPMID"], "PMID"])
+
+def hash_functions():
+    # The parameters a and b of the hash functions of the signature.
+    rng = np.random.default_rng(near_duplicate_random_state)
+    a = rng.integers(1, prime, size=near_duplicate_num_perm, dtype=np.uint64)
+    b = rng.integers(0, prime, size=near_duplicate_num_perm, dtype=np.uint64)
+    return a, b
+
+def minhash_signatures(texts, vectorizer, a, b):
+    # The MinHash signatures of the texts (one row per text), and whether a text has shingles at all.
+    shingles = vectorizer.transform(texts)
+    has_shingles = np.diff(shingles.indptr) > 0
+    signatures = np.full((len(texts), len(a)), prime, dtype=np.uint32)
+    if not has_shingles.any():
+        return signatures, has_shingles
+
+    # The shingles of a text are consecutive in the sparse matrix, so the minimum per text is a 'reduceat' over the
+    # start positions of the texts with shingles.
+    x = shingles.indices.astype(np.uint64)[:, None]
+    starts = shingles.indptr[:-1][has_shingles]
+    for block in range(0, len(a), perms_per_block):
+        values = (x * a[None, block:block + perms_per_block] + b[None, block:block + perms_per_block]) % prime
+        signatures[has_shingles, block:block + perms_per_block] = np.minimum.reduceat(values, starts, axis=0)
+    return signatures, has_shingles
+
+def band_keys(signatures):
+    # One 64-bit hash per text and band, of the signature values in the band.
+    rows_per_band = signatures.shape[1] // near_duplicate_bands
+    return np.column_stack([
+        pd.util.hash_pandas_object(
+            pd.DataFrame(signatures[:, band * rows_per_band:(band + 1) * rows_per_band]), index=False
+        ).to_numpy()
+        for band in range(near_duplicate_bands)
+    ])
+
+def find_groups(chunks):
+    # Find the near-duplicate groups in the chunks of (PMID, text). Returns a DataFrame with the PMID and canonical
+    # PMID of every article in a group, and the number of articles and candidate pairs.
+    vectorizer = HashingVectorizer(
+        analyzer="word",
+        ngram_range=(near_duplicate_shingle_size, near_duplicate_shingle_size),
+        lowercase=False,
+        n_features=prime,
+        alternate_sign=False,
+        norm=None,
+        binary=True
+    )
+    a, b = hash_functions()
+    buckets = [{} for _ in range(near_duplicate_bands)]
+    pmids, signatures, candidates = [], [], []
+    n_rows = 0
+
+    for chunk in chunks:
+        chunk_signatures, has_shingles = minhash_signatures(chunk["Title_plus_abstract"].fillna(""), vectorizer, a, b)
+        keys = band_keys(chunk_signatures)
+        for row in np.flatnonzero(has_shingles):
+            for band, bucket in enumerate(buckets):
+                first = bucket.setdefault(keys[row, band], n_rows + row)
+                if first != n_rows + row:
+                    candidates.append((first, n_rows + row))
+        pmids.append(chunk["PMID"].to_numpy())
+        signatures.append(chunk_signatures)
+        n_rows += len(chunk)
+
+    # Keep the candidate pairs with an estimated Jaccard similarity of at least the threshold.
+    pmids = np.concatenate(pmids) if pmids else np.array([], dtype=np.int64)
+    signatures = np.concatenate(signatures) if signatures else np.empty((0, near_duplicate_num_perm), np.uint32)
+    pairs = np.unique(np.array(candidates, dtype=np.int64).reshape(-1, 2), axis=0)
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[similarity >= near_duplicate_threshold]
+
+    # Connected near-duplicates form a group. The canonical PMID is the lowest PMID of the group.
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_rows, n_rows))
+    _, labels = connected_components(graph, directed=False)
+    members = np.unique(pairs)
+    groups = pd.DataFrame({"PMID": pmids[members], "Group": labels[members]})
+    groups["CanonicalPMID"] = groups.groupby("Group")["PMID"].transform("min")
+    groups = groups.sort_values(["CanonicalPMID", "PMID"])[["PMID", "CanonicalPMID"]]
+    return groups, n_rows, len(candidates)
+
+def main():
+    start = time.perf_counter()
+    if not skip_near_duplicates:
+        print("'skip_near_duplicates' is False: near-duplicates are not searched. Set it to True to skip them in the "
+              "feature stages, PCA and clustering.")
+        return
+    if near_duplicate_num_perm % near_duplicate_bands:
+        raise ValueError("'near_duplicate_num_perm' must be a multiple of 'near_duplicate_bands'.")
+
+    plan = memory_budget.make_plan("Near-duplicates", memory_budget.bytes_per_row(input_path) * row_copies)
+    groups, n_rows, n_candidates = find_groups(
+        memory_budget.read_chunks(input_path, plan, usecols=["PMID", "Title_plus_abstract"])
+    )
+    schema.write_table(groups, csv_folder / output_filename)
+    memory_budget.report(plan)
+
+    # Print statements. The feature stages, PCA and clustering process one row per article, so their work decreases
+    # (about) in proportion to the skipped rows.
+    duplicates = int((groups["PMID"] != groups["CanonicalPMID"]).sum())
+    share = duplicates / n_rows if n_rows else 0
+    print(f"\nSaved: {output_filename} ({time.perf_counter() - start:.1f} s)")
+    print(f"Articles: {n_rows}")
+    print(f"Candidate pairs (LSH): {n_candidates}")
+    print(f"Near-duplicate groups: {groups['CanonicalPMID'].nunique()} ({len(groups)} articles)")
+    print(f"Rows that can be skipped (all but the canonical article of a group): {duplicates} ({share:.2%})")
+    combined_path = csv_folder / "data_combined_before_PCA.csv"
+    if combined_path.exists():
+        n_columns = len(schema.read_table(combined_path, nrows=0).columns)
+        print(f"Cells of the combined feature matrix that can be skipped: {duplicates * n_columns} "
+              f"({duplicates} rows x {n_columns} columns)")
+    print(f"Skipped by the feature stages, PCA and clustering: {duplicates} rows, about {share:.2%} of their work.")
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,34 @@
 # Apply PCA to the combined feature matrix consisting of Keywords, MeSH-terms Chemicals, and
-# TF-IDF data created based on titles and abstracts. Because of RAM-overlad this is done in chunks.
+# TF-IDF data created based on titles and abstracts. Because of RAM-overlad this is done in chunks. The chunk size is
+# set by the memory budget (see 'memory_budget'). The passes over the data save checkpoints (see 'checkpoints'), so an
+# interrupted run continues from its last checkpoint, with the same results.
 
+import os
 import pandas as pd
 import numpy as np
 from sklearn.decomposition import IncrementalPCA
 from sklearn.preprocessing import StandardScaler
 import matplotlib.pyplot as plt
 from pathlib import Path
+import joblib
+import checkpoints
+import memory_budget
+import schema
 from variables import csv_folder
 
 # Set directories.
 csv_folder = Path(csv_folder)
 input_path = csv_folder / "data_combined_before_PCA.csv"
 output_path = csv_folder / "data_after_pca.csv"
+partial_output_path = csv_folder / "data_after_pca.csv.partial"
+models_folder = csv_folder / "models"
+checkpoint_path = checkpoints.checkpoint_path(csv_folder, "perform_PCA")
 
-def main():
-    # Chunk size.
-    chunk_size = 100000
-
-    # Load metadata separately.
-    meta_df = pd.read_csv(input_path, sep="~", usecols=["PMID", "SourceFile"])
-
-    # First chunk for column names and plotting.
-    first_chunk = pd.read_csv(input_path, sep="~", nrows=chunk_size)
-    columns_to_drop = ["PMID", "SourceFile"]
-    feature_cols = [col for col in first_chunk.columns if col not in columns_to_drop]
-
-    # Prepare scaler and PCA
-    scaler = StandardScaler()
-    ipca = IncrementalPCA()
-
-    # First pass: fit scaler and PCA incrementally
-    reader = pd.read_csv(input_path, sep="~", chunksize=chunk_size)
-    for i, chunk in enumerate(reader):
-        data = chunk[feature_cols]
-        scaled = scaler.partial_fit(data) if i == 0 else scaler.partial_fit(data)
+# Number of copies of a chunk in memory: the chunk itself, its scaled version and the copies made by IncrementalPCA.
+chunk_copies = 4
 
-    reader = pd.read_csv(input_path, sep="~", chunksize=chunk_size)
-    for chunk in reader:
-        scaled_chunk = scaler.transform(chunk[feature_cols])
-        ipca.partial_fit(scaled_chunk)
-
-    # Extract explained variance
+def choose_components(ipca):
+    # Plot the explained variance of the components and ask the user how many components to keep.
     explained = ipca.explained_variance_ratio_
     cumulative = np.cumsum(explained)
 
@@ -62,30 +49,88 @@ def main():
     plt.show()
 
     # Prompt user for component count
-    chosen = int(input("Input required. Enter number of components to keep: "))
+    return int(input("Input required. Enter number of components to keep: "))
+
+def main():
+    # Column names.
+    columns = schema.read_table(input_path, nrows=0).columns
+    columns_to_drop = ["PMID", "SourceFile"]
+    feature_cols = [col for col in columns if col not in columns_to_drop]
+
+    # Chunk size. IncrementalPCA needs at least as many rows per chunk as there are features.
+    plan = memory_budget.make_plan(
+        "perform_PCA", memory_budget.bytes_per_row(input_path) * chunk_copies, min_rows=len(feature_cols)
+    )
+
+    # Continue from the last checkpoint, or prepare scaler and PCA. A resumed run keeps the chunk size of the
+    # interrupted run, so it processes the same chunks.
+    fingerprint = checkpoints.fingerprint([input_path], {})
+    state = checkpoints.load(checkpoint_path, fingerprint) or {
+        "fingerprint": fingerprint,
+        "rows": plan["rows"],
+        "finished": [],
+        "pass": None,
+        "chunks": 0,
+        "scaler": StandardScaler(),
+        "ipca": IncrementalPCA(),
+        "chosen": None,
+        "ipca_final": None,
+        "output_bytes": 0,
+        "output_rows": 0
+    }
+    scaler = state["scaler"]
+
+    # First pass: fit scaler and PCA incrementally
+    checkpoints.run_pass(
+        state, "scaler", input_path, plan, lambda chunk: scaler.partial_fit(chunk[feature_cols]), checkpoint_path
+    )
+    checkpoints.run_pass(
+        state, "pca", input_path, plan, lambda chunk: state["ipca"].partial_fit(scaler.transform(chunk[feature_cols])),
+        checkpoint_path
+    )
+
+    # Plot the explained variance and ask for the number of components (once; a resumed run keeps the answer).
+    if state["chosen"] is None:
+        state["chosen"] = choose_components(state["ipca"])
+        state["ipca_final"] = IncrementalPCA(n_components=state["chosen"])
+        checkpoints.save(checkpoint_path, state)
+    chosen = state["chosen"]
+    ipca_final = state["ipca_final"]
 
     # Fit final IncrementalPCA with chosen components
-    ipca_final = IncrementalPCA(n_components=chosen)
-    reader = pd.read_csv(input_path, sep="~", chunksize=chunk_size)
-    pca_results = []
-
-    for chunk in reader:
-        scaled_chunk = scaler.transform(chunk[feature_cols])
-        reduced = ipca_final.partial_fit(scaled_chunk)
-
-    reader = pd.read_csv(input_path, sep="~", chunksize=chunk_size)
-    for chunk in reader:
-        scaled_chunk = scaler.transform(chunk[feature_cols])
-        reduced = ipca_final.transform(scaled_chunk)
-        pca_results.append(pd.DataFrame(reduced, columns=[f"pca_{i + 1}" for i in range(chosen)]))
-
-    # Combine all PCA chunks and metadata
-    pca_df = pd.concat(pca_results, axis=0).reset_index(drop=True)
-    meta_df = meta_df.reset_index(drop=True)
-    pca_df.insert(0, "SourceFile", meta_df["SourceFile"])
-    pca_df.insert(0, "PMID", meta_df["PMID"])
-
-    pca_df.to_csv(output_path, sep="~", index=False)
-    print(f"Saved: data_after_pca ({pca_df.shape})")
+    checkpoints.run_pass(
+        state, "final", input_path, plan, lambda chunk: ipca_final.partial_fit(scaler.transform(chunk[feature_cols])),
+        checkpoint_path
+    )
+
+    # Transform all chunks and append them (with their metadata) to a partial output file, which replaces the output
+    # at the end. A resumed run first removes the rows written after the last checkpoint.
+    pca_columns = [f"pca_{i + 1}" for i in range(chosen)]
+    if state["pass"] != "output" or not (partial_output_path.exists() or "output" in state["finished"]):
+        state.update({"pass": None, "output_bytes": 0, "output_rows": 0})
+    if "output" not in state["finished"]:
+        with open(partial_output_path, "a") as f:
+            f.truncate(state["output_bytes"])
+
+    def transform(chunk):
+        reduced = pd.DataFrame(ipca_final.transform(scaler.transform(chunk[feature_cols])), columns=pca_columns)
+        reduced.insert(0, "SourceFile", chunk["SourceFile"].to_numpy())
+        reduced.insert(0, "PMID", chunk["PMID"].to_numpy())
+        schema.write_table(
+            reduced, partial_output_path, name=output_path.name, mode="a", header=state["output_bytes"] == 0
+        )
+        state["output_bytes"] = partial_output_path.stat().st_size
+        state["output_rows"] += len(reduced)
+
+    checkpoints.run_pass(state, "output", input_path, plan, transform, checkpoint_path)
+    if partial_output_path.exists():
+        os.replace(partial_output_path, output_path)
+    print(f"Saved: data_after_pca ({(state['output_rows'], len(pca_columns) + 2)})")
+
+    # Save the fitted scaler and PCA, so that new articles can be projected later (see 'assign').
+    models_folder.mkdir(exist_ok=True)
+    joblib.dump({"scaler": scaler, "pca": ipca_final, "feature_columns": feature_cols}, models_folder / "pca_model.joblib")
+    checkpoints.remove(checkpoint_path)
+    memory_budget.report(plan)
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
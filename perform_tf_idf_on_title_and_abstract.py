@@ -1,9 +1,16 @@
 # This module creates 2 separate TF-IDF tables for titles and abstracts based on the cleaned lowercase files.
 # The resulting tables are saved as CSVs which include the created features. SourceFile is excluded to reduce RAM-usage.
+# If 'skip_near_duplicates' is True, the near-duplicates (see 'near_duplicates') are left out.
+# If 'tfidf_feature_mode' is "hashing", the features are created with feature hashing instead of fitted vocabularies
+# (see 'hashing_tfidf'): the texts are read and vectorized in chunks, in parallel.
 
 import pandas as pd                                            # For reading and writing CSV files.
 from sklearn.feature_extraction.text import TfidfVectorizer    # For creating TF-IDF tables.
 from pathlib import Path                                       # For file system paths.
+import joblib                                                  # For saving the fitted vectorizers.
+import near_duplicates                                         # For the near-duplicates that are skipped.
+import hashing_tfidf                                           # For the hashing feature mode.
+import schema                                                  # For reading and writing the CSVs with their types.
 
 from variables import (
     csv_folder,
@@ -13,20 +20,40 @@ from variables import (
     abstract_max_features,
     abstract_ngram_range,
     min_df_clustering,
-    max_df_clustering
+    max_df_clustering,
+    tfidf_feature_mode
 )
 
-# Set directory.
+# Set directories. The fitted vectorizers are saved, so that new articles can be transformed later (see 'assign').
 csv_folder = Path(csv_folder)
+models_folder = csv_folder / "models"
 
 def main():
-    # Fill missing text entries with empty strings.
+    models_folder.mkdir(exist_ok=True)
+
+    skipped = near_duplicates.skipped_pmids(csv_folder)
+
+    # Hashing mode: the same tables and model files, and per table the most frequent n-grams of every column.
+    if tfidf_feature_mode == "hashing":
+        for column, prefix, ngram_range in [("Title", "title", title_ngram_range),
+                                            ("Abstract", "abstract", abstract_ngram_range)]:
+            features, model, counts = hashing_tfidf.hash_file(
+                csv_folder / f"articles_{prefix}_lower_case.csv", column, f"{prefix}__", ngram_range, skipped
+            )
+            schema.write_table(features, csv_folder / f"tfidf_{prefix}.csv")
+            print(f"Saved: tfidf_{prefix}.csv ({features.shape})")
+            joblib.dump(model, models_folder / f"tfidf_{prefix}.joblib")
+            hashing_tfidf.save_bucket_terms(counts, f"{prefix}__", models_folder / f"tfidf_{prefix}_buckets.json")
+        return
+
+    # Leave out the skipped near-duplicates and fill missing text entries with empty strings.
     def clean_column(df, column_name):
+        df = df[~df["PMID"].isin(skipped)].reset_index(drop=True)
         df[column_name] = df[column_name].fillna("")
         return df
 
     # Load and process title data.
-    title_df = pd.read_csv(csv_folder / "articles_title_lower_case.csv", sep="~")
+    title_df = schema.read_table(csv_folder / "articles_title_lower_case.csv")
     title_df = clean_column(title_df, "Title")
 
     # Create TF-IDF table for title. Use variables as set in variables module.
@@ -39,16 +66,17 @@ def main():
     )
     X_title = tfidf_title.fit_transform(title_df["Title"])
 
-    # Store title TF-IDF output.
+    # Store title TF-IDF output (as 32-bit floats, see 'schema').
     title_features = pd.DataFrame.sparse.from_spmatrix(
-        X_title, columns=[f"title__{t}" for t in tfidf_title.get_feature_names_out()]
+        X_title.astype("float32"), columns=[f"title__{t}" for t in tfidf_title.get_feature_names_out()]
     )
     title_features["PMID"] = title_df["PMID"]
-    title_features.to_csv(csv_folder / "tfidf_title.csv", sep="~", index=False)
+    schema.write_table(title_features, csv_folder / "tfidf_title.csv")
     print(f"Saved: tfidf_title.csv ({title_features.shape})")
+    joblib.dump(tfidf_title, models_folder / "tfidf_title.joblib")
 
     # Load and process abstract data.
-    abstract_df = pd.read_csv(csv_folder / "articles_abstract_lower_case.csv", sep="~")
+    abstract_df = schema.read_table(csv_folder / "articles_abstract_lower_case.csv")
     abstract_df = clean_column(abstract_df, "Abstract")
 
     # Create TF-IDF table for abstract. Use variables as set in variables module.
@@ -61,12 +89,13 @@ def main():
     )
     X_abstract = tfidf_abstract.fit_transform(abstract_df["Abstract"])
 
-    # Store abstract TF-IDF output.
+    # Store abstract TF-IDF output (as 32-bit floats, see 'schema').
     abstract_features = pd.DataFrame.sparse.from_spmatrix(
-        X_abstract, columns=[f"abstract__{t}" for t in tfidf_abstract.get_feature_names_out()]
+        X_abstract.astype("float32"), columns=[f"abstract__{t}" for t in tfidf_abstract.get_feature_names_out()]
     )
     abstract_features["PMID"] = abstract_df["PMID"]
-    abstract_features.to_csv(csv_folder / "tfidf_abstract.csv", sep="~", index=False)
+    schema.write_table(abstract_features, csv_folder / "tfidf_abstract.csv")
     print(f"Saved: tfidf_abstract.csv ({abstract_features.shape})")
+    joblib.dump(tfidf_abstract, models_folder / "tfidf_abstract.joblib")
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,16 @@
 # This module creates a TF-IDF table based on the cleaned title and abstract tables.
-# It processes the data in chunks to avoid RAM-overload. All data is combined into a single table.
+# It processes the data in chunks to avoid RAM-overload. The number of rows used to fit the vectorizer and the chunk
+# size are set by the memory budget (see 'memory_budget'). All data is combined into a single table.
 # The SourceFile column is excluded to reduce memory usage.
 
 import pandas as pd                                             # For reading and writing CSV files.
 from sklearn.feature_extraction.text import TfidfVectorizer     # For creating the TF-IDF matrix.
 from pathlib import Path                                        # For working with file paths.
 import csv                                                      # For controlling CSV output quoting.
+import joblib                                                   # For saving the fitted vectorizer.
+import shutil                                                   # For copying part 2 into the final output.
+import memory_budget                                            # For sizing the chunks to the memory budget.
+import schema                                                   # For reading and writing the CSVs with their types.
 
 from variables import (
     csv_folder,
@@ -23,10 +28,20 @@ input_path = csv_folder / "articles_title_plus_abstract_lower_case.csv"
 output_path_1 = csv_folder / "tfidf_title_plus_abstract_part1.csv"
 output_path_2 = csv_folder / "tfidf_title_plus_abstract_part2.csv"
 final_output_path = csv_folder / "tfidf_title_plus_abstract.csv"
+models_folder = csv_folder / "models"
+
+# Number of copies of a row in memory while fitting the vectorizer (all n-grams of a text are counted before the
+# vocabulary is pruned), and while transforming a chunk (the text, the TF-IDF values and the CSV output).
+fit_copies = 10
+transform_copies = 3
 
 def main():
-    # Load the first chunk of rows to fit the TF-IDF vocabulary.
-    part1_df = pd.read_csv(input_path, sep="~", nrows=tfidf_chunk_size)
+    # Load the first chunk of rows to fit the TF-IDF vocabulary. This is 'tfidf_chunk_size' rows, or fewer if they do
+    # not fit in the memory budget.
+    text_bytes = memory_budget.bytes_per_row(input_path)
+    fit_plan = memory_budget.make_plan("TF-IDF fit", text_bytes * fit_copies, rows=tfidf_chunk_size)
+    fit_rows = fit_plan["rows"]
+    part1_df = schema.read_table(input_path, nrows=fit_rows)
     part1_df["Title_plus_abstract"] = part1_df["Title_plus_abstract"].fillna("")
 
     # Fit the TF-IDF vectorizer on the initial chunk.
@@ -39,47 +54,45 @@ def main():
     )
     X_part1 = vectorizer.fit_transform(part1_df["Title_plus_abstract"])
 
-    # Transform TF-IDF for part 1 and place PMID as first column
+    # Save the fitted vectorizer, so that updated articles can be transformed later (see 'delta_update').
+    models_folder.mkdir(exist_ok=True)
+    joblib.dump(vectorizer, models_folder / "tfidf_title_plus_abstract.joblib")
+
+    # Transform TF-IDF for part 1 (as 32-bit floats, see 'schema') and place PMID as first column
     features_part1 = pd.DataFrame.sparse.from_spmatrix(
-        X_part1, columns=[f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()]
+        X_part1.astype("float32"), columns=[f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()]
     )
     features_part1.insert(0, "PMID", part1_df["PMID"])  # Ensure PMID is first column
-    features_part1.to_csv(output_path_1, sep="~", index=False)
+    schema.write_table(features_part1, output_path_1)
     print(f"Saved: part 1 ({features_part1.shape})")
-    features_part1.iloc[0:0].to_csv(output_path_2, sep="~", index=False)
-
-    # Prepare column names for consistent chunked reading.
-    column_names = pd.read_csv(input_path, sep="~", nrows=0).columns.tolist()
-
+    schema.write_table(features_part1.iloc[0:0], output_path_2)
+    memory_budget.report(fit_plan)
+    del part1_df, X_part1, features_part1
 
     # Now that part 1 has been created, the remaining data is processed in chunks and appended.
-    print(f"Processing remaining rows in chunks of {tfidf_chunk_size}")
-    chunk_generator = pd.read_csv(
-        input_path,
-        sep="~",
-        skiprows=range(1, tfidf_chunk_size + 1),
-        header=0,
-        chunksize=tfidf_chunk_size
-    )
+    plan = memory_budget.make_plan("TF-IDF transform", text_bytes * transform_copies)
+    print(f"Processing remaining rows in chunks of {plan['rows']}")
+    chunk_generator = memory_budget.read_chunks(input_path, plan, skiprows=range(1, fit_rows + 1), header=0)
 
     first_chunk = True
     for chunk in chunk_generator:
+        if chunk.empty:  # All rows fit in part 1.
+            continue
         chunk["Title_plus_abstract"] = chunk["Title_plus_abstract"].fillna("")
 
         # Transform chunk using the fitted vectorizer
         X_chunk = vectorizer.transform(chunk["Title_plus_abstract"])
         df_chunk = pd.DataFrame.sparse.from_spmatrix(
-            X_chunk, columns=[f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()]
+            X_chunk.astype("float32"), columns=[f"title_abstract__{t}" for t in vectorizer.get_feature_names_out()]
         )
 
         # Correctly insert PMID from chunk (from original source!)
         df_chunk.insert(0, "PMID", chunk["PMID"].values)
 
-        df_chunk.to_csv(
+        schema.write_table(
+            df_chunk,
             output_path_2,
-            sep="~",
             mode="w" if first_chunk else "a",
-            index=False,
             header=first_chunk,
             quoting=csv.QUOTE_MINIMAL
         )
@@ -89,40 +102,40 @@ def main():
 
     print(f"All chunks saved to: {output_path_2}")
 
-    # Combine both parts into the final TF-IDF output.
-    part2_df = pd.read_csv(output_path_2, sep="~")
-    combined_df = pd.concat([features_part1, part2_df], axis=0).reset_index(drop=True)
-
-    # Ensure PMID is the first column
-    pmid = combined_df.pop("PMID")
-    combined_df.insert(0, "PMID", pmid)
-
-    combined_df.to_csv(final_output_path, sep="~", index=False)
+    # Combine both parts into the final TF-IDF output. Both parts have the same columns (PMID first), so the rows of
+    # part 2 are copied after part 1 without loading them.
+    with open(final_output_path, "wb") as target:
+        for path in [output_path_1, output_path_2]:
+            with open(path, "rb") as source:
+                if path == output_path_2:
+                    source.readline()  # Header.
+                shutil.copyfileobj(source, target, 2 ** 24)
 
-    print(f"Combined TF-IDF saved ({combined_df.shape})")
+    print(f"Combined TF-IDF saved: {final_output_path}")
 
     # Check tfidf_title_plus_abstract_part1.csv
-    part1 = pd.read_csv(csv_folder / "tfidf_title_plus_abstract_part1.csv", sep="~", nrows=0)
+    part1 = schema.read_table(csv_folder / "tfidf_title_plus_abstract_part1.csv", nrows=0)
     print(f"\ntfidf_title_plus_abstract_part1.csv")
     print(f"Columns: {len(part1.columns)}")
     print(f"First column: {part1.columns[0]}")
 
     # Check tfidf_title_plus_abstract_part2.csv
-    part2 = pd.read_csv(csv_folder / "tfidf_title_plus_abstract_part2.csv", sep="~", nrows=0)
+    part2 = schema.read_table(csv_folder / "tfidf_title_plus_abstract_part2.csv", nrows=0)
     print("\ntfidf_title_plus_abstract_part2.csv")
     print(f"Columns: {len(part2.columns)}")
     print(f"First column: {part2.columns[0]}")
 
     # Check tfidf_title_plus_abstract.csv
-    final = pd.read_csv(csv_folder / "tfidf_title_plus_abstract.csv", sep="~", nrows=0)
+    final = schema.read_table(csv_folder / "tfidf_title_plus_abstract.csv", nrows=0)
     print("\ntfidf_title_plus_abstract.csv")
     print(f"Columns: {len(final.columns)}")
     print(f"First column: {final.columns[0]}")
 
     # Check if the number of rows matches between input and final TF-IDF file
-    input_rows = pd.read_csv(input_path, sep="~").shape[0]
-    final_rows = pd.read_csv(csv_folder / "tfidf_title_plus_abstract.csv", sep="~").shape[0]
+    input_rows = sum(len(chunk) for chunk in memory_budget.read_chunks(input_path, plan, usecols=["PMID"]))
+    final_rows = sum(len(chunk) for chunk in memory_budget.read_chunks(final_output_path, plan, usecols=["PMID"]))
     print(f"\nInput rows: {input_rows}")
     print(f"TF-IDF output rows: {final_rows}")
+    memory_budget.report(plan)
 if __name__ == "__main__":
     main()
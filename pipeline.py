@@ -0,0 +1,460 @@
+# This module runs the pipeline as a graph of stages (DAG). For every stage, its inputs, outputs, settings in
+# 'variables' and the stages it depends on are declared below. Before a stage runs, a fingerprint is calculated from:
+# - the content (SHA-256) of its input files;
+# - the values of its settings in 'variables';
+# - the source code of the module and of the local modules it imports.
+# If the fingerprint is equal to that of the last run, and the output files still have the content of the last run,
+# the stage is up to date and is skipped. The fingerprints are stored in '.pipeline_state.json' in the destination
+# folder. To avoid reading large files again, the hash of a file is reused as long as its size and modification time
+# have not changed.
+# Stages of which all dependencies are finished run concurrently in worker processes (e.g. the two TF-IDF modules and
+# 'transform_categorical_to_binary'). Interactive stages (which show charts and ask for input) run in the main process.
+#
+# Usage:
+#   python -m pipeline                        Run all stages that are not up to date.
+#   python -m pipeline --from clustering      Run 'clustering' (always) and the stages after it that are not up to
+#                                             date.
+#   python -m pipeline --until perform_PCA    Run 'perform_PCA' and the stages before it that are not up to date.
+#   python -m pipeline --force                Run all stages, also when they are up to date.
+#   python -m pipeline --profile cprofile     Profile the stages (see 'instrumentation'), optionally only the stages
+#                                             given with --profile-stages.
+#   python -m pipeline run data_checking      Run one stage (always). The stage modules are imported only when they
+#                                             run, and importing them does no work on the file system, so only the
+#                                             libraries of that stage are loaded.
+# Every stage is measured (time, memory, I/O, articles per second) by 'instrumentation'. The run report is saved to
+# 'run_reports/<start time>' in the destination folder.
+
+import argparse                                              # For the command line options.
+import ast                                                   # For finding the local modules a stage imports.
+import hashlib                                               # For the fingerprints.
+import importlib                                             # For running a stage by name.
+import json                                                  # For the state file.
+import os                                                    # For counting CPU cores and replacing the state file.
+from datetime import datetime                                # For the name of the run report folder.
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait   # For running stages concurrently.
+from pathlib import Path                                     # For handling file paths.
+
+import variables
+import instrumentation                                       # For measuring the stages.
+from variables import pipeline_n_jobs, instrumentation_profiler, instrumentation_profile_stages
+
+module_folder = Path(__file__).resolve().parent
+state_filename = ".pipeline_state.json"
+
+# The stages. Paths start with {dest} (destination_folder) or {csv} (csv_folder), and may contain wildcards. A file that
+# only exists with some settings is declared as (path, setting, value): it is only used (fingerprinted, and required as
+# an output) when the setting has that value. The stages that read files with rows per article also have the tombstones
+# of the daily updates as input (the superseded rows that are left out, see 'schema').
+STAGES = [
+    {
+        "name": "retrieve_data",
+        "inputs": [],
+        "outputs": ["{dest}/*.xml.gz", "{dest}/*.xml.gz.md5", "{dest}/*.xml"],
+        "config": ["base_url", "destination_folder", "first_file", "last_file"],
+        "depends_on": []
+    },
+    {
+        "name": "check_hashes_gz_files",
+        "inputs": ["{dest}/*.xml.gz", "{dest}/*.xml.gz.md5"],
+        "outputs": [],
+        "config": ["destination_folder"],
+        "depends_on": ["retrieve_data"]
+    },
+    {
+        "name": "create_multi_CSV",
+        "inputs": ["{dest}/*.xml"],
+        "outputs": [
+            "{dest}/pubmed_csv_export/articles.csv", "{dest}/pubmed_csv_export/keywords.csv",
+            "{dest}/pubmed_csv_export/mesh_terms.csv", "{dest}/pubmed_csv_export/chemicals.csv",
+            "{dest}/pubmed_csv_export/articles_metadata.json",
+            ("{dest}/pubmed_csv_export/pubmed.sqlite", "use_sqlite_store", True)
+        ],
+        "config": ["destination_folder", "use_sqlite_store"],
+        "depends_on": ["check_hashes_gz_files"]
+    },
+    {
+        "name": "data_checking",
+        "inputs": [
+            "{csv}/articles.csv", "{csv}/keywords.csv", "{csv}/mesh_terms.csv", "{csv}/chemicals.csv",
+            ("{csv}/pubmed.sqlite", "use_sqlite_store", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [],
+        "config": ["destination_folder", "csv_folder", "use_sqlite_store"],
+        "depends_on": ["create_multi_CSV"]
+    },
+    {
+        "name": "descr_stats",
+        "inputs": [
+            "{csv}/articles.csv", "{csv}/keywords.csv", "{csv}/mesh_terms.csv", "{csv}/chemicals.csv",
+            ("{csv}/pubmed.sqlite", "use_sqlite_store", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [],
+        "config": ["csv_folder", "use_sqlite_store"],
+        "depends_on": ["create_multi_CSV"]
+    },
+    {
+        "name": "convert_to_lower_case",
+        "inputs": [
+            "{csv}/articles.csv", "{csv}/keywords.csv", "{csv}/mesh_terms.csv", "{csv}/chemicals.csv",
+            ("{csv}/pubmed.sqlite", "use_sqlite_store", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [
+            "{csv}/articles_title_lower_case.csv", "{csv}/articles_abstract_lower_case.csv",
+            "{csv}/articles_title_plus_abstract_lower_case.csv", "{csv}/keywords_lower_case.csv",
+            "{csv}/mesh_terms_lower_case.csv", "{csv}/chemicals_lower_case.csv"
+        ],
+        "config": ["csv_folder", "use_sqlite_store"],
+        "depends_on": ["create_multi_CSV"]
+    },
+    {
+        "name": "near_duplicates",
+        "inputs": ["{csv}/articles_title_plus_abstract_lower_case.csv", "{csv}/tombstones.csv"],
+        "outputs": [("{csv}/near_duplicates.csv", "skip_near_duplicates", True)],
+        "config": [
+            "csv_folder", "near_duplicate_threshold", "near_duplicate_shingle_size", "near_duplicate_num_perm",
+            "near_duplicate_bands", "near_duplicate_random_state", "skip_near_duplicates", "max_memory_gb"
+        ],
+        "depends_on": ["convert_to_lower_case"]
+    },
+    {
+        "name": "transform_categorical_to_binary",
+        "inputs": [
+            "{csv}/keywords_lower_case.csv", "{csv}/mesh_terms_lower_case.csv", "{csv}/chemicals_lower_case.csv",
+            ("{csv}/near_duplicates.csv", "skip_near_duplicates", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [
+            "{csv}/keywords_transformed.csv", "{csv}/mesh_terms_transformed.csv", "{csv}/chemicals_transformed.csv"
+        ],
+        "config": ["csv_folder", "top_n_keywords", "top_n_mesh", "top_n_chemicals", "skip_near_duplicates"],
+        "depends_on": ["convert_to_lower_case", "near_duplicates"]
+    },
+    {
+        "name": "perform_tf_idf_on_title_and_abstract",
+        "inputs": [
+            "{csv}/articles_title_lower_case.csv", "{csv}/articles_abstract_lower_case.csv",
+            ("{csv}/near_duplicates.csv", "skip_near_duplicates", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [
+            "{csv}/tfidf_title.csv", "{csv}/tfidf_abstract.csv",
+            "{csv}/models/tfidf_title.joblib", "{csv}/models/tfidf_abstract.joblib",
+            ("{csv}/models/tfidf_title_buckets.json", "tfidf_feature_mode", "hashing"),
+            ("{csv}/models/tfidf_abstract_buckets.json", "tfidf_feature_mode", "hashing")
+        ],
+        "config": [
+            "csv_folder", "CUSTOM_DOMAIN_STOPWORDS_TF_IDF", "title_max_features", "title_ngram_range",
+            "abstract_max_features", "abstract_ngram_range", "min_df_clustering", "max_df_clustering",
+            "skip_near_duplicates", "tfidf_feature_mode", "hashing_n_features", "hashing_terms_per_bucket"
+        ],
+        "depends_on": ["convert_to_lower_case", "near_duplicates"]
+    },
+    {
+        "name": "perform_tf_idf_on_title_plus_abstract",
+        "inputs": ["{csv}/articles_title_plus_abstract_lower_case.csv", "{csv}/tombstones.csv"],
+        "outputs": [
+            "{csv}/tfidf_title_plus_abstract.csv", "{csv}/tfidf_title_plus_abstract_part1.csv",
+            "{csv}/tfidf_title_plus_abstract_part2.csv", "{csv}/models/tfidf_title_plus_abstract.joblib"
+        ],
+        "config": [
+            "csv_folder", "CUSTOM_DOMAIN_STOPWORDS_TF_IDF", "title_abstract_max_features",
+            "title_abstract_ngram_range", "min_df_profiling", "max_df_profiling", "tfidf_chunk_size",
+            "max_memory_gb"
+        ],
+        "depends_on": ["convert_to_lower_case"]
+    },
+    {
+        "name": "combine_transformed_data",
+        "inputs": [
+            "{csv}/articles.csv", "{csv}/keywords_transformed.csv", "{csv}/mesh_terms_transformed.csv",
+            "{csv}/chemicals_transformed.csv", "{csv}/tfidf_title.csv", "{csv}/tfidf_abstract.csv",
+            ("{csv}/near_duplicates.csv", "skip_near_duplicates", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": ["{csv}/data_combined_before_PCA.csv"],
+        "config": ["csv_folder", "skip_near_duplicates"],
+        "depends_on": ["transform_categorical_to_binary", "perform_tf_idf_on_title_and_abstract"]
+    },
+    {
+        "name": "perform_PCA",
+        "inputs": ["{csv}/data_combined_before_PCA.csv", "{csv}/tombstones.csv"],
+        "outputs": ["{csv}/data_after_pca.csv", "{csv}/models/pca_model.joblib"],
+        "config": ["csv_folder", "max_memory_gb"],
+        "depends_on": ["combine_transformed_data"],
+        "interactive": True
+    },
+    {
+        "name": "clustering",
+        "inputs": [
+            "{csv}/data_after_pca.csv", "{csv}/models/pca_model.joblib", "{csv}/articles_metadata.json",
+            ("{csv}/near_duplicates.csv", "skip_near_duplicates", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": [
+            "{csv}/data_with_clusters.csv", "{csv}/models/cluster_model.joblib", "{csv}/cluster_plots/clusters_*.png"
+        ],
+        "config": [
+            "csv_folder", "clustering_random_state", "clustering_k_min", "clustering_k_max", "clustering_sample_size",
+            "clustering_warm_start", "clustering_engine", "minibatch_batch_size", "minibatch_max_epochs",
+            "minibatch_max_no_improvement", "minibatch_tol", "minibatch_init_size", "cluster_plot_mode",
+            "cluster_plot_bins", "cluster_plot_sample_size", "quality_check_sample_size", "clustering_sample_method",
+            "max_memory_gb", "skip_near_duplicates"
+        ],
+        "depends_on": ["perform_PCA"],
+        "interactive": True
+    },
+    {
+        "name": "profiling_clusters",
+        "inputs": [
+            "{csv}/data_with_clusters.csv", "{csv}/keywords_lower_case.csv", "{csv}/mesh_terms_lower_case.csv",
+            "{csv}/chemicals_lower_case.csv", "{csv}/tfidf_title_plus_abstract.csv",
+            ("{csv}/pubmed.sqlite", "use_sqlite_store", True), "{csv}/tombstones.csv"
+        ],
+        "outputs": ["{csv}/cluster_profiles/*"],
+        "config": [
+            "csv_folder", "CUSTOM_DOMAIN_STOPWORDS_PROFILING", "profiling_number_of_top_keywords",
+            "profiling_number_of_top_mesh", "profiling_number_of_top_chemicals",
+            "profiling_number_of_top_words_in_title_abstract", "TERM_REPLACEMENTS", "profiling_render_charts",
+            "use_sqlite_store"
+        ],
+        "depends_on": ["clustering", "perform_tf_idf_on_title_plus_abstract"]
+    }
+]
+
+stages_by_name = {stage["name"]: stage for stage in STAGES}
+
+def read_state(path):
+    # Read the state file. Returns an empty state if it does not exist (yet).
+    if not path.exists():
+        return {"files": {}, "stages": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_state(path, state):
+    # Write the state file. It is written to a temporary file first, so an interrupted run cannot leave a broken file.
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_path, path)
+
+def file_hash(path, state):
+    # SHA-256 of the content of a file. The hash is reused while the size and modification time are unchanged.
+    stat = path.stat()
+    cached = state["files"].get(str(path))
+    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    state["files"][str(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+    return sha256.hexdigest()
+
+def expand(pattern):
+    # Replace {dest} and {csv} in a path pattern, and return the matching files (sorted).
+    pattern = pattern.format(dest=Path(variables.destination_folder), csv=Path(variables.csv_folder))
+    path = Path(pattern)
+    if any(char in path.name for char in "*?["):
+        return sorted(p for p in path.parent.glob(path.name) if p.is_file())
+    return [path] if path.is_file() else []
+
+def applicable_patterns(patterns):
+    # The path patterns that apply to the current settings.
+    return [
+        pattern if isinstance(pattern, str) else pattern[0] for pattern in patterns
+        if isinstance(pattern, str) or getattr(variables, pattern[1]) == pattern[2]
+    ]
+
+def pattern_hashes(patterns, state):
+    # Hash per path pattern that applies to the current settings: the hashes of all matching files combined. None if no
+    # file matches.
+    hashes = {}
+    for pattern in applicable_patterns(patterns):
+        files = expand(pattern)
+        if not files:
+            hashes[pattern] = None
+            continue
+        combined = hashlib.sha256()
+        for path in files:
+            combined.update(f"{path.name}:{file_hash(path, state)}\n".encode())
+        hashes[pattern] = combined.hexdigest()
+    return hashes
+
+def config_value(value):
+    # JSON-compatible, order-independent form of a setting (sets are unordered, so they are sorted).
+    if isinstance(value, (set, frozenset)):
+        return sorted(config_value(v) for v in value)
+    if isinstance(value, dict):
+        return {str(k): config_value(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [config_value(v) for v in value]
+    return value
+
+def local_modules(name, found=None):
+    # The module and all local modules it imports (recursively), except 'variables': its settings are fingerprinted
+    # per stage, so that a change in an unrelated setting does not invalidate every stage.
+    found = set() if found is None else found
+    path = module_folder / f"{name}.py"
+    if name in found or name == "variables" or not path.exists():
+        return found
+    found.add(name)
+
+    for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                local_modules(alias.name, found)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            local_modules(node.module, found)
+    return found
+
+def fingerprint(stage, state):
+    # Fingerprint of everything a stage depends on: input files, settings and source code.
+    code = {name: file_hash(module_folder / f"{name}.py", state) for name in sorted(local_modules(stage["name"]))}
+    content = {
+        "inputs": pattern_hashes(stage["inputs"], state),
+        "config": {key: config_value(getattr(variables, key)) for key in stage["config"]},
+        "code": code
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def is_up_to_date(stage, state, stage_fingerprint):
+    # A stage is up to date if it ran with the same fingerprint, and its outputs still exist with the same content.
+    previous = state["stages"].get(stage["name"])
+    if previous is None or previous["fingerprint"] != stage_fingerprint:
+        return False
+    outputs = pattern_hashes(stage["outputs"], state)
+    return None not in outputs.values() and outputs == previous["outputs"]
+
+def ancestors(name):
+    # All stages a stage (indirectly) depends on.
+    result = set()
+    for dependency in stages_by_name[name]["depends_on"]:
+        result |= {dependency} | ancestors(dependency)
+    return result
+
+def select_stages(start=None, until=None):
+    # The stages to run, in the declared order: from 'start' and its descendants, until 'until' and its ancestors.
+    selected = [stage["name"] for stage in STAGES]
+    if start:
+        selected = [name for name in selected if name == start or start in ancestors(name)]
+    if until:
+        selected = [name for name in selected if name == until or name in ancestors(until)]
+    return selected
+
+def run_stage(name, profiler=None, report_folder=None):
+    # Run and measure the main() of a stage. Runs in a worker process or in the main process.
+    return instrumentation.measure(
+        name, lambda: importlib.import_module(name).main(), profiler, report_folder, variables.csv_folder
+    )
+
+def run(start=None, until=None, force=False, profiler=instrumentation_profiler,
+        profile_stages=instrumentation_profile_stages):
+    # Run the selected stages. A stage starts when all its selected dependencies have finished.
+    for name in [start, until]:
+        if name and name not in stages_by_name:
+            raise ValueError(f"Unknown stage: {name}. Stages: {', '.join(stages_by_name)}")
+
+    state_path = Path(variables.destination_folder) / state_filename
+    state = read_state(state_path)
+    pending = select_stages(start, until)
+    finished = set()
+    running = {}
+    fingerprints = {}
+    n_jobs = pipeline_n_jobs or os.cpu_count() or 1
+    started = datetime.now()
+    report_folder = Path(variables.destination_folder) / "run_reports" / started.strftime("%Y%m%d_%H%M%S")
+    records = {}
+
+    def stage_profiler(name):
+        return profiler if profile_stages is None or name in profile_stages else None
+
+    def ready_stages():
+        return [name for name in pending
+                if all(dep in finished or dep not in pending and dep not in running.values()
+                       for dep in stages_by_name[name]["depends_on"])]
+
+    def finish(name, record):
+        # Store the fingerprint and the output hashes of a finished stage.
+        records[name] = record
+        outputs = pattern_hashes(stages_by_name[name]["outputs"], state)
+        state["stages"][name] = {"fingerprint": fingerprints[name], "outputs": outputs}
+        write_state(state_path, state)
+        finished.add(name)
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            while pending or running:
+                # Skip the ready stages that are up to date.
+                to_start = []
+                for name in ready_stages():
+                    fingerprints[name] = fingerprint(stages_by_name[name], state)
+                    if not force and name != start and is_up_to_date(stages_by_name[name], state, fingerprints[name]):
+                        print(f"[pipeline] {name}: up to date, skipped.")
+                        pending.remove(name)
+                        finished.add(name)
+                        records[name] = instrumentation.skipped_record(name)
+                    else:
+                        to_start.append(name)
+
+                # Start the other stages. Interactive stages run in the main process, when no other stage is running.
+                # A stage that is the only one to run at this moment also runs in the main process (no worker process
+                # needs to be started for it).
+                for name in to_start:
+                    interactive = stages_by_name[name].get("interactive", False)
+                    if interactive or (len(to_start) == 1 and not running):
+                        if running:
+                            continue
+                        print(f"[pipeline] {name}: running" + (" (interactive)." if interactive else "."))
+                        pending.remove(name)
+                        records[name] = {"stage": name, "status": "failed"}  # Replaced when the stage finishes.
+                        finish(name, run_stage(name, stage_profiler(name), report_folder))
+                        print(f"[pipeline] {name}: finished.")
+                        continue
+
+                    print(f"[pipeline] {name}: running.")
+                    pending.remove(name)
+                    running[pool.submit(run_stage, name, stage_profiler(name), report_folder)] = name
+
+                if not running:
+                    continue
+
+                # Wait for a running stage to finish. A failed stage stops the pipeline (after the running ones).
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        records[name] = {"stage": name, "status": "failed"}
+                        pending.clear()
+                        wait(running)
+                        raise RuntimeError(f"Stage {name} failed.") from future.exception()
+                    finish(name, future.result())
+                    print(f"[pipeline] {name}: finished.")
+
+        print("[pipeline] Finished: all selected stages are up to date.")
+    finally:
+        # Save the run report, in the order of the stages (also when a stage failed).
+        ordered_records = [records[stage["name"]] for stage in STAGES if stage["name"] in records]
+        instrumentation.save_report(ordered_records, report_folder, started)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline, skipping the stages that are up to date.")
+    parser.add_argument("--from", dest="start", help="first stage to run (always runs), followed by its descendants")
+    parser.add_argument("--until", help="last stage to run, preceded by its ancestors")
+    parser.add_argument("--force", action="store_true", help="also run the stages that are up to date")
+    parser.add_argument("--profile", choices=["cprofile", "sampling"], default=instrumentation_profiler,
+                        help="profile the stages with cProfile or with the sampling profiler")
+    parser.add_argument("--profile-stages", nargs="+", default=instrumentation_profile_stages,
+                        help="only profile these stages")
+
+    # Run a single stage. Only the modules of that stage are imported.
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="run one stage (always), e.g. 'run data_checking'")
+    run_parser.add_argument("stage", choices=list(stages_by_name))
+    run_parser.add_argument("--profile", choices=["cprofile", "sampling"], default=instrumentation_profiler,
+                            help="profile the stage with cProfile or with the sampling profiler")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.stage, args.stage, profiler=args.profile, profile_stages=None)
+    else:
+        run(args.start, args.until, args.force, args.profile, args.profile_stages)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# This module keeps metadata about the PMIDs in articles.csv: the number of rows and a checksum of all PMIDs. The
+# metadata is updated by 'create_multi_CSV' and 'delta_update' each time rows are appended or removed, so later
+# modules can check their output against articles.csv without reading it again.
+# The checksum is the sum (modulo 2^64) of a 64-bit hash per PMID. A sum does not depend on the order of the rows and
+# can be updated for every appended (or removed) file. Two sets of PMIDs with the same row count and checksum are
+# (practically) always equal.
+# The metadata is written to a temporary file that replaces the metadata file, so an interrupted write does not leave a
+# truncated file.
+
+import json                      # For reading and writing the metadata file.
+import os                        # For replacing the metadata file.
+import pandas as pd              # For hashing the PMIDs.
+import schema                    # For reading articles.csv.
+
+metadata_filename = "articles_metadata.json"
+
+def pmid_checksum(pmids):
+    # Calculate the order-independent checksum of a collection of PMIDs.
+    # PMIDs are normalized to integers first, so "123", 123 and 123.0 (a column with missing values) are equal.
+    pmids = pd.to_numeric(pd.Series(pmids), errors="coerce").astype("Int64")
+    hashes = pd.util.hash_pandas_object(pmids, index=False).to_numpy()
+    return int(hashes.sum(dtype="uint64"))
+
+def read_metadata(folder):
+    # Read the metadata. Returns None if it does not exist (yet).
+    path = folder / metadata_filename
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_metadata(folder, rows, checksum):
+    # Write the metadata.
+    path = folder / metadata_filename
+    temporary_path = path.with_name(path.name + ".tmp")
+    with open(temporary_path, "w") as f:
+        json.dump({"rows": int(rows), "pmid_checksum": int(checksum)}, f)
+    os.replace(temporary_path, path)
+
+def reset_metadata(folder):
+    # Start the metadata of an empty articles.csv (when it is created from scratch).
+    write_metadata(folder, 0, 0)
+
+def add_pmids(folder, pmids):
+    # Update the metadata for rows that have been appended to articles.csv.
+    metadata = read_metadata(folder) or {"rows": 0, "pmid_checksum": 0}
+    write_metadata(folder, metadata["rows"] + len(pmids), (metadata["pmid_checksum"] + pmid_checksum(pmids)) % 2 ** 64)
+
+def build_metadata(folder):
+    # Create the metadata from an existing articles.csv (only the PMID column is read).
+    pmids = schema.read_table(folder / "articles.csv", usecols=["PMID"])["PMID"]
+    write_metadata(folder, len(pmids), pmid_checksum(pmids))
+    return read_metadata(folder)
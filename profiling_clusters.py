@@ -1,131 +1,300 @@
-# Generate profile CSVs and bar charts for each cluster.
+# Generate the profiles of all clusters. The profiles are saved to one file (cluster_profiles.json), and optionally as
+# a profile CSV and a bar chart (PNG) per cluster. The charts are rendered in parallel by worker processes.
+# If the SQLite store is used (see 'sqlite_store'), the Keywords, MeSH-terms and Chemicals are counted per cluster in
+# SQL instead of from the lower-case CSV files.
 
+import os
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import matplotlib.pyplot as plt
 from pathlib import Path
+import memory_budget
+import schema
+import sqlite_store
+from convert_to_lower_case import clean_text
 from variables import (
     csv_folder,
+    use_sqlite_store,
     CUSTOM_DOMAIN_STOPWORDS_PROFILING,
     profiling_number_of_top_keywords,
     profiling_number_of_top_mesh,
     profiling_number_of_top_chemicals,
     profiling_number_of_top_words_in_title_abstract,
-    TERM_REPLACEMENTS
+    TERM_REPLACEMENTS,
+    profiling_render_charts,
+    profiling_n_jobs
 )
 
 # Set paths
 csv_folder = Path(csv_folder)
 output_dir = csv_folder / "cluster_profiles"
-output_dir.mkdir(exist_ok=True)
+
+# Create a function that replaces terms with normalized equivalents. All replacements are compiled into one regular
+# expression, with the longest terms first. The text is scanned once: at every position the longest matching term is
+# replaced, and replaced text is not replaced again. The result therefore does not depend on the order of the
+# replacements dictionary.
+def build_term_normalizer(replacements):
+    terms = sorted(replacements, key=lambda term: (-len(term), term))
+    pattern = re.compile("|".join(re.escape(term) for term in terms))
+
+    def normalize(text):
+        return pattern.sub(lambda match: replacements[match.group(0)], str(text).strip().lower())
+    return normalize
 
 # Replace terms with normalized equivalents
-def normalize_term(text):
-    text = str(text).strip().lower()
-    for original, replacement in TERM_REPLACEMENTS.items():
-        text = text.replace(original, replacement)
-    return text
+normalize_term = build_term_normalizer(TERM_REPLACEMENTS)
 
-def main():
-    # Load CSVs
-    clusters = pd.read_csv(csv_folder / "data_with_clusters.csv", sep="~")
-    keywords = pd.read_csv(csv_folder / "keywords_lower_case.csv", sep="~")
-    mesh_terms = pd.read_csv(csv_folder / "mesh_terms_lower_case.csv", sep="~")
-    chemicals = pd.read_csv(csv_folder / "chemicals_lower_case.csv", sep="~")
-    tfidf = pd.read_csv(csv_folder / "tfidf_title_plus_abstract.csv", sep="~", low_memory=False)
-
-    # Ensure consistent PMIDs.
-    for df in [clusters, keywords, mesh_terms, chemicals, tfidf]:
-        df["PMID"] = df["PMID"].astype(str)
-
-    # Normalize terms.
-    keywords["Keyword"] = keywords["Keyword"].apply(normalize_term)
-    mesh_terms["Descriptor"] = mesh_terms["Descriptor"].apply(normalize_term)
-    chemicals["Chemical"] = chemicals["Chemical"].apply(normalize_term)
-
-    # Merge cluster labels.
-    keywords = keywords.merge(clusters[["PMID", "Cluster"]], on="PMID")
-    mesh_terms = mesh_terms.merge(clusters[["PMID", "Cluster"]], on="PMID")
-    chemicals = chemicals.merge(clusters[["PMID", "Cluster"]], on="PMID")
-    tfidf = tfidf.merge(clusters[["PMID", "Cluster"]], on="PMID")
-
-    # Profile each cluster.
-    for cluster_id in sorted(clusters["Cluster"].unique()):
-        cluster_data = {}
-        cluster_size = clusters["Cluster"].value_counts()[cluster_id]
-
-        # Keywords (relative frequency).
-        cluster_keywords = keywords[keywords["Cluster"] == cluster_id]["Keyword"]
-        top_keywords = (
-            cluster_keywords.value_counts(normalize=False) / cluster_size
-        ).drop(labels=CUSTOM_DOMAIN_STOPWORDS_PROFILING, errors="ignore").head(profiling_number_of_top_keywords)
-        cluster_data["Top Keywords"] = top_keywords
-
-        # MeSH terms (relative frequency).
-        cluster_mesh = mesh_terms[mesh_terms["Cluster"] == cluster_id]["Descriptor"]
-        top_mesh = (
-            cluster_mesh.value_counts(normalize=False) / cluster_size
-        ).drop(labels=CUSTOM_DOMAIN_STOPWORDS_PROFILING, errors="ignore").head(profiling_number_of_top_mesh)
-        cluster_data["Top MeSH Terms"] = top_mesh
-
-        # Chemicals (relative frequency).
-        cluster_chemicals = chemicals[chemicals["Cluster"] == cluster_id]["Chemical"]
-        top_chem = (
-            cluster_chemicals.value_counts(normalize=False) / cluster_size
-        ).drop(labels=CUSTOM_DOMAIN_STOPWORDS_PROFILING, errors="ignore").head(profiling_number_of_top_chemicals)
-        cluster_data["Top Chemicals"] = top_chem
-
-        # TF-IDF: normalize column names, group duplicates, and average.
-        tfidf_cols = [col for col in tfidf.columns if col.startswith("title_abstract__")]
-        tfidf_cluster = tfidf[tfidf["Cluster"] == cluster_id][tfidf_cols]
-
-        normalized_cols = [
-            f"title_abstract__{normalize_term(col.replace('title_abstract__', ''))}" for col in tfidf_cols
-        ]
-        tfidf_cluster.columns = normalized_cols
-        tfidf_cluster = tfidf_cluster.T.groupby(level=0).mean().T
-
-        top_words = tfidf_cluster.mean().sort_values(ascending=False)
-        prefixed_stopwords = {f"title_abstract__{w}" for w in CUSTOM_DOMAIN_STOPWORDS_PROFILING}
-        top_words = top_words[~top_words.index.isin(prefixed_stopwords)].head(
-            profiling_number_of_top_words_in_title_abstract
+# Normalize a column of terms. Every unique term is normalized only once, and the result is broadcast back to all rows
+# through the integer codes of the terms. Missing values get code -1, which selects the last entry ("nan", as before).
+def normalize_terms(series):
+    codes, uniques = pd.factorize(series)
+    normalized = np.array([*map(normalize_term, uniques), normalize_term(np.nan)], dtype=object)
+    return pd.Series(normalized[codes], index=series.index)
+
+# Count every term per cluster in one grouped pass. The terms are encoded as integer codes, and the counts are stored
+# in a sparse matrix with one row per cluster and one column per term. Every row counts once, or the number in the
+# column 'Count' if it exists (rows that were already counted in SQL). A second matrix with the same entries holds the
+# position (plus one) of the first row of every term within its cluster, for breaking ties in 'top_terms'.
+def count_terms_per_cluster(df, column, cluster_ids):
+    df = df[df[column].notna()]
+    term_codes, terms = pd.factorize(df[column])
+    cluster_codes = np.searchsorted(cluster_ids, df["Cluster"].to_numpy())
+    weights = df["Count"].to_numpy(dtype=np.int64) if "Count" in df else np.ones(len(df), dtype=np.int64)
+
+    # One entry per cluster and term: the sum of the weights and the first row.
+    keys = cluster_codes.astype(np.int64) * max(len(terms), 1) + term_codes
+    keys, first_rows, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.int64)
+    entries = np.divmod(keys, max(len(terms), 1))
+    shape = (len(cluster_ids), len(terms))
+    counts = sparse.csr_matrix((totals, entries), shape=shape)
+    first_rows = sparse.csr_matrix((first_rows + 1, entries), shape=shape)
+
+    # Remove the stop words once for all clusters.
+    keep = np.flatnonzero(~terms.isin(CUSTOM_DOMAIN_STOPWORDS_PROFILING))
+    return counts[:, keep].tocsr(), first_rows[:, keep].tocsr(), terms[keep]
+
+# Count the Keywords, MeSH-terms and Chemicals per cluster and term in the SQLite store: the cluster labels are loaded
+# into a temporary table, and every term table is joined and grouped in SQL. Only the distinct terms are lower-cased
+# (as in 'convert_to_lower_case', so also missing values are the same as in the lower-case files) and normalized in
+# Python. The groups (per cluster and term) are sorted by their first row, so the terms keep the order of first
+# appearance within every cluster. Returns the counts per table (see 'count_terms_per_cluster').
+def count_terms_per_cluster_store(clusters, cluster_ids):
+    conn = sqlite_store.open_store(csv_folder)
+    conn.execute("CREATE TEMP TABLE clusters (PMID INTEGER, Cluster INTEGER)")
+    conn.executemany("INSERT INTO temp.clusters VALUES (?, ?)",
+                     zip(clusters["PMID"].astype(int).tolist(), clusters["Cluster"].astype(int).tolist()))
+    conn.execute("CREATE INDEX temp.clusters_pmid ON clusters (PMID)")
+
+    results = {}
+    for name, column in sqlite_store.term_columns.items():
+        df = pd.read_sql_query(
+            f"SELECT c.Cluster, t.{column}, COUNT(*) AS Count FROM {name} AS t JOIN temp.clusters AS c "
+            f"ON c.PMID = t.PMID GROUP BY c.Cluster, t.{column} ORDER BY MIN(t.rowid)", conn
         )
-        cluster_data["Top TF-IDF Title & Abstract Words"] = top_words
-
-        # Remove duplicate index entries.
-        for key in cluster_data:
-            cluster_data[key] = cluster_data[key][~cluster_data[key].index.duplicated(keep="first")]
-
-        # Save profile CSV.
-        profile_df = pd.concat(cluster_data.values(), axis=1)
-        profile_df.columns = cluster_data.keys()
-        profile_df.to_csv(output_dir / f"cluster_{cluster_id}_profile.csv", sep="~")
-
-        # Plot bar charts.
-        fig, axes = plt.subplots(2, 2, figsize=(12, 7))
-        axes = axes.flatten()
-
-        for i, (name, series) in enumerate(cluster_data.items()):
-            ax = axes[i]
-            if not series.empty:
-                clean_series = series.copy()
-                if "TF-IDF" in name:
-                    clean_series.index = clean_series.index.str.replace("title_abstract__", "", regex=False)
-                    ax.set_xlabel("Mean TF-IDF Score")
-                else:
-                    ax.set_xlabel("Frequency / Cluster Size")
-
-                clean_series.sort_values().plot(kind="barh", ax=ax)
-                ax.set_title(name)
-                ax.set_ylabel("")
+        codes, terms = pd.factorize(df[column], use_na_sentinel=False)
+        lower_case = pd.Series(terms, dtype=object).map(lambda term: np.nan if pd.isna(term) else clean_text(term))
+        lower_case = lower_case.where(~lower_case.isin(sqlite_store.missing_values), np.nan)
+        df[column] = normalize_terms(lower_case).to_numpy()[codes]
+        results[name] = count_terms_per_cluster(df, column, cluster_ids)
+    conn.close()
+    return results
+
+# Select the top N terms of one cluster (one row of the count matrix), relative to the cluster size.
+def top_terms(counts, first_rows, terms, row, cluster_size, top_n):
+    start, end = counts.indptr[row], counts.indptr[row + 1]
+    term_codes, values = counts.indices[start:end], counts.data[start:end]
+    # Highest count first, ties in order of first appearance within the cluster.
+    order = np.lexsort((first_rows.data[start:end], -values))[:top_n]
+    return pd.Series(values[order] / cluster_size, index=terms[term_codes[order]])
+
+# Calculate the mean TF-IDF score per cluster and (normalized) word. The TF-IDF table is read in chunks. For every
+# chunk, words that have the same normalized form (e.g. 'machine learning' and 'deep learning') are merged by a
+# column-aggregation matrix (words x normalized words) that averages them, and a sparse cluster-indicator matrix
+# (clusters x rows) adds the sums and the number of articles with a value per cluster. Dividing them gives the means.
+def tfidf_means_per_cluster(clusters, cluster_ids):
+    tfidf_path = csv_folder / "tfidf_title_plus_abstract.csv"
+    columns = schema.read_table(tfidf_path, nrows=0).columns
+    tfidf_cols = [col for col in columns if col.startswith("title_abstract__")]
+
+    # Column-aggregation matrix.
+    normalized_cols = [
+        f"title_abstract__{normalize_term(col.replace('title_abstract__', ''))}" for col in tfidf_cols
+    ]
+    merged_cols, merged_index = np.unique(normalized_cols, return_inverse=True)
+    aggregation = sparse.csr_matrix(
+        (np.ones(len(tfidf_cols)), (np.arange(len(tfidf_cols)), merged_index)),
+        shape=(len(tfidf_cols), len(merged_cols))
+    )
+
+    # Sum the TF-IDF values per cluster. The TF-IDF file is saved from sparse tables, so zeros are empty values. As in
+    # a pandas mean, empty values are skipped: per article, the value of a normalized word is the mean of its non-empty
+    # columns, and per cluster, the mean is taken over the articles with a value.
+    # The chunk size is set by the memory budget (see 'memory_budget'); a chunk is in memory about three times (the
+    # chunk, its values and the sparse matrices).
+    cluster_of_pmid = clusters.drop_duplicates("PMID").set_index("PMID")["Cluster"]
+    sums = np.zeros((len(cluster_ids), len(merged_cols)))
+    counts = np.zeros((len(cluster_ids), len(merged_cols)))
+    plan = memory_budget.make_plan("Profiling TF-IDF", memory_budget.bytes_per_row(tfidf_path) * 3)
+    for chunk in memory_budget.read_chunks(tfidf_path, plan, usecols=["PMID", *tfidf_cols]):
+        chunk_clusters = chunk["PMID"].map(cluster_of_pmid)
+        matched = chunk_clusters.notna().to_numpy()
+        cluster_codes = np.searchsorted(cluster_ids, chunk_clusters[matched].to_numpy())
+
+        values = chunk.loc[matched, tfidf_cols].to_numpy(dtype=np.float64)
+        present = ~np.isnan(values)
+        value_sums = sparse.csr_matrix(np.nan_to_num(values)) @ aggregation
+        value_counts = (sparse.csr_matrix(present, dtype=np.float64) @ aggregation).toarray()
+        article_means = value_sums.toarray() / np.where(value_counts > 0, value_counts, 1)
+
+        indicator = sparse.csr_matrix(
+            (np.ones(len(cluster_codes)), (cluster_codes, np.arange(len(cluster_codes)))),
+            shape=(len(cluster_ids), len(cluster_codes))
+        )
+        sums += indicator @ article_means
+        counts += indicator @ (value_counts > 0).astype(np.float64)
+
+    memory_budget.report(plan)
+
+    means = sums / np.where(counts > 0, counts, np.nan)
+    return pd.DataFrame(means, columns=merged_cols)
+
+# Select the profile of one cluster: the top Keywords, MeSH terms and Chemicals (relative frequency) and the top
+# TF-IDF words (mean score per normalized word).
+def profile_cluster(row, cluster_size, term_counts, tfidf_means):
+    cluster_data = {}
+    for name, (counts, first_rows, terms, top_n) in term_counts.items():
+        cluster_data[name] = top_terms(counts, first_rows, terms, row, cluster_size, top_n)
+
+    top_words = tfidf_means.iloc[row].sort_values(ascending=False)
+    prefixed_stopwords = {f"title_abstract__{w}" for w in CUSTOM_DOMAIN_STOPWORDS_PROFILING}
+    top_words = top_words[~top_words.index.isin(prefixed_stopwords)].head(
+        profiling_number_of_top_words_in_title_abstract
+    )
+    cluster_data["Top TF-IDF Title & Abstract Words"] = top_words
+
+    # Remove duplicate index entries.
+    for key in cluster_data:
+        cluster_data[key] = cluster_data[key][~cluster_data[key].index.duplicated(keep="first")]
+    return cluster_data
+
+# Save all profiles to one JSON file: per cluster its size and, per profile part, the terms with their scores.
+def save_profiles_json(profiles, cluster_sizes):
+    output = {
+        str(cluster_id): {
+            "size": int(cluster_sizes[cluster_id]),
+            **{
+                name: {str(term): float(value) for term, value in series.items()}
+                for name, series in cluster_data.items()
+            }
+        }
+        for cluster_id, cluster_data in profiles.items()
+    }
+    with open(output_dir / "cluster_profiles.json", "w") as f:
+        json.dump(output, f, indent=2)
+
+# Use the headless Agg backend in the worker processes: the charts are only saved, never shown.
+def init_render_worker():
+    plt.switch_backend("Agg")
+
+# Save the profile CSV and the bar charts of one cluster. Runs in a worker process.
+def render_profile(cluster_id, cluster_data):
+    # Save profile CSV.
+    profile_df = pd.concat(cluster_data.values(), axis=1)
+    profile_df.columns = cluster_data.keys()
+    profile_df.to_csv(output_dir / f"cluster_{cluster_id}_profile.csv", sep="~")
+
+    # Plot bar charts.
+    fig, axes = plt.subplots(2, 2, figsize=(12, 7))
+    axes = axes.flatten()
+
+    for i, (name, series) in enumerate(cluster_data.items()):
+        ax = axes[i]
+        if not series.empty:
+            clean_series = series.copy()
+            if "TF-IDF" in name:
+                clean_series.index = clean_series.index.str.replace("title_abstract__", "", regex=False)
+                ax.set_xlabel("Mean TF-IDF Score")
             else:
-                ax.set_visible(False)
+                ax.set_xlabel("Frequency / Cluster Size")
+
+            clean_series.sort_values().plot(kind="barh", ax=ax)
+            ax.set_title(name)
+            ax.set_ylabel("")
+        else:
+            ax.set_visible(False)
+
+    plt.suptitle(f"Cluster {cluster_id} – Combined Profile", fontsize=22)
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.savefig(output_dir / f"cluster_{cluster_id}_combined.png")
+    plt.close(fig)
+    return cluster_id
+
+def main():
+    output_dir.mkdir(exist_ok=True)
+
+    # Load the cluster labels.
+    clusters = schema.read_table(csv_folder / "data_with_clusters.csv", usecols=["PMID", "Cluster"])
+    cluster_ids = np.sort(clusters["Cluster"].unique())
+    cluster_sizes = clusters["Cluster"].value_counts()
+
+    if use_sqlite_store:
+        # Count the Keywords, MeSH-terms and Chemicals per cluster in SQL.
+        results = count_terms_per_cluster_store(clusters, cluster_ids)
+        keyword_counts, keyword_first_rows, keyword_names = results["keywords"]
+        mesh_counts, mesh_first_rows, mesh_names = results["mesh_terms"]
+        chemical_counts, chemical_first_rows, chemical_names = results["chemicals"]
+    else:
+        # Load CSVs (the PMIDs are 64-bit integers in all tables, see 'schema').
+        keywords = schema.read_table(csv_folder / "keywords_lower_case.csv")
+        mesh_terms = schema.read_table(csv_folder / "mesh_terms_lower_case.csv")
+        chemicals = schema.read_table(csv_folder / "chemicals_lower_case.csv")
+
+        # Normalize terms.
+        keywords["Keyword"] = normalize_terms(keywords["Keyword"])
+        mesh_terms["Descriptor"] = normalize_terms(mesh_terms["Descriptor"])
+        chemicals["Chemical"] = normalize_terms(chemicals["Chemical"])
+
+        # Merge cluster labels.
+        keywords = keywords.merge(clusters[["PMID", "Cluster"]], on="PMID")
+        mesh_terms = mesh_terms.merge(clusters[["PMID", "Cluster"]], on="PMID")
+        chemicals = chemicals.merge(clusters[["PMID", "Cluster"]], on="PMID")
+
+        # Count the Keywords, MeSH-terms and Chemicals for all clusters at once.
+        keyword_counts, keyword_first_rows, keyword_names = count_terms_per_cluster(keywords, "Keyword", cluster_ids)
+        mesh_counts, mesh_first_rows, mesh_names = count_terms_per_cluster(mesh_terms, "Descriptor", cluster_ids)
+        chemical_counts, chemical_first_rows, chemical_names = count_terms_per_cluster(
+            chemicals, "Chemical", cluster_ids
+        )
+
+    # Calculate the mean TF-IDF scores for all clusters at once.
+    tfidf_means = tfidf_means_per_cluster(clusters, cluster_ids)
+
+    # Profile all clusters first.
+    term_counts = {
+        "Top Keywords": (keyword_counts, keyword_first_rows, keyword_names, profiling_number_of_top_keywords),
+        "Top MeSH Terms": (mesh_counts, mesh_first_rows, mesh_names, profiling_number_of_top_mesh),
+        "Top Chemicals": (chemical_counts, chemical_first_rows, chemical_names, profiling_number_of_top_chemicals)
+    }
+    profiles = {
+        cluster_id: profile_cluster(row, cluster_sizes[cluster_id], term_counts, tfidf_means)
+        for row, cluster_id in enumerate(cluster_ids)
+    }
+    save_profiles_json(profiles, cluster_sizes)
+    print("\nSaved: cluster_profiles.json")
 
-        plt.suptitle(f"Cluster {cluster_id} – Combined Profile", fontsize=22)
-        plt.tight_layout(rect=[0, 0.03, 1, 0.95])
-        plt.savefig(output_dir / f"cluster_{cluster_id}_combined.png")
-        plt.close()
+    # Render the CSV and the charts per cluster in parallel.
+    if not profiling_render_charts:
+        return
+    n_jobs = profiling_n_jobs or min(os.cpu_count() or 1, len(profiles))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_render_worker) as pool:
+        list(pool.map(render_profile, profiles.keys(), profiles.values()))
 
-    print("\nSaved: cluster profiles (CSV and PNG).")
+    print(f"Saved: cluster profiles (CSV and PNG) for {len(profiles)} clusters, rendered by {n_jobs} workers.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,218 @@
+# This module is a small local HTTP service (JSON) for the results of the pipeline, so other tools do not have to parse
+# the output files again for every lookup. The cluster labels (data_with_clusters.csv, as a PMID index) and the
+# profiles (cluster_profiles/cluster_profiles.json, see 'profiling_clusters') are loaded into memory once. Requests:
+#   GET  /health                            Number of articles and clusters, and when the files were loaded.
+#   GET  /clusters                          All clusters with their size.
+#   GET  /pmid/<PMID>                       The cluster of an article.
+#   GET  /pmids?ids=<PMID>,<PMID>,...       The clusters of several articles (null for unknown PMIDs).
+#   POST /pmids with {"pmids": [...]}       Idem, for longer lists.
+#   GET  /cluster/<id>                      The size and profile of a cluster.
+#   GET  /cluster/<id>/top-terms?n=<N>      The N top terms per profile part of a cluster.
+# The responses of GET requests are cached (the last 'service_cache_size' responses). The files (and the tombstones of
+# the daily updates, see 'delta_update') are checked every 'service_reload_interval' seconds: when a new run of the
+# pipeline has changed them, and they have not changed since the previous check (so the run has finished writing them),
+# they are loaded again and the cache is cleared. Requests are answered from the old data until the new data is loaded.
+#
+# Usage:
+#   python query_service.py [--host H] [--port P]
+
+import argparse                                              # For the command line options.
+import json                                                  # For the profiles and the responses.
+import threading                                             # For reloading the files in the background.
+import time                                                  # For the reload interval.
+from collections import OrderedDict                          # For the response cache.
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler  # For the service.
+from pathlib import Path                                     # For handling file paths.
+from urllib.parse import urlsplit, parse_qs                  # For the request paths and parameters.
+import numpy as np                                           # For the batch lookups.
+import pandas as pd                                          # For the cluster labels.
+
+import variables
+import schema                                                # For reading the cluster labels.
+
+# The loaded data, and the cache of responses. The data is replaced as a whole when the files are loaded again, so a
+# request always uses one version of the data.
+data = None
+cache = OrderedDict()
+cache_lock = threading.Lock()
+
+def watched_files(folder):
+    return [
+        Path(folder) / "data_with_clusters.csv", Path(folder) / "cluster_profiles" / "cluster_profiles.json",
+        Path(folder) / schema.tombstones_filename
+    ]
+
+def file_versions(folder):
+    # The size and modification time of the files (None for a file that does not exist).
+    versions = []
+    for path in watched_files(folder):
+        stat = path.stat() if path.exists() else None
+        versions.append((stat.st_size, stat.st_mtime_ns) if stat else None)
+    return versions
+
+def load_data(folder):
+    # Load the cluster labels (as a Series with the PMIDs as index) and the profiles.
+    labels_path, profiles_path, _ = watched_files(folder)
+    versions = file_versions(folder)
+    labels = schema.read_table(labels_path, usecols=["PMID", "Cluster"])
+    labels = labels.drop_duplicates("PMID", keep="last").set_index("PMID")["Cluster"]
+    profiles = {}
+    if profiles_path.exists():
+        with open(profiles_path, "r") as f:
+            profiles = {int(cluster_id): profile for cluster_id, profile in json.load(f).items()}
+    sizes = labels.value_counts().sort_index()
+    return {
+        "labels": labels,
+        "sizes": {int(cluster_id): int(size) for cluster_id, size in sizes.items()},
+        "profiles": profiles,
+        "versions": versions,
+        "loaded_at": time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+def top_terms(profile, n):
+    # The N terms with the highest score per profile part (without the 'title_abstract__' prefix of the TF-IDF terms).
+    return {
+        part: [term.replace("title_abstract__", "") for term, _ in sorted(terms.items(), key=lambda t: -t[1])[:n]]
+        for part, terms in profile.items() if isinstance(terms, dict)
+    }
+
+def respond(loaded, method, path, body):
+    # Answer a request with the loaded data. Returns the HTTP status and the response (a dictionary).
+    url = urlsplit(path)
+    parts = [part for part in url.path.split("/") if part]
+    query = parse_qs(url.query)
+
+    if method == "POST":
+        if parts != ["pmids"]:
+            return 404, {"error": f"Unknown path: {url.path}"}
+        try:
+            pmids = json.loads(body or b"{}")["pmids"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": "The body must be JSON with a list 'pmids'."}
+        return 200, {"clusters": batch_lookup(loaded["labels"], pmids)}
+
+    if parts == ["health"]:
+        return 200, {"articles": len(loaded["labels"]), "clusters": len(loaded["sizes"]), "loaded_at": loaded["loaded_at"]}
+    if parts == ["clusters"]:
+        return 200, {"clusters": [{"cluster": cluster_id, "size": size} for cluster_id, size in loaded["sizes"].items()]}
+    if parts == ["pmids"]:
+        ids = [pmid for value in query.get("ids", []) for pmid in value.split(",") if pmid]
+        return 200, {"clusters": batch_lookup(loaded["labels"], ids)}
+    if len(parts) == 2 and parts[0] == "pmid":
+        cluster = batch_lookup(loaded["labels"], [parts[1]])[parts[1]]
+        if cluster is None:
+            return 404, {"error": f"PMID {parts[1]} not found."}
+        return 200, {"pmid": parts[1], "cluster": cluster}
+    if len(parts) in (2, 3) and parts[0] == "cluster":
+        if not parts[1].isdigit() or int(parts[1]) not in loaded["sizes"]:
+            return 404, {"error": f"Cluster {parts[1]} not found."}
+        cluster_id = int(parts[1])
+        profile = loaded["profiles"].get(cluster_id, {})
+        if len(parts) == 2:
+            return 200, {"cluster": cluster_id, "size": loaded["sizes"][cluster_id], "profile": profile}
+        if parts[2] == "top-terms":
+            n = query.get("n", ["3"])[0]
+            if not n.isdigit():
+                return 400, {"error": "n must be a positive number."}
+            return 200, {"cluster": cluster_id, "top_terms": top_terms(profile, int(n))}
+    return 404, {"error": f"Unknown path: {url.path}"}
+
+def batch_lookup(labels, pmids):
+    # The clusters of the PMIDs (keys as given in the request; None for unknown PMIDs).
+    keys = [str(pmid) for pmid in pmids]
+    numbers = pd.to_numeric(pd.Series(keys, dtype=object), errors="coerce")
+    valid = numbers.notna() & (numbers == numbers.round())
+    found = iter(labels.reindex(numbers[valid].astype(np.int64).to_numpy()).to_numpy())
+    clusters = [next(found) if is_valid else np.nan for is_valid in valid]
+    return {key: None if pd.isna(cluster) else int(cluster) for key, cluster in zip(keys, clusters)}
+
+def cached_response(path):
+    # The response of a GET request, from the cache if possible. The cache is cleared when the files are reloaded; a
+    # response of data that has been replaced in the meantime is not cached.
+    loaded = data
+    with cache_lock:
+        if path in cache:
+            cache.move_to_end(path)
+            return cache[path]
+    status, response = respond(loaded, "GET", path, None)
+    encoded = (status, json.dumps(response).encode())
+    with cache_lock:
+        if loaded is not data:
+            return encoded
+        cache[path] = encoded
+        if len(cache) > variables.service_cache_size:
+            cache.popitem(last=False)
+    return encoded
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_json(*cached_response(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, response = respond(data, "POST", self.path, body)
+        self.send_json(status, json.dumps(response).encode())
+
+    def send_json(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No line per request.
+
+def watch_files(folder, stop):
+    # Reload the files when they have changed and have not changed since the previous check.
+    global data
+    previous = file_versions(folder)
+    while not stop.wait(variables.service_reload_interval):
+        current = file_versions(folder)
+        if current == previous and current != data["versions"] and current[0] is not None:
+            try:
+                data = load_data(folder)
+            except Exception as e:  # E.g. a file that is written again; it is loaded at the next check.
+                print(f"Reload failed: {e}")
+                continue
+            with cache_lock:
+                cache.clear()
+            print(f"Reloaded: {len(data['labels'])} articles, {len(data['sizes'])} clusters ({data['loaded_at']}).")
+        previous = current
+
+def start_service(folder, host, port):
+    # Load the files and start the service (and the reloading) in background threads. Returns the server and a
+    # function that stops both.
+    global data
+    data = load_data(folder)
+    with cache_lock:
+        cache.clear()
+    server = ThreadingHTTPServer((host, port), Handler)
+    stop = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=watch_files, args=(folder, stop), daemon=True).start()
+
+    def shutdown():
+        stop.set()
+        server.shutdown()
+        server.server_close()
+
+    return server, shutdown
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the cluster labels and profiles over HTTP (JSON).")
+    parser.add_argument("--host", default=variables.service_host)
+    parser.add_argument("--port", type=int, default=variables.service_port)
+    args = parser.parse_args()
+
+    server, shutdown = start_service(variables.csv_folder, args.host, args.port)
+    print(f"Loaded: {len(data['labels'])} articles, {len(data['sizes'])} clusters, {len(data['profiles'])} profiles.")
+    print(f"Serving on http://{args.host}:{server.server_address[1]} (stop with Ctrl+C).")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -12,20 +12,22 @@ from variables import (
     last_file
 )
 
-def main():
+# Download and extract the files with numbers 'first' to 'last' from 'url' to 'folder'. Files that already exist are
+# not downloaded again. Returns the names of the files that could not be downloaded or extracted.
+def download_files(url, folder, first, last):
     # Make the destination folder.
-    os.makedirs(destination_folder, exist_ok=True)
+    os.makedirs(folder, exist_ok=True)
 
     # Track missing files.
     missing_files = []
 
     # Download and extract files.
-    for num in tqdm(range(first_file, last_file + 1), desc="Processing files", unit="file"):
+    for num in tqdm(range(first, last + 1), desc="Processing files", unit="file"):
         base_name = f"pubmed25n{num:04d}.xml.gz"
-        gz_url = base_url + base_name
+        gz_url = url + base_name
         md5_url = gz_url + ".md5"
 
-        gz_path = os.path.join(destination_folder, base_name)
+        gz_path = os.path.join(folder, base_name)
         md5_path = gz_path + ".md5"
         xml_path = gz_path.replace(".gz", "")
 
@@ -50,6 +52,11 @@ def main():
         except Exception:
             missing_files.append(base_name)
 
+    return missing_files
+
+def main():
+    missing_files = download_files(base_url, destination_folder, first_file, last_file)
+
     # Final check and message
     if missing_files:
         raise Exception("Not all files were downloaded or extracted correctly.")
@@ -0,0 +1,257 @@
+# This module is the schema registry of the pipeline: the type of every column of every CSV file that the stages read
+# and write. All tables are read and written through this module, so they have compact types in memory:
+# - PMIDs are 64-bit integers (not texts);
+# - SourceFile and the term columns (Keyword, Descriptor, Chemical) are categorical: every distinct value is kept once,
+#   and a row only holds a small integer code;
+# - Multi-hot columns are 8-bit unsigned integers, and the TF-IDF, combined and PCA features are 32-bit floats.
+# A file is checked against its schema when it is read: a missing or unknown column, or a value that does not fit its
+# type (e.g. a PMID that is not a number) raises a SchemaError with the name of the file. Tables are written with the
+# types of their schema as well, in blocks of rows. Sparse (TF-IDF) columns are written as dense blocks, with empty
+# values for the values that are not stored, as pandas writes sparse columns. The rows that a daily update has
+# superseded are left out when a file is read (see 'Superseded rows' below).
+
+import numpy as np                   # For the dense copies of sparse columns.
+import pandas as pd                  # For reading and writing the tables.
+from pathlib import Path             # For handling file paths.
+
+write_rows_per_block = 100000        # Number of rows that are converted and written at once.
+
+# The error of a table that does not match its schema. It is a ValueError, so callers can catch it without catching
+# every other error.
+class SchemaError(ValueError):
+    pass
+
+# The schema per file name: the type per column. '*' is the type of all other columns (the feature columns). Files in
+# the shard folders of 'mapreduce' have the same names, and the same schemas.
+raw_tables = {
+    "articles.csv": {"PMID": "int64", "Title": "str", "Abstract": "str", "Year": "Int16", "SourceFile": "category"},
+    "keywords.csv": {"PMID": "int64", "Keyword": "category", "SourceFile": "category"},
+    "mesh_terms.csv": {"PMID": "int64", "Descriptor": "category", "SourceFile": "category"},
+    "chemicals.csv": {"PMID": "int64", "Chemical": "category", "SourceFile": "category"}
+}
+features = {"PMID": "int64", "SourceFile": "category", "*": "float32"}
+tables = {
+    **raw_tables,
+    "articles_title_lower_case.csv": {"PMID": "int64", "Title": "str", "SourceFile": "category"},
+    "articles_abstract_lower_case.csv": {"PMID": "int64", "Abstract": "str", "SourceFile": "category"},
+    "articles_title_plus_abstract_lower_case.csv": {"PMID": "int64", "Title_plus_abstract": "str"},
+    "keywords_lower_case.csv": raw_tables["keywords.csv"],
+    "mesh_terms_lower_case.csv": raw_tables["mesh_terms.csv"],
+    "chemicals_lower_case.csv": raw_tables["chemicals.csv"],
+    "keywords_transformed.csv": {"PMID": "int64", "*": "uint8"},
+    "mesh_terms_transformed.csv": {"PMID": "int64", "*": "uint8"},
+    "chemicals_transformed.csv": {"PMID": "int64", "*": "uint8"},
+    "tfidf_title.csv": {"PMID": "int64", "*": "float32"},
+    "tfidf_abstract.csv": {"PMID": "int64", "*": "float32"},
+    "tfidf_title_plus_abstract.csv": {"PMID": "int64", "*": "float32"},
+    "tfidf_title_plus_abstract_part1.csv": {"PMID": "int64", "*": "float32"},
+    "tfidf_title_plus_abstract_part2.csv": {"PMID": "int64", "*": "float32"},
+    "data_combined_before_PCA.csv": features,
+    "data_after_pca.csv": features,
+    "data_with_clusters.csv": {**features, "Cluster": "int32"},
+    "near_duplicates.csv": {"PMID": "int64", "CanonicalPMID": "int64"},
+    "tombstones.csv": {"PMID": "int64", "SourceFile": "str", "MissingFrom": "str"}
+}
+
+# Superseded rows. A daily update (see 'delta_update') only appends rows to the files with rows per article: the rows of
+# a revised or deleted article stay in the files until they are compacted, and its PMID is saved in tombstones.csv with
+# the source file of its latest version (empty if it has been deleted) and the files without a SourceFile column that
+# have no row of its latest version (MissingFrom, separated by spaces). These files are always read without the
+# superseded rows:
+# - in a file with a SourceFile column, a row of a PMID in the tombstones is superseded if it has another source file;
+# - the other files (the features: at most one row per article, without line breaks in the values) only keep the last
+#   row of a PMID in the tombstones, and none if its latest version has no row in the file (it has been deleted, or
+#   has no keywords for example). While there are tombstones, these rows are found in a first pass over the PMID
+#   column, and skipped by the CSV reader ('nrows' and 'skiprows' count all rows of the file).
+tombstones_filename = "tombstones.csv"
+article_tables = [
+    *raw_tables, "articles_title_lower_case.csv", "articles_abstract_lower_case.csv",
+    "articles_title_plus_abstract_lower_case.csv", "keywords_lower_case.csv", "mesh_terms_lower_case.csv",
+    "chemicals_lower_case.csv", "keywords_transformed.csv", "mesh_terms_transformed.csv", "chemicals_transformed.csv",
+    "tfidf_title.csv", "tfidf_abstract.csv", "tfidf_title_plus_abstract.csv", "data_combined_before_PCA.csv",
+    "data_after_pca.csv", "data_with_clusters.csv"
+]
+
+def table_schema(name):
+    if name not in tables:
+        raise SchemaError(f"{name} has no schema. Add it to the tables of 'schema'.")
+    return tables[name]
+
+def column_types(name, columns):
+    # The type of every given column of a table. A column that is not in the schema raises an error.
+    schema = table_schema(name)
+    unknown = [column for column in columns if column not in schema and "*" not in schema]
+    if unknown:
+        raise SchemaError(f"{name} does not match its schema: unknown column(s) {unknown}.")
+    return {column: schema.get(column, schema.get("*")) for column in columns}
+
+def check(df, name):
+    # Check the columns and types of a table against its schema.
+    wrong = {
+        column: str(df[column].dtype) for column, dtype in column_types(name, df.columns).items()
+        if df[column].dtype != dtype
+    }
+    if wrong:
+        raise SchemaError(f"{name} does not match its schema: wrong type(s) {wrong}.")
+    return df
+
+def checked_chunks(reader, name):
+    # The chunks of a reader; a value that does not fit its type raises an error with the name of the file.
+    try:
+        yield from reader
+    except (ValueError, TypeError, OverflowError) as e:
+        raise SchemaError(f"{name} does not match its schema: {e}") from e
+
+def read_tombstones(folder):
+    # The source file of the latest version per PMID in the tombstones (missing if the article has been deleted), and
+    # the files it is missing from (a set). None if there are no tombstones.
+    path = Path(folder) / tombstones_filename
+    if not path.exists():
+        return None
+    tombstones = read_table(path)
+    if tombstones.empty:
+        return None
+    return pd.DataFrame(
+        {
+            "SourceFile": tombstones["SourceFile"].to_numpy(dtype=object),
+            "MissingFrom": [set(files.split()) for files in tombstones["MissingFrom"].fillna("")]
+        },
+        index=tombstones["PMID"].to_numpy()
+    )
+
+def live_rows(df, tombstones):
+    # Mask of the rows of a table with a SourceFile column that are not superseded.
+    pmids = pd.to_numeric(df["PMID"], errors="coerce")  # Also if all values are read as text.
+    tombstoned = pmids.isin(tombstones.index).to_numpy()
+    live = ~tombstoned
+    latest = pmids[tombstoned].map(tombstones["SourceFile"])
+    live[tombstoned] = (df["SourceFile"][tombstoned].astype(object) == latest).to_numpy()
+    return live
+
+def superseded_rows(path, name, tombstones):
+    # The numbers of the superseded rows of a file (0 is the first row after the header), in one pass over the PMID
+    # (and SourceFile) column.
+    with_source = "SourceFile" in table_schema(name)
+    columns = ["PMID", "SourceFile"] if with_source else ["PMID"]
+    superseded, rows, pmids, start = [np.array([], dtype=np.int64)], [], [], 0
+    types = column_types(name, columns)
+    for chunk in pd.read_csv(path, sep="~", usecols=columns, dtype=types, chunksize=write_rows_per_block):
+        if with_source:
+            superseded.append(start + np.flatnonzero(~live_rows(chunk, tombstones)))
+        else:
+            tombstoned = np.flatnonzero(chunk["PMID"].isin(tombstones.index).to_numpy())
+            rows.append(start + tombstoned)
+            pmids.append(chunk["PMID"].to_numpy()[tombstoned])
+        start += len(chunk)
+    if rows:
+        # Only the last row of an article is kept, if its latest version has a row in the file.
+        rows = pd.DataFrame({"PMID": np.concatenate(pmids), "row": np.concatenate(rows)})
+        in_file = tombstones["SourceFile"].notna() & ~tombstones["MissingFrom"].map(lambda files: name in files)
+        kept = (rows["row"] == rows.groupby("PMID")["row"].transform("max")) & rows["PMID"].map(in_file)
+        superseded.append(rows.loc[~kept, "row"].to_numpy())
+    return np.concatenate(superseded)
+
+def skip_superseded(path, name, tombstones, read_csv_kwargs):
+    # The arguments of the CSV reader that also skip the superseded rows of a file without a SourceFile column. Its rows
+    # are its lines, and line 0 is the header.
+    superseded = set((superseded_rows(path, name, tombstones) + 1).tolist())
+    if not superseded:
+        return read_csv_kwargs
+    skiprows = read_csv_kwargs.get("skiprows")
+    if callable(skiprows):
+        skip = lambda line: line in superseded or skiprows(line)
+    elif skiprows is not None:
+        skip = superseded | set(range(skiprows) if isinstance(skiprows, int) else skiprows)
+    else:
+        skip = superseded
+    read_csv_kwargs = {**read_csv_kwargs, "skiprows": skip}
+    if "nrows" in read_csv_kwargs:
+        read_csv_kwargs["nrows"] -= sum(1 for line in superseded if line <= read_csv_kwargs["nrows"])
+    return read_csv_kwargs
+
+def without_superseded(chunks, tombstones, added):
+    # The chunks of a table with a SourceFile column without the superseded rows and the columns that were only read to
+    # find them. The rows are numbered again, and the categories only have the values of the other rows, as if the
+    # superseded rows were not in the file.
+    start = 0
+    for chunk in chunks:
+        chunk = chunk[live_rows(chunk, tombstones)].drop(columns=added)
+        for column in chunk.columns[chunk.dtypes == "category"]:
+            chunk[column] = chunk[column].cat.remove_unused_categories()
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+def read_table(path, name=None, **read_csv_kwargs):
+    # Read a CSV file (or an iterator of chunks, with 'chunksize') with the types of its schema. 'name' is the name of
+    # the schema if it differs from the file name. An explicit 'dtype' replaces the types of the schema (e.g. to read
+    # all values as text, see 'data_checking'); the columns are still checked. The superseded rows of a file with rows
+    # per article are left out.
+    path = Path(path)
+    name = name or path.name
+    header = pd.read_csv(path, sep="~", nrows=0).columns
+    missing = [column for column in table_schema(name) if column != "*" and column not in header]
+    if missing:
+        raise SchemaError(f"{name} does not match its schema: missing column(s) {missing}.")
+    tombstones = None
+    if name in article_tables and read_csv_kwargs.get("nrows") != 0:
+        tombstones = read_tombstones(path.parent)
+    added = []
+    if tombstones is not None and "SourceFile" not in table_schema(name):
+        read_csv_kwargs = skip_superseded(path, name, tombstones, read_csv_kwargs)
+        tombstones = None
+    elif tombstones is not None and "usecols" in read_csv_kwargs:
+        added = [column for column in ["PMID", "SourceFile"] if column not in read_csv_kwargs["usecols"]]
+        read_csv_kwargs = {**read_csv_kwargs, "usecols": [*read_csv_kwargs["usecols"], *added]}
+    types = column_types(name, read_csv_kwargs.get("usecols", header))
+    explicit = "dtype" in read_csv_kwargs
+    read_csv_kwargs = {"dtype": types, **read_csv_kwargs}
+
+    if "chunksize" in read_csv_kwargs:
+        reader = pd.read_csv(path, sep="~", **read_csv_kwargs)
+        chunks = reader if explicit else (check(chunk, name) for chunk in reader)
+        return checked_chunks(chunks if tombstones is None else without_superseded(chunks, tombstones, added), name)
+    try:
+        df = pd.read_csv(path, sep="~", **read_csv_kwargs)
+    except (ValueError, TypeError, OverflowError) as e:
+        raise SchemaError(f"{name} does not match its schema: {e}") from e
+    df = df if explicit else check(df, name)
+    return df if tombstones is None else next(without_superseded([df], tombstones, added))
+
+def cast(df, name):
+    # A copy of the table with the types of its schema. Sparse columns become dense, with NaN for the values that are
+    # not stored.
+    columns = {}
+    for column, dtype in column_types(name, df.columns).items():
+        values = df[column]
+        if isinstance(values.dtype, pd.SparseDtype):
+            dense = np.full(len(values), np.nan, dtype=dtype)
+            dense[values.array.sp_index.indices] = values.array.sp_values
+            values = pd.Series(dense, index=df.index)
+        columns[column] = values.astype(dtype)
+    return pd.DataFrame(columns, index=df.index)
+
+def write_table(df, path, name=None, **to_csv_kwargs):
+    # Write a table with the types of its schema, in blocks of rows. 'mode' and 'header' apply to the first block (the
+    # other blocks are appended). 'name' is the name of the schema if it differs from the file name.
+    name = name or Path(path).name
+    mode = to_csv_kwargs.pop("mode", "w")
+    header = to_csv_kwargs.pop("header", True)
+    for start in range(0, max(len(df), 1), write_rows_per_block):
+        block = cast(df.iloc[start:start + write_rows_per_block], name)
+        block.to_csv(path, sep="~", index=False, mode=mode, header=header, **to_csv_kwargs)
+        mode, header = "a", False
+
+def value_counts(values, sort=True):
+    # The number of rows per value (as 64-bit integers), without missing values, as for a text column: ties (or all
+    # values, if sort is False) in order of first appearance. pandas orders the values of a categorical column by its
+    # categories instead, and counts the values of a nullable integer column as nullable integers.
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.value_counts(sort=sort).astype("int64")
+    codes = values.cat.codes.to_numpy()
+    order = pd.unique(codes[codes >= 0])
+    counts = pd.Series(
+        np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))[order],
+        index=values.cat.categories[order].rename(values.name), name="count"
+    )
+    return counts.sort_values(ascending=False, kind="stable") if sort else counts
@@ -0,0 +1,232 @@
+# This module finds similar articles ("more like this PMID") in the PCA space, with an approximate nearest-neighbour
+# index (inverted file, IVF):
+# 1. The PCA vectors of all clustered articles (data_with_clusters.csv) are divided over 'ann_n_lists' lists. The list
+#    centroids are seeded with the saved K-Means centroids (see 'clustering') and random articles, and refined with a
+#    few K-Means (Lloyd) iterations on a sample. Every article is added to the list of its nearest centroid;
+# 2. The vectors are saved sorted by list (models/ann_index.npz), so the articles of a list are one contiguous block;
+# 3. A query only compares its vector with the articles of the 'ann_n_probe' lists with the nearest centroids, instead
+#    of with all articles. More lists to probe means a higher recall (share of the exact nearest neighbours that is
+#    found), but slower queries.
+# The benchmark compares the results of a sample of queries with exact (brute force) results: recall@k and the time
+# per query. Rebuild the index after new articles have been added to data_with_clusters.csv (see 'assign' and
+# 'delta_update').
+#
+# Usage:
+#   python similar_articles.py build                      Build the index from data_with_clusters.csv.
+#   python similar_articles.py query <PMID> [<PMID> ...]  Show the nearest articles of one or more PMIDs.
+#   python similar_articles.py benchmark                  Recall@k and query time against brute force on a sample.
+
+import argparse                                              # For the command line options.
+import time                                                  # For the build and query times.
+import numpy as np                                           # For the index and the distances.
+import pandas as pd                                          # For reading the PCA vectors.
+from pathlib import Path                                     # For handling file paths.
+import joblib                                                # For loading the saved centroids.
+
+import memory_budget                                         # For reading the PCA vectors in chunks.
+import schema                                                # For the columns of the PCA output.
+from variables import (
+    csv_folder,
+    clustering_random_state,
+    ann_n_lists,
+    ann_n_probe,
+    ann_train_iterations,
+    ann_train_sample_size,
+    ann_top_k,
+    ann_benchmark_sample_size
+)
+
+# Set directories.
+csv_folder = Path(csv_folder)
+input_path = csv_folder / "data_with_clusters.csv"
+models_folder = csv_folder / "models"
+index_path = models_folder / "ann_index.npz"
+
+# Number of rows per block when distances are calculated for many rows at once (limits the size of the distance
+# matrix).
+block_rows = 4096
+
+def squared_distances(X, Y):
+    # Squared Euclidean distances between the rows of X and the rows of Y.
+    return np.maximum((X ** 2).sum(axis=1)[:, None] - 2 * X @ Y.T + (Y ** 2).sum(axis=1)[None, :], 0)
+
+def nearest_centroids(X, centroids):
+    # The nearest centroid of every row of X, in blocks of rows.
+    return np.concatenate([
+        np.argmin(squared_distances(X[start:start + block_rows], centroids), axis=1)
+        for start in range(0, len(X), block_rows)
+    ]) if len(X) else np.array([], dtype=np.int64)
+
+def read_vectors():
+    # The PMIDs, clusters and PCA vectors (float32) of all clustered articles.
+    columns = schema.read_table(input_path, nrows=0).columns
+    pca_columns = [c for c in columns if c.startswith("pca_")]
+    usecols = ["PMID", "Cluster", *pca_columns]
+    plan = memory_budget.make_plan("ANN index", memory_budget.bytes_per_row(input_path, usecols=usecols))
+    pmids, clusters, vectors = [], [], []
+    for chunk in memory_budget.read_chunks(input_path, plan, usecols=usecols):
+        pmids.append(chunk["PMID"].to_numpy(dtype=np.int64))
+        clusters.append(chunk["Cluster"].to_numpy(dtype=np.int32))
+        vectors.append(chunk[pca_columns].to_numpy(dtype=np.float32))
+    memory_budget.report(plan)
+    return np.concatenate(pmids), np.concatenate(clusters), np.concatenate(vectors)
+
+def train_centroids(vectors, n_lists, rng):
+    # The list centroids: the saved K-Means centroids and random articles, refined with Lloyd iterations on a sample.
+    sample = vectors[np.sort(rng.choice(len(vectors), size=min(ann_train_sample_size, len(vectors)), replace=False))]
+    seeds = np.empty((0, vectors.shape[1]), dtype=np.float32)
+    model_path = models_folder / "cluster_model.joblib"
+    if model_path.exists():
+        centroids = np.asarray(joblib.load(model_path)["centroids"], dtype=np.float32)
+        if centroids.shape[1] == vectors.shape[1]:
+            seeds = centroids[:n_lists]
+    extra = rng.choice(len(sample), size=min(len(sample), n_lists - len(seeds)), replace=False)
+    centroids = np.vstack([seeds, sample[extra]])
+
+    for _ in range(ann_train_iterations):
+        labels = nearest_centroids(sample, centroids)
+        counts = np.bincount(labels, minlength=len(centroids))
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, labels, sample)
+        filled = counts > 0  # A centroid without articles keeps its position.
+        centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+    return centroids
+
+def build_index():
+    # Build and save the index.
+    start = time.perf_counter()
+    pmids, clusters, vectors = read_vectors()
+    n_lists = min(len(vectors), ann_n_lists or max(1, int(4 * np.sqrt(len(vectors)))))
+    centroids = train_centroids(vectors, n_lists, np.random.default_rng(clustering_random_state))
+
+    # Sort the articles by list. 'offsets' are the start positions of the lists (and the end of the last list).
+    labels = nearest_centroids(vectors, centroids)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+
+    models_folder.mkdir(exist_ok=True)
+    np.savez(index_path, centroids=centroids, offsets=offsets, vectors=vectors[order], pmids=pmids[order],
+             clusters=clusters[order])
+    sizes = np.diff(offsets)
+    print(f"Saved: {index_path.name} ({len(vectors)} articles, {n_lists} lists of {sizes.min()}-{sizes.max()} "
+          f"articles, {time.perf_counter() - start:.1f} s)")
+
+def load_index():
+    # Load the index, with the positions of the PMIDs for lookups.
+    if not index_path.exists():
+        raise FileNotFoundError(f"{index_path.name} does not exist. Run 'python similar_articles.py build' first.")
+    if index_path.stat().st_mtime < input_path.stat().st_mtime:
+        print(f"Warning: data_with_clusters.csv is newer than {index_path.name}. Rebuild the index to include all "
+              f"articles.")
+    with np.load(index_path) as data:
+        index = {name: data[name] for name in data.files}
+    index["pmid_order"] = np.argsort(index["pmids"])
+    return index
+
+def find_rows(index, pmids):
+    # The positions of the PMIDs in the index (-1 if a PMID is not in the index).
+    pmids = np.asarray(pmids, dtype=np.int64)
+    sorted_pmids = index["pmids"][index["pmid_order"]]
+    positions = np.minimum(np.searchsorted(sorted_pmids, pmids), len(sorted_pmids) - 1)
+    return np.where(sorted_pmids[positions] == pmids, index["pmid_order"][positions], -1)
+
+def top_k(distances, rows, k):
+    # The k rows with the smallest distances, sorted by distance.
+    if len(rows) > k:
+        nearest = np.argpartition(distances, k)[:k]
+        rows, distances = rows[nearest], distances[nearest]
+    order = np.argsort(distances, kind="stable")
+    return rows[order], distances[order]
+
+def query(index, query_rows, k=ann_top_k, n_probe=ann_n_probe):
+    # The approximate k nearest articles (positions and distances) of every query row, without the query itself.
+    vectors, offsets = index["vectors"], index["offsets"]
+    queries = vectors[query_rows]
+    n_probe = min(n_probe, len(index["centroids"]))
+    probe_lists = np.argpartition(squared_distances(queries, index["centroids"]), n_probe - 1, axis=1)[:, :n_probe]
+
+    results = []
+    for row, query_vector, lists in zip(query_rows, queries, probe_lists):
+        rows = np.concatenate([np.arange(offsets[l], offsets[l + 1]) for l in lists])
+        rows = rows[rows != row]
+        distances = squared_distances(query_vector[None, :], vectors[rows])[0]
+        results.append(top_k(distances, rows, k))
+    return results
+
+def exact_query(index, query_rows, k=ann_top_k):
+    # The exact k nearest articles of every query row (brute force over all articles), without the query itself.
+    vectors = index["vectors"]
+    all_rows = np.arange(len(vectors))
+    results = []
+    for row in query_rows:
+        distances = squared_distances(vectors[row][None, :], vectors)[0]
+        distances[row] = np.inf
+        results.append(top_k(distances, all_rows, k))
+    return results
+
+def benchmark(index, k=ann_top_k, n_probe=ann_n_probe):
+    # Recall@k and the time per query of the index against brute force, on a random sample of articles.
+    rng = np.random.default_rng(clustering_random_state)
+    n_rows = len(index["vectors"])
+    sample = rng.choice(n_rows, size=min(ann_benchmark_sample_size, n_rows), replace=False)
+    k = min(k, n_rows - 1)
+
+    start = time.perf_counter()
+    exact = exact_query(index, sample, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(sample)
+
+    single_ms = []
+    for row in sample:
+        start = time.perf_counter()
+        query(index, [row], k, n_probe)
+        single_ms.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    approximate = query(index, sample, k, n_probe)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(sample)
+
+    recall = np.mean([
+        len(np.intersect1d(found, true)) / k for (found, _), (true, _) in zip(approximate, exact)
+    ])
+    print(f"Benchmark: {len(sample)} queries, {n_rows} articles, k={k}, {n_probe} of {len(index['centroids'])} lists "
+          f"probed.")
+    print(f"Recall@{k}: {recall:.4f}")
+    print(f"Index query: {np.mean(single_ms):.2f} ms per query (p95 {np.percentile(single_ms, 95):.2f} ms), "
+          f"{batch_ms:.2f} ms per query in a batch.")
+    print(f"Brute force: {exact_ms:.2f} ms per query ({exact_ms / np.mean(single_ms):.1f}x slower).")
+    return recall
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the nearest-neighbour index of the PCA space.")
+    parser.add_argument("command", choices=["build", "query", "benchmark"])
+    parser.add_argument("pmids", nargs="*", type=int, help="PMIDs to query")
+    parser.add_argument("--k", type=int, default=ann_top_k, help="number of similar articles per PMID")
+    parser.add_argument("--n-probe", type=int, default=ann_n_probe, help="number of lists to search")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_index()
+        return
+
+    index = load_index()
+    if args.command == "benchmark":
+        benchmark(index, args.k, args.n_probe)
+        return
+
+    rows = find_rows(index, args.pmids)
+    for pmid in np.asarray(args.pmids)[rows < 0]:
+        print(f"PMID {pmid} not found.")
+    start = time.perf_counter()
+    results = query(index, rows[rows >= 0], args.k, args.n_probe)
+    duration_ms = (time.perf_counter() - start) * 1000
+    for row, (neighbours, distances) in zip(rows[rows >= 0], results):
+        print(f"\nArticles similar to PMID {index['pmids'][row]} (cluster {index['clusters'][row]}):")
+        print(pd.DataFrame({
+            "PMID": index["pmids"][neighbours],
+            "Cluster": index["clusters"][neighbours],
+            "Distance": np.sqrt(distances).round(4)
+        }).to_string(index=False))
+    print(f"\n({len(results)} queries took {duration_ms:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
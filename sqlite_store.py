@@ -0,0 +1,164 @@
+# This module keeps an optional SQLite copy of the multi-CSV setup (articles, keywords, MeSH-terms and chemicals), with
+# indexes on the PMID and term columns. It is enabled with 'use_sqlite_store' in the variables module. The store is
+# filled by 'create_multi_CSV' (bulk inserts per XML file) and kept up to date by 'mapreduce' and 'delta_update'. The
+# modules 'data_checking', 'descr_stats', 'convert_to_lower_case' and 'profiling_clusters' then read the store instead
+# of the CSV files, and calculate their counts and aggregations in SQL.
+# The store is saved as pubmed.sqlite in the CSV folder. It uses write-ahead logging (WAL), and the log is written back
+# to the database file when the store is closed, so the file always has the full content.
+# A row of the store has the values of the row in the CSV file, as pandas reads them: values that pandas reads as a
+# missing value (an empty value, 'NA', 'null', etc.) are NULL, and the rows are in the same order (rowid).
+#
+# Usage:
+#   python sqlite_store.py build              (Re)build the store from the CSV files.
+#   python sqlite_store.py lookup <PMID>      Show an article with its Keywords, MeSH-terms and Chemicals.
+
+import argparse                      # For the command line options.
+import sqlite3                       # For the store.
+import time                          # For the duration of a lookup.
+from pathlib import Path             # For handling file paths.
+import numpy as np                   # For missing values.
+import pandas as pd                  # For reading the CSV files and the query results.
+
+import variables
+import pmid_metadata                 # Row count of articles.csv, to check that the store is up to date.
+import schema                        # For reading the CSV files, and the types of the tables.
+
+store_filename = "pubmed.sqlite"
+insert_rows_per_batch = 100000       # Number of rows per bulk insert when the store is built from the CSV files.
+
+# The tables of the store, with the same columns as the CSV files, and their indexes.
+tables = {
+    "articles": {"PMID": "INTEGER", "Title": "TEXT", "Abstract": "TEXT", "Year": "INTEGER", "SourceFile": "TEXT"},
+    "keywords": {"PMID": "INTEGER", "Keyword": "TEXT", "SourceFile": "TEXT"},
+    "mesh_terms": {"PMID": "INTEGER", "Descriptor": "TEXT", "SourceFile": "TEXT"},
+    "chemicals": {"PMID": "INTEGER", "Chemical": "TEXT", "SourceFile": "TEXT"}
+}
+term_columns = {"keywords": "Keyword", "mesh_terms": "Descriptor", "chemicals": "Chemical"}
+
+# Texts that pandas reads as a missing value (the default 'na_values' of pandas.read_csv).
+missing_values = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA",
+    "NULL", "NaN", "None", "n/a", "nan", "null"
+}
+
+def store_path(folder):
+    return Path(folder) / store_filename
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value)) or value in missing_values
+
+def connect(folder):
+    # Open the store (it is created if it does not exist), with the tables.
+    conn = sqlite3.connect(store_path(folder))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for name, columns in tables.items():
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({', '.join(f'{c} {t}' for c, t in columns.items())})")
+    return conn
+
+def close(conn):
+    # Write the log back to the database file and close the store.
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+def create_indexes(conn):
+    # The indexes are created after the bulk inserts, which is faster than updating them for every row.
+    with conn:
+        for name in tables:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_pmid ON {name} (PMID)")
+        for name, column in term_columns.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_{column.lower()} ON {name} ({column})")
+
+def insert_rows(conn, name, rows):
+    # Insert rows (dictionaries as created by 'create_multi_CSV', or a DataFrame) in one transaction.
+    columns = list(tables[name])
+    if isinstance(rows, pd.DataFrame):
+        rows = rows.to_dict("records")
+    values = [tuple(None if is_missing(row[column]) else row[column] for column in columns) for row in rows]
+    with conn:
+        conn.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' * len(columns))})", values)
+
+def remove_pmids(conn, pmids):
+    # Remove all rows of the given PMIDs (see 'delta_update').
+    pmids = [(int(pmid),) for pmid in pmids]
+    with conn:
+        for name in tables:
+            conn.executemany(f"DELETE FROM {name} WHERE PMID = ?", pmids)
+
+def build_store(folder):
+    # (Re)build the store from the CSV files, in chunks. Text columns are read as text, as in the full file.
+    store_path(folder).unlink(missing_ok=True)
+    conn = connect(folder)
+    for name, columns in tables.items():
+        text_columns = {column: str for column, sql_type in columns.items() if sql_type == "TEXT"}
+        for chunk in schema.read_table(Path(folder) / f"{name}.csv", dtype=text_columns,
+                                       chunksize=insert_rows_per_batch):
+            insert_rows(conn, name, chunk)
+    create_indexes(conn)
+    close(conn)
+    print(f"Created: {store_filename}")
+
+def is_up_to_date(folder):
+    # The store exists and has the same number of articles as articles.csv (see 'pmid_metadata').
+    metadata = pmid_metadata.read_metadata(Path(folder))
+    if not store_path(folder).exists() or metadata is None:
+        return False
+    conn = sqlite3.connect(store_path(folder))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0] == metadata["rows"]
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+def open_store(folder):
+    # Open the store for reading.
+    if not is_up_to_date(folder):
+        raise RuntimeError(f"{store_filename} does not exist or is not up to date with articles.csv. Run "
+                           f"create_multi_CSV or 'python sqlite_store.py build'.")
+    return connect(folder)
+
+def read_table(conn, name, columns=None):
+    # Read a table (in the order of the CSV file) as a DataFrame, with NaN for missing values and the types of the CSV
+    # file (see 'schema').
+    columns = columns or list(tables[name])
+    df = pd.read_sql_query(f"SELECT {', '.join(columns)} FROM {name} ORDER BY rowid", conn)
+    for column in columns:
+        if tables[name][column] == "TEXT":
+            df[column] = df[column].where(df[column].notna(), np.nan)
+    return schema.cast(df, f"{name}.csv")
+
+def lookup(conn, pmid):
+    # An article with its Keywords, MeSH-terms and Chemicals (uses the PMID indexes).
+    article = conn.execute("SELECT PMID, Title, Year, SourceFile FROM articles WHERE PMID = ?", (pmid,)).fetchone()
+    terms = {
+        name: [row[0] for row in conn.execute(f"SELECT {column} FROM {name} WHERE PMID = ? ORDER BY rowid", (pmid,))]
+        for name, column in term_columns.items()
+    }
+    return article, terms
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the SQLite store of the multi-CSV setup.")
+    parser.add_argument("command", choices=["build", "lookup"])
+    parser.add_argument("pmid", nargs="?", type=int, help="PMID to look up")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_store(variables.csv_folder)
+        return
+
+    conn = open_store(variables.csv_folder)
+    start = time.perf_counter()
+    article, terms = lookup(conn, args.pmid)
+    duration_ms = (time.perf_counter() - start) * 1000
+    conn.close()
+    if article is None:
+        print(f"PMID {args.pmid} not found.")
+        return
+    print(f"PMID: {article[0]}\nTitle: {article[1]}\nYear: {article[2]}\nSourceFile: {article[3]}")
+    for name, values in terms.items():
+        print(f"{name}: {'; '.join(str(value) for value in values)}")
+    print(f"(lookup took {duration_ms:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
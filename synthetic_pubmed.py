@@ -0,0 +1,220 @@
+# This module generates a synthetic PubMed corpus, for testing and benchmarking the pipeline without downloading data.
+# It writes files in the same format as 'retrieve_data': pubmed25nXXXX.xml.gz, the .md5 file and the extracted .xml.
+# The articles are PubmedArticle elements with the fields that 'create_multi_CSV' reads (PMID, title, abstract,
+# publication year, languages, retraction notes, Keywords, MeSH-terms and Chemicals).
+# Every article belongs to one of a number of topics. Per topic, the words, Keywords, MeSH-terms and Chemicals follow
+# a Zipf distribution over a topic-specific order of the vocabulary, so the pipeline finds clusters in the data. Part
+# of the Keywords are real terms from TERM_REPLACEMENTS (in different letter cases), so the text cleaning and term
+# normalization are also exercised.
+# The mix of retracted, non-English and non-2024/2025 articles (which are filtered out by 'create_multi_CSV'), the
+# vocabulary sizes and the abstract length can be controlled. The same settings and seed give the same files.
+#
+# Usage:
+#   python synthetic_pubmed.py <output folder> --articles 100000
+
+import argparse                              # For the command line options.
+import gzip                                  # For compressing the XML-files.
+import hashlib                               # For the .md5 files.
+import json                                  # For the corpus description.
+import random                                # For creating the vocabularies.
+import zlib                                  # For the (stable) MeSH descriptor ids.
+from pathlib import Path                     # For handling file paths.
+from xml.sax.saxutils import escape          # For escaping text in XML.
+import numpy as np                           # For random sampling.
+
+from variables import first_file, TERM_REPLACEMENTS
+
+syllables = [
+    "ba", "ce", "di", "fo", "gu", "ka", "le", "mi", "no", "pu", "ra", "se", "ti", "vo", "zu", "an", "el", "in", "or",
+    "ul", "pro", "tra", "cy", "neo", "ther", "gen", "path", "cor", "lym", "hep"
+]
+common_words = np.array([
+    "the", "of", "and", "in", "to", "a", "with", "for", "was", "were", "is", "on", "by", "we", "this", "that", "as",
+    "patients", "study", "results", "analysis", "effect", "group", "data", "methods", "conclusion", "associated"
+], dtype=object)
+other_languages = ["ger", "fre", "spa", "chi", "jpn"]
+
+def make_vocabulary(rng, size, words_per_term=(1, 1), reserved=()):
+    # Create 'size' unique pseudo-words or multi-word terms (e.g. 'kaleno', 'proti vocy'). The 'reserved' terms are
+    # placed first, so they are the most frequent.
+    py_random = random.Random(int(rng.integers(2 ** 32)))  # Faster than numpy for drawing single values.
+    vocabulary = list(dict.fromkeys(reserved))[:size]
+    seen = set(vocabulary)
+    while len(vocabulary) < size:
+        n_words = py_random.randint(*words_per_term)
+        term = " ".join("".join(py_random.choices(syllables, k=py_random.randint(2, 4))) for _ in range(n_words))
+        if term not in seen:
+            seen.add(term)
+            vocabulary.append(term)
+    return np.array(vocabulary, dtype=object)
+
+def zipf_cdf(size, exponent=1.1):
+    # Cumulative Zipf distribution over the ranks 1..size, for sampling with np.searchsorted.
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return np.cumsum(weights) / weights.sum()
+
+def sample_terms(rng, vocabulary, cdf, topic_order, count):
+    # Sample 'count' terms of a topic (without duplicates).
+    ranks = np.minimum(np.searchsorted(cdf, rng.random(count)), len(cdf) - 1)
+    return list(dict.fromkeys(vocabulary[topic_order[ranks]]))
+
+def make_settings(args):
+    # The settings of a corpus (saved to corpus.json, to reuse an existing corpus with the same settings).
+    return {key: value for key, value in vars(args).items() if key != "output_folder"}
+
+def article_xml(rng, pmid, topic, settings, vocabularies):
+    # Create the XML of one PubmedArticle.
+    words, keywords, mesh_terms, chemicals, cdfs, orders = vocabularies
+
+    def text(length):
+        # Half of the words are topic words, the other half are common words.
+        ranks = np.minimum(np.searchsorted(cdfs["words"], rng.random(length)), len(words) - 1)
+        common = common_words[rng.integers(0, len(common_words), length)]
+        mixed = np.where(rng.random(length) < 0.5, words[orders["words"][topic][ranks]], common)
+        return escape(" ".join(mixed))
+
+    # Filters of 'create_multi_CSV': year, language and retraction.
+    year = str(rng.choice([2024, 2025])) if rng.random() >= settings["old_year_rate"] else str(rng.integers(2015, 2024))
+    languages = ["eng"]
+    if rng.random() < settings["non_english_rate"]:
+        languages = [rng.choice(other_languages)]
+    elif rng.random() < 0.02:
+        languages.append(rng.choice(other_languages))
+    ref_type = "RetractionIn" if rng.random() < settings["retraction_rate"] else "Cites"
+
+    # Title and abstract (some abstracts are structured, some are missing).
+    title = text(int(rng.integers(6, 16)))
+    abstract = ""
+    if rng.random() >= 0.05:
+        length = max(20, int(rng.lognormal(np.log(settings["abstract_words"]), 0.4)))
+        if rng.random() < 0.3:
+            parts = np.array_split(np.arange(length), 4)
+            abstract = "".join(
+                f'<AbstractText Label="{label}">{text(len(part))}</AbstractText>'
+                for label, part in zip(["BACKGROUND", "METHODS", "RESULTS", "CONCLUSIONS"], parts)
+            )
+        else:
+            abstract = f"<AbstractText>{text(length)}</AbstractText>"
+        abstract = f"<Abstract>{abstract}</Abstract>"
+
+    # Keywords (in different letter cases), MeSH-terms and Chemicals.
+    keyword_list = sample_terms(rng, keywords, cdfs["keywords"], orders["keywords"][topic], rng.poisson(5))
+    keyword_list = [k.upper() if rng.random() < 0.05 else k.title() if rng.random() < 0.2 else k for k in keyword_list]
+    mesh_list = sample_terms(rng, mesh_terms, cdfs["mesh_terms"], orders["mesh_terms"][topic], rng.poisson(9))
+    chemical_list = []
+    if rng.random() < 0.5:
+        chemical_list = sample_terms(rng, chemicals, cdfs["chemicals"], orders["chemicals"][topic], rng.poisson(2) + 1)
+
+    keyword_xml = "".join(f'<Keyword MajorTopicYN="N">{escape(k)}</Keyword>' for k in keyword_list)
+    mesh_xml = "".join(
+        f'<MeshHeading><DescriptorName UI="D{zlib.crc32(m.encode()) % 10 ** 6:06d}" MajorTopicYN="N">{escape(m)}'
+        f'</DescriptorName></MeshHeading>' for m in mesh_list
+    )
+    chemical_xml = "".join(
+        f"<Chemical><RegistryNumber>0</RegistryNumber><NameOfSubstance>{escape(c)}</NameOfSubstance></Chemical>"
+        for c in chemical_list
+    )
+
+    return (
+        f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>'
+        f'<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><PubDate><Year>{year}</Year>'
+        f'</PubDate></JournalIssue><Title>Journal of Synthetic Topic {topic}</Title></Journal>'
+        f'<ArticleTitle>{title}</ArticleTitle>{abstract}'
+        + "".join(f"<Language>{language}</Language>" for language in languages)
+        + f'</Article>'
+        + (f'<ChemicalList>{chemical_xml}</ChemicalList>' if chemical_xml else "")
+        + f'<CommentsCorrectionsList><CommentsCorrections RefType="{ref_type}"><RefSource>Synthetic</RefSource>'
+        f'</CommentsCorrections></CommentsCorrectionsList>'
+        + (f'<MeshHeadingList>{mesh_xml}</MeshHeadingList>' if mesh_xml else "")
+        + (f'<KeywordList Owner="NOTNLM">{keyword_xml}</KeywordList>' if keyword_xml else "")
+        + "</MedlineCitation></PubmedArticle>\n"
+    )
+
+def write_file(path, articles):
+    # Write the XML-file, the .gz file and the .md5 file (in the format of the PubMed .md5 files).
+    content = ('<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet>\n<PubmedArticleSet>\n'
+               + "".join(articles) + "</PubmedArticleSet>\n").encode("utf-8")
+    gz_path = path.with_name(path.name + ".gz")
+    with open(path, "wb") as f:
+        f.write(content)
+    with gzip.open(gz_path, "wb", compresslevel=5) as f:
+        f.write(content)
+    with open(gz_path, "rb") as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    with open(gz_path.with_name(gz_path.name + ".md5"), "w") as f:
+        f.write(f"MD5({gz_path.name})= {md5}\n")
+
+def generate(output_folder, settings):
+    # Generate the corpus. An existing corpus with the same settings is reused.
+    output_folder = Path(output_folder)
+    description_path = output_folder / "corpus.json"
+    if description_path.exists():
+        with open(description_path, "r") as f:
+            if json.load(f) == settings:
+                print(f"Synthetic corpus already exists: {output_folder}")
+                return
+    output_folder.mkdir(parents=True, exist_ok=True)
+    for old_file in output_folder.glob("pubmed25n*.xml*"):
+        old_file.unlink()
+
+    # Vocabularies, and per topic an order of every vocabulary (the most frequent terms differ per topic).
+    rng = np.random.default_rng(settings["seed"])
+    vocabulary_sizes = {
+        "words": settings["words"], "keywords": settings["keywords"],
+        "mesh_terms": settings["mesh_terms"], "chemicals": settings["chemicals"]
+    }
+    vocabularies = {
+        "words": make_vocabulary(rng, settings["words"]),
+        "keywords": make_vocabulary(rng, settings["keywords"], (1, 3), reserved=TERM_REPLACEMENTS.keys()),
+        "mesh_terms": make_vocabulary(rng, settings["mesh_terms"], (1, 3), reserved=TERM_REPLACEMENTS.keys()),
+        "chemicals": make_vocabulary(rng, settings["chemicals"], (1, 2))
+    }
+    cdfs = {name: zipf_cdf(size) for name, size in vocabulary_sizes.items()}
+    orders = {
+        name: [rng.permutation(size) for _ in range(settings["topics"])] for name, size in vocabulary_sizes.items()
+    }
+    all_vocabularies = (
+        vocabularies["words"], vocabularies["keywords"], vocabularies["mesh_terms"], vocabularies["chemicals"],
+        cdfs, orders
+    )
+
+    # Write the files.
+    topic_weights = rng.dirichlet(np.full(settings["topics"], 2.0))
+    n_files = -(-settings["articles"] // settings["articles_per_file"])
+    for file_index in range(n_files):
+        start = file_index * settings["articles_per_file"]
+        end = min(start + settings["articles_per_file"], settings["articles"])
+        topics = rng.choice(settings["topics"], size=end - start, p=topic_weights)
+        articles = [
+            article_xml(rng, 30000000 + start + i, topic, settings, all_vocabularies) for i, topic in enumerate(topics)
+        ]
+        write_file(output_folder / f"pubmed25n{settings['first_file'] + file_index:04d}.xml", articles)
+        print(f"Saved: pubmed25n{settings['first_file'] + file_index:04d}.xml(.gz/.md5) ({end - start} articles)")
+
+    with open(description_path, "w") as f:
+        json.dump(settings, f, indent=2)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic PubMed corpus.")
+    parser.add_argument("output_folder", help="folder for the XML-files (the destination_folder of the pipeline)")
+    parser.add_argument("--articles", type=int, default=10000, help="number of articles")
+    parser.add_argument("--articles-per-file", type=int, default=30000, help="number of articles per XML-file")
+    parser.add_argument("--first-file", type=int, default=first_file, help="number of the first file")
+    parser.add_argument("--topics", type=int, default=20, help="number of topics")
+    parser.add_argument("--words", type=int, default=20000, help="size of the title/abstract vocabulary")
+    parser.add_argument("--keywords", type=int, default=20000, help="size of the Keyword vocabulary")
+    parser.add_argument("--mesh-terms", type=int, default=10000, help="size of the MeSH-term vocabulary")
+    parser.add_argument("--chemicals", type=int, default=5000, help="size of the Chemical vocabulary")
+    parser.add_argument("--abstract-words", type=int, default=200, help="median number of words per abstract")
+    parser.add_argument("--retraction-rate", type=float, default=0.002, help="fraction of retracted articles")
+    parser.add_argument("--non-english-rate", type=float, default=0.05, help="fraction of non-English articles")
+    parser.add_argument("--old-year-rate", type=float, default=0.1, help="fraction of articles before 2024")
+    parser.add_argument("--seed", type=int, default=20250501, help="random seed")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    generate(args.output_folder, make_settings(args))
+
+if __name__ == "__main__":
+    main()
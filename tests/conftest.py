@@ -0,0 +1,6 @@
+# The modules of the pipeline are in the root of the repository, next to this folder.
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
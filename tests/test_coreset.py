@@ -0,0 +1,29 @@
+# Tests of the weighted coreset of 'coreset'.
+
+import numpy as np
+import pandas as pd
+
+import coreset
+
+def write_pca_output(folder, X):
+    # A PCA output with the rows of X.
+    path = folder / "data_after_pca.csv"
+    df = pd.DataFrame(X, columns=[f"pca_{i + 1}" for i in range(X.shape[1])])
+    df.insert(0, "SourceFile", "pubmed.xml")
+    df.insert(0, "PMID", np.arange(len(X)))
+    df.to_csv(path, sep="~", index=False)
+    return path
+
+def test_all_rows_when_they_fit(tmp_path):
+    # No more rows than draws: the coreset is the full data, with weight 1.
+    X = np.random.default_rng(0).normal(size=(300, 3))
+    rows, weights = coreset.build(write_pca_output(tmp_path, X), 300, 0)
+    assert np.allclose(rows, X)
+    assert np.array_equal(weights, np.ones(300))
+
+def test_weights_estimate_the_size(tmp_path):
+    # More rows than draws: the total weight estimates the number of rows.
+    X = np.random.default_rng(0).normal(size=(3000, 3))
+    rows, weights = coreset.build(write_pca_output(tmp_path, X), 500, 0)
+    assert len(rows) <= 500
+    assert abs(weights.sum() - 3000) < 300
@@ -0,0 +1,78 @@
+# Tests of the term counting and normalization of 'profiling_clusters'.
+
+import random
+
+import numpy as np
+import pandas as pd
+
+import pmid_metadata
+import profiling_clusters
+import sqlite_store
+from variables import TERM_REPLACEMENTS
+
+def profile_terms(df, column, top_n=3):
+    # The top terms per cluster, as dictionaries.
+    cluster_ids = np.sort(df["Cluster"].unique())
+    counts, first_rows, terms = profiling_clusters.count_terms_per_cluster(df, column, cluster_ids)
+    sizes = df["Cluster"].value_counts()
+    return {
+        cluster_id: profiling_clusters.top_terms(counts, first_rows, terms, row, sizes[cluster_id], top_n).to_dict()
+        for row, cluster_id in enumerate(cluster_ids)
+    }
+
+def test_ties_in_order_of_first_appearance_within_the_cluster():
+    # 'aaa' appears first in the table, but 'bbb' appears first in cluster 2.
+    df = pd.DataFrame({"PMID": [1, 2, 3], "Keyword": ["aaa", "bbb", "aaa"], "Cluster": [1, 2, 2]})
+    assert profile_terms(df, "Keyword", top_n=1) == {1: {"aaa": 1.0}, 2: {"bbb": 0.5}}
+
+def test_highest_count_first():
+    df = pd.DataFrame({"PMID": [1, 2, 3, 4], "Keyword": ["aaa", "bbb", "bbb", "ccc"], "Cluster": [1, 1, 1, 1]})
+    assert list(profile_terms(df, "Keyword")[1]) == ["bbb", "aaa", "ccc"]
+
+def test_ties_in_the_sqlite_store(tmp_path, monkeypatch):
+    # The same case, counted in SQL.
+    conn = sqlite_store.connect(tmp_path)
+    sqlite_store.insert_rows(conn, "articles", [
+        {"PMID": pmid, "Title": "t", "Abstract": "a", "Year": 2024, "SourceFile": "f"} for pmid in [1, 2, 3]
+    ])
+    sqlite_store.insert_rows(conn, "keywords", [
+        {"PMID": pmid, "Keyword": keyword, "SourceFile": "f"} for pmid, keyword in [(1, "aaa"), (2, "bbb"), (3, "aaa")]
+    ])
+    sqlite_store.create_indexes(conn)
+    sqlite_store.close(conn)
+    pmid_metadata.write_metadata(tmp_path, 3, pmid_metadata.pmid_checksum([1, 2, 3]))
+    monkeypatch.setattr(profiling_clusters, "csv_folder", tmp_path)
+
+    clusters = pd.DataFrame({"PMID": [1, 2, 3], "Cluster": [1, 2, 2]})
+    cluster_ids = np.array([1, 2])
+    results = profiling_clusters.count_terms_per_cluster_store(clusters, cluster_ids)
+    counts, first_rows, terms = results["keywords"]
+    top = profiling_clusters.top_terms(counts, first_rows, terms, 1, 2, 1)
+    assert top.to_dict() == {"bbb": 0.5}
+
+def test_normalize_terms_is_independent_of_the_order_of_the_terms():
+    terms = pd.Series(["machine learning", np.nan, "children", "deep learning", "aged, 80 and over", "machine learning",
+                       "neural networks, computer", "other term"])
+    expected = profiling_clusters.normalize_terms(terms)
+    for seed in range(5):
+        shuffled = terms.sample(frac=1, random_state=seed)
+        pd.testing.assert_series_equal(profiling_clusters.normalize_terms(shuffled), expected.loc[shuffled.index])
+
+def test_normalizer_is_independent_of_the_order_of_the_replacements():
+    terms = [*TERM_REPLACEMENTS, "deep learning models", "neural networks, computer and children", "other term"]
+    expected = [profiling_clusters.normalize_term(term) for term in terms]
+    items = list(TERM_REPLACEMENTS.items())
+    for seed in range(5):
+        shuffled = items.copy()
+        random.Random(seed).shuffle(shuffled)
+        normalize = profiling_clusters.build_term_normalizer(dict(shuffled))
+        assert [normalize(term) for term in terms] == expected
+
+def test_overlapping_replacement_keys():
+    # The longest key wins, whatever the order of the keys, and replaced text is not replaced again.
+    replacements = {"network": "net", "neural network": "ann", "neural networks": "anns", "anns": "other"}
+    items = list(replacements.items())
+    for ordered in [items, items[::-1], items[1:] + items[:1]]:
+        normalize = profiling_clusters.build_term_normalizer(dict(ordered))
+        assert normalize("Deep neural networks and a network ") == "deep anns and a net"
+        assert normalize("neural network") == "ann"
@@ -0,0 +1,107 @@
+# Tests of 'query_service': the service runs on localhost with the outputs in 'sample_data'.
+
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+import query_service
+import variables
+
+sample_data = Path(__file__).resolve().parent.parent / "sample_data"
+
+@pytest.fixture
+def service(monkeypatch):
+    # Start the service on a free port. Returns a function that sends a request (status and JSON response).
+    monkeypatch.setattr(variables, "service_reload_interval", 0.05)
+    started = []
+
+    def start(folder):
+        server, shutdown = query_service.start_service(str(folder), "127.0.0.1", 0)
+        started.append(shutdown)
+        return request_function(server.server_address[1])
+
+    yield start
+    for shutdown in started:
+        shutdown()
+
+def request_function(port):
+    def request(path, body=None):
+        data = None if body is None else body if isinstance(body, bytes) else json.dumps(body).encode()
+        method = "GET" if data is None else "POST"
+        req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+    return request
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_health_and_clusters(service):
+    request = service(sample_data)
+    status, response = request("/health")
+    assert status == 200 and response["articles"] == 10 and response["clusters"] == 3
+    assert request("/clusters") == (200, {"clusters": [
+        {"cluster": 1, "size": 3}, {"cluster": 5, "size": 1}, {"cluster": 6, "size": 6}
+    ]})
+
+def test_pmid_lookups(service):
+    request = service(sample_data)
+    assert request("/pmid/34463149") == (200, {"pmid": "34463149", "cluster": 6})
+    assert request("/pmid/34463151") == (200, {"pmid": "34463151", "cluster": 1})
+    assert request("/pmids?ids=34463149,1,abc,34463151") == (200, {"clusters": {
+        "34463149": 6, "1": None, "abc": None, "34463151": 1
+    }})
+    assert request("/pmids", {"pmids": [34463149, "34463151", 1]}) == (200, {"clusters": {
+        "34463149": 6, "34463151": 1, "1": None
+    }})
+
+def test_cluster_and_top_terms(service):
+    request = service(sample_data)
+    assert request("/cluster/6") == (200, {"cluster": 6, "size": 6, "profile": {}})
+    assert request("/cluster/6/top-terms?n=2") == (200, {"cluster": 6, "top_terms": {}})
+
+def test_errors(service):
+    request = service(sample_data)
+    assert request("/pmid/1")[0] == 404
+    assert request("/cluster/99")[0] == 404
+    assert request("/cluster/abc")[0] == 404
+    assert request("/unknown")[0] == 404
+    assert request("/unknown", {"pmids": []})[0] == 404
+    assert request("/cluster/6/top-terms?n=x")[0] == 400
+    assert request("/pmids", b"not json")[0] == 400
+    assert request("/pmids", {"ids": []})[0] == 400
+
+def test_hot_reload(service, tmp_path):
+    # A copy of the sample data, so the files can be changed.
+    shutil.copy(sample_data / "data_with_clusters.csv", tmp_path)
+    request = service(tmp_path)
+    assert request("/cluster/6") == (200, {"cluster": 6, "size": 6, "profile": {}})
+    loaded_at = query_service.data
+
+    # Add the profiles and touch the labels: the service loads both again, and clears the cache.
+    (tmp_path / "cluster_profiles").mkdir()
+    profile = {"size": 6, "Top Keywords": {"covid-19": 0.5, "vaccine": 0.3, "children": 0.1}}
+    with open(tmp_path / "cluster_profiles" / "cluster_profiles.json", "w") as f:
+        json.dump({"6": profile}, f)
+    labels_path = tmp_path / "data_with_clusters.csv"
+    os.utime(labels_path, ns=(time.time_ns(), labels_path.stat().st_mtime_ns + 10 ** 9))
+
+    assert wait_for(lambda: query_service.data is not loaded_at)
+    assert request("/cluster/6") == (200, {"cluster": 6, "size": 6, "profile": profile})
+    assert request("/cluster/6/top-terms?n=2") == (200, {
+        "cluster": 6, "top_terms": {"Top Keywords": ["covid-19", "vaccine"]}
+    })
@@ -0,0 +1,62 @@
+# Tests of the schema errors and the superseded rows of 'schema'.
+
+import pandas as pd
+import pytest
+
+import schema
+
+def test_missing_column(tmp_path):
+    pd.DataFrame({"PMID": [1], "Keyword": ["a"]}).to_csv(tmp_path / "keywords.csv", sep="~", index=False)
+    with pytest.raises(schema.SchemaError, match="missing column"):
+        schema.read_table(tmp_path / "keywords.csv")
+
+def test_value_that_does_not_fit(tmp_path):
+    df = pd.DataFrame({"PMID": ["not a number"], "CanonicalPMID": [1]})
+    df.to_csv(tmp_path / "near_duplicates.csv", sep="~", index=False)
+    with pytest.raises(schema.SchemaError, match="near_duplicates.csv"):
+        schema.read_table(tmp_path / "near_duplicates.csv")
+    with pytest.raises(schema.SchemaError):
+        list(schema.read_table(tmp_path / "near_duplicates.csv", chunksize=1))
+
+def test_unknown_table_and_column(tmp_path):
+    with pytest.raises(schema.SchemaError, match="has no schema"):
+        schema.write_table(pd.DataFrame({"PMID": [1]}), tmp_path / "unknown.csv")
+    with pytest.raises(schema.SchemaError, match="unknown column"):
+        schema.write_table(pd.DataFrame({"PMID": [1], "Other": [2]}), tmp_path / "near_duplicates.csv")
+
+def test_is_a_value_error():
+    # Callers can catch schema errors as ValueError, without catching every other error.
+    assert issubclass(schema.SchemaError, ValueError)
+
+def write_tombstones(folder):
+    # PMID 1 has been revised (latest version in f2.xml, without keywords), 3 has been deleted and 4 has been revised
+    # (latest version in f2.xml, with keywords).
+    tombstones = pd.DataFrame({
+        "PMID": [1, 3, 4], "SourceFile": ["f2.xml", None, "f2.xml"],
+        "MissingFrom": ["keywords_transformed.csv", None, ""]
+    })
+    schema.write_table(tombstones, folder / schema.tombstones_filename)
+
+def test_rows_with_another_source_file_are_superseded(tmp_path):
+    df = pd.DataFrame({
+        "PMID": [1, 1, 2, 3, 4, 4], "Keyword": ["a", "b", "c", "d", "e", "f"],
+        "SourceFile": ["f1.xml", "f1.xml", "f1.xml", "f1.xml", "f1.xml", "f2.xml"]
+    })
+    df.to_csv(tmp_path / "keywords.csv", sep="~", index=False)
+    write_tombstones(tmp_path)
+    live = schema.read_table(tmp_path / "keywords.csv")
+    assert live["Keyword"].tolist() == ["c", "f"]
+    assert live.index.tolist() == [0, 1]
+    assert live["Keyword"].cat.categories.tolist() == ["c", "f"]
+    chunks = list(schema.read_table(tmp_path / "keywords.csv", usecols=["Keyword"], chunksize=2))
+    assert [chunk["Keyword"].tolist() for chunk in chunks] == [[], ["c"], ["f"]]
+    assert chunks[-1].columns.tolist() == ["Keyword"]
+
+def test_last_row_is_kept_in_files_without_source_file(tmp_path):
+    df = pd.DataFrame({"PMID": [1, 2, 3, 4, 1, 4], "kw__a": [1, 0, 1, 0, 1, 1]})
+    df.to_csv(tmp_path / "keywords_transformed.csv", sep="~", index=False)
+    write_tombstones(tmp_path)
+    assert schema.read_table(tmp_path / "keywords_transformed.csv")["PMID"].tolist() == [2, 4]
+    # 'nrows' counts all rows of the file.
+    assert schema.read_table(tmp_path / "keywords_transformed.csv", nrows=5)["PMID"].tolist() == [2]
+    assert schema.read_table(tmp_path / "keywords_transformed.csv", skiprows=[2])["PMID"].tolist() == [4]
@@ -1,30 +1,41 @@
 # This script applies multi-hot encoding to the cleaned Keywords, MeSH-terms, and Chemical files.
 # It creates CSV-files containing the top-N most frequent values for each category.
+# If 'skip_near_duplicates' is True, the near-duplicates (see 'near_duplicates') are left out.
 
-import pandas as pd             # For reading and writing CSV files.
+import pandas as pd             # For the multi-hot encoding.
 from pathlib import Path        # For working with file paths.
 
 import variables
+import schema                   # For reading and writing the CSVs with the types of their schema.
+import near_duplicates          # For the near-duplicates that are skipped.
 
 # Set directory.
 csv_folder = Path(variables.csv_folder)
 
+# Multi-hot encode a categorical column, using only the given values (one column per value).
+def encode(df, column, values):
+    filtered = df[df[column].isin(values)]
+
+    # Apply one-hot encoding. A categorical column is encoded as text, so the categories of the other values do not get
+    # a column.
+    one_hot = pd.get_dummies(filtered[column].astype(object), dtype="uint8")
+    result = pd.concat([filtered[["PMID"]], one_hot], axis=1)
+    return result.groupby("PMID").sum().astype("uint8").reset_index()
+
 def main():
+    skipped = near_duplicates.skipped_pmids(csv_folder)
+
     # Convert a categorical column into a multi-hot encoded feature set.
     def multi_hot_encode(filepath, column, top_n, output_name):
-        df = pd.read_csv(filepath, sep="~")
+        df = schema.read_table(filepath)
+        df = df[~df["PMID"].isin(skipped)]
 
         # Keep only the top-N most frequent values.
-        top_values = df[column].value_counts().nlargest(top_n).index
-        filtered = df[df[column].isin(top_values)]
-
-        # Apply one-hot encoding.
-        one_hot = pd.get_dummies(filtered[column])
-        result = pd.concat([filtered[["PMID"]], one_hot], axis=1)
-        result = result.groupby("PMID").sum().reset_index()
+        top_values = schema.value_counts(df[column]).nlargest(top_n).index
+        result = encode(df, column, top_values)
 
         # Export the result.
-        result.to_csv(csv_folder / f"{output_name}_transformed.csv", sep="~", index=False)
+        schema.write_table(result, csv_folder / f"{output_name}_transformed.csv")
         return result
 
     # Process and export multi-hot encoded features.
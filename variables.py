@@ -1,7 +1,5 @@
 # This module contains the variables/configs used by other modules.
 
-from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
-
 # Variables for retrieving the data. The first file is the .GZ-file with the lowest number. The last file is the
 # file with the highest number.
 first_file = 1100
@@ -12,6 +10,15 @@ base_url = "https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/"
 destination_folder = "PLACEHOLDER"
 csv_folder = "PLACEHOLDER"
 
+# Variables for the daily update files (see 'delta_update'). The update files continue the numbering of the baseline.
+# They are downloaded to the folder 'updatefiles' in the destination folder.
+update_base_url = "https://ftp.ncbi.nlm.nih.gov/pubmed/updatefiles/"
+update_first_file = 1275
+update_last_file = 1275
+# An update only appends rows; the rows of revised and deleted articles are left out when the files are read. They are
+# removed from the files (compaction) when the revised and deleted articles exceed this share of all articles.
+delta_compact_share = 0.05
+
 # Multi hot encoding variables. The top N most used Keywords, MeSH-terms and Chemicals that are added to the combined
 # feature table. This data is used by the module 'transform_categorical_to_binary'.
 top_n_keywords=100
@@ -28,25 +35,141 @@ abstract_ngram_range = (1, 2)
 min_df_clustering = 500 # Only include terms that appear in at least N documents (so titles, abstracts).
 max_df_clustering = 0.7 # Exclude terms that appear in more than X% of all documents.
 
+# TF-IDF feature mode for clustering: "vocabulary" (the settings above, fitted on all titles and abstracts at once) or
+# "hashing" (see 'hashing_tfidf'). In the hashing mode every n-gram is hashed to one of 'hashing_n_features' columns,
+# so the texts are vectorized in chunks, in parallel by 'hashing_n_jobs' worker processes (None = number of CPU cores).
+# The n-gram ranges and stop words are used in both modes. Every column is named after its most frequent n-gram; the
+# 'hashing_terms_per_bucket' most frequent n-grams per column are saved as well.
+tfidf_feature_mode = "vocabulary"
+hashing_n_features = 256
+hashing_terms_per_bucket = 5
+hashing_n_jobs = None
+
 # TF-IDF config for profiling (!).
-tfidf_chunk_size = 125000  # number of rows processed.
+tfidf_chunk_size = 125000  # number of rows used to fit the vectorizer (fewer if they do not fit in 'max_memory_gb').
 title_abstract_max_features = 100
 title_abstract_ngram_range = (2, 2)
 
 min_df_profiling = 500 # Only include terms that appear in at least N documents (so titles, abstracts).
 max_df_profiling = 0.5 # Exclude terms that appear in more than X% of all documents.
 
+# Near-duplicate detection configs (see 'near_duplicates'). Articles of which the word N-grams (shingles) of the
+# ('title' + 'abstract') texts have an estimated Jaccard similarity of at least the threshold are near-duplicates. The
+# MinHash signatures have 'near_duplicate_num_perm' values (a multiple of the number of bands), split into
+# 'near_duplicate_bands' bands for the LSH. If 'skip_near_duplicates' is True, the feature stages, PCA and clustering
+# only use the canonical article (lowest PMID) of a group of near-duplicates. If it is False, they are not searched.
+near_duplicate_threshold = 0.8
+near_duplicate_shingle_size = 3
+near_duplicate_num_perm = 128
+near_duplicate_bands = 16
+near_duplicate_random_state = 20250501
+skip_near_duplicates = False
+
+# Clustering configs. The K-range is evaluated on a random sample of the PCA output. The sweep runs in a process pool.
+# Each worker gets an equal share of the CPU cores for its (BLAS/OpenMP) threads, so the workers do not compete.
+clustering_random_state = 20250501
+clustering_k_min = 2
+clustering_k_max = 19
+clustering_sample_size = 65000
+clustering_n_jobs = None # Number of worker processes for the K-sweep. None means one per CPU core (max. one per K).
+clustering_warm_start = False # If True, K+1 is initialized by splitting the worst cluster of the K solution (bisecting).
+
+# Sample of the K-sweep: "coreset" (a weighted importance sample of 'clustering_sample_size' draws, see 'coreset') or
+# "uniform" (a uniform random sample of 'clustering_sample_size' rows). A coreset keeps small and distinct clusters in
+# the sample, and its weighted inertia estimates the inertia on the full data.
+clustering_sample_method = "coreset"
+
+# Clustering engine for the final model: "kmeans" (K-Means on the full PCA output in RAM) or "minibatch" (Mini-Batch
+# K-Means on a memory-mapped copy of the PCA output, for datasets that do not fit in RAM).
+clustering_engine = "kmeans"
+minibatch_batch_size = 10000 # Number of rows per mini-batch.
+minibatch_max_epochs = 10 # Maximum number of passes over the full data.
+minibatch_max_no_improvement = 50 # Stop after N batches without improvement of the (smoothed) batch inertia.
+minibatch_tol = 0.0 # Stop when the squared centroid shift of a batch is at most this value. 0 disables this check.
+minibatch_init_size = 100000 # Number of random rows used for the k-means++ initialization.
+minibatch_chunk_size = 100000 # Number of rows per chunk for converting, labeling and saving.
+clustering_checkpoint_iterations = 10 # Number of K-Means iterations per checkpoint of the final fit (K-Means engine).
+
+# Similar-article index configs (see 'similar_articles'). The PCA vectors are divided over 'ann_n_lists' lists (None
+# means 4 x the square root of the number of articles), and a query searches the 'ann_n_probe' nearest lists. The list
+# centroids are trained with N iterations on a sample of articles. The benchmark compares N random queries with brute
+# force.
+ann_n_lists = None
+ann_n_probe = 16
+ann_train_iterations = 10
+ann_train_sample_size = 100000
+ann_top_k = 10
+ann_benchmark_sample_size = 1000
+
+# Cluster plot configs. "density" counts all articles into a grid of N x N cells per cluster, "sample" draws a scatter
+# plot of a stratified sample of N articles. Both take the same time for any number of articles.
+cluster_plot_mode = "density"
+cluster_plot_bins = 300
+cluster_plot_sample_size = 20000
+
+# Cluster quality configs. The quality metrics per K are calculated on the full PCA output, read in chunks (sized by
+# 'max_memory_gb'). The exact silhouette is only calculated on a small subsample, to report the error of the simplified
+# silhouette.
+quality_check_sample_size = 5000
+
 # Profiling configs. The number of top 'N' terms displayed per cluster/profile.
 profiling_number_of_top_keywords = 3
 profiling_number_of_top_mesh = 3
 profiling_number_of_top_chemicals = 3
 profiling_number_of_top_words_in_title_abstract = 3
 
+# Profiling output configs. All profiles are always saved to one file (cluster_profiles.json). If
+# 'profiling_render_charts' is True, a profile CSV and a bar chart (PNG) are also saved per cluster. The charts are
+# rendered in parallel by 'profiling_n_jobs' worker processes (None = number of CPU cores).
+profiling_render_charts = True
+profiling_n_jobs = None
+
+# SQLite store (see 'sqlite_store'). If True, 'create_multi_CSV' also saves the articles, Keywords, MeSH-terms and
+# Chemicals to an indexed SQLite database, and the checks, statistics, lower-case conversion and profiling read it
+# instead of the CSV files.
+use_sqlite_store = False
+
+# Query service configs (see 'query_service'). The host and port of the local HTTP service, the number of cached
+# responses, and the interval in seconds at which the output files are checked for a new run of the pipeline.
+service_host = "127.0.0.1"
+service_port = 8050
+service_cache_size = 10000
+service_reload_interval = 5.0
+
+# Memory budget in GB (see 'memory_budget'). The chunked stages (TF-IDF for profiling, PCA, clustering and profiling)
+# size their chunks, samples and worker processes to stay within this budget. None means half of the physical memory
+# (or 4 GB where it cannot be read, e.g. on Windows).
+max_memory_gb = None
+
+# Checkpoint configs (see 'checkpoints'). The passes over the data in 'perform_PCA' and the final K-Means fit in
+# 'clustering' save a checkpoint at most every N seconds, so an interrupted stage continues from its last checkpoint
+# when it is run again. None disables checkpoints.
+checkpoint_interval = 300
+
+# Pipeline configs. The number of worker processes for running independent stages concurrently (see 'pipeline'). None
+# means the number of CPU cores.
+pipeline_n_jobs = None
+
+# Map-reduce configs (see 'mapreduce'). The number of local worker processes (None means the number of CPU cores;
+# workers on other hosts can join as well), the time in seconds after which a task of a worker that no longer reports
+# is run again, and the interval in seconds at which the coordinator and the workers check the job folder.
+mapreduce_n_jobs = None
+mapreduce_task_timeout = 600
+mapreduce_poll_interval = 1.0
+
+# Instrumentation configs (see 'instrumentation'). Memory and I/O are sampled every N seconds. The optional profiler
+# ("cprofile", "sampling" or None) is used for the stages in 'instrumentation_profile_stages' (None means all stages).
+# The sampling profiler records the stack every N seconds.
+instrumentation_sample_interval = 0.1
+instrumentation_profiler = None
+instrumentation_profile_stages = None
+instrumentation_profile_interval = 0.01
+
 # The following stop words are used by the TF-IDF on Title and Abstract (separately) and ('Title' + 'Abstract').
 # This should prevent clustering articles based on domain specific 'stop words'.  The selection of these words has
 # been done manually based on iterations. Only 'single' terms are included, no combinations. This is the format that
 # TF-IDF requires from a set of stopwordss.
-CUSTOM_DOMAIN_STOPWORDS_TF_IDF = ENGLISH_STOP_WORDS.union(set([
+DOMAIN_STOPWORDS_TF_IDF = set([
     "study", "effect", "effects", "analysis", "trial", "patients", "group", "data", "results",
     "evaluation", "based", "impact", "associated", "association", "human", "case", "cases",
     "review", "systematic", "prognosis", "meta", "meta-analysis", "risk", "factors", "objective",
@@ -77,13 +200,13 @@ CUSTOM_DOMAIN_STOPWORDS_TF_IDF = ENGLISH_STOP_WORDS.union(set([
     "severe", "ng", "ml", "operating", "characteristic", "pre", "post", "receiver", "semi",
     "structured", "sensitivity", "specificity", "state", "art", "remains", "unclear", "area", "curve",
     "did", "differ", "et", "al", "kaplan", "meier", "qualitative"
-]))
+])
 
 # The following stop words are used by the profiling module. This prevents profiling clusters based on domain
 # specific stop words. The selection of these words has been done manually based on iterations. Since the set is
 # used for profiling, both single terms and combinations of terms are used (i.e. 'correlated' and
 # 'positively correlated').
-CUSTOM_DOMAIN_STOPWORDS_PROFILING = ENGLISH_STOP_WORDS.union(set([
+DOMAIN_STOPWORDS_PROFILING = set([
     "study", "effect", "effects", "analysis", "trial", "patients", "group", "data",
     "disease", "treatment", "approach", "results", "evaluation", "based", "impact",
     "associated", "association", "human", "case", "review", "systematic", "studies",
@@ -123,20 +246,38 @@ CUSTOM_DOMAIN_STOPWORDS_PROFILING = ENGLISH_STOP_WORDS.union(set([
     "years age", "age sex", "65 years", "longitudinal studies", "different types", "length stay",
     "randomized controlled trial", "adolescents", "intervention", "cox proportional", "qualitative research",
 
-]))
+])
 
-# Term normalization dictionary. This has been done manually based on iterations.
+# The complete stop word sets are the domain stop words above plus the English stop words of scikit-learn. They are
+# created when they are used for the first time, so importing this module does not import scikit-learn (which takes
+# about a second).
+def __getattr__(name):
+    domain_stopwords = {
+        "CUSTOM_DOMAIN_STOPWORDS_TF_IDF": DOMAIN_STOPWORDS_TF_IDF,
+        "CUSTOM_DOMAIN_STOPWORDS_PROFILING": DOMAIN_STOPWORDS_PROFILING
+    }
+    if name not in domain_stopwords:
+        raise AttributeError(f"module 'variables' has no attribute '{name}'")
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    globals()[name] = ENGLISH_STOP_WORDS.union(domain_stopwords[name])
+    return globals()[name]
+
+# Term normalization dictionary. This has been done manually based on iterations. The replacements are applied in one
+# pass, and the longest matching term wins (the order of the entries does not matter). A replaced term is not replaced
+# again, so e.g. "infant, newborn" needs its own entry (otherwise it would become "child, newborn").
 TERM_REPLACEMENTS = {
     "child, preschool": "child",
     "infant": "child",
+    "infant, newborn": "child",
     "children": "child",
     "child, newborn": "child",
-    "child, preschool": "child",
     "older adults": "aged",
     "aged, 80 and over": "aged",
     "machine learning": "artificial intelligence",
     "deep learning": "artificial intelligence",
     "neural network": "artificial intelligence",
+    "neural networks": "artificial intelligence",
+    "neural networks, computer": "artificial intelligence",
     "artificial intelligences, computer": "artificial intelligence",
     "artificial intelligences": "artificial intelligence",
     "sars-cov-2": "covid-19",